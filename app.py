@@ -1,10 +1,11 @@
 """APP-IT-PMR-2  —  Aplicación Flask modular con Blueprints.
 
 El monolito original se ha dividido en:
-    models.py          – User, get_db, init_db
+    models.py          – User, pool de conexiones (get_db), init_db
     utils.py           – helpers compartidos (PDF, email, importación, paginación)
+    jobs.py            – importaciones en segundo plano (tabla import_jobs)
     routes/            – Blueprints (auth, admin, main, moviles, computers,
-                         history, incidents, extras)
+                         history, incidents, extras, jobs, api)
 """
 
 import os
@@ -14,7 +15,7 @@ from dotenv import load_dotenv
 from flask import Flask, jsonify, request as flask_request, redirect, url_for
 from flask_login import LoginManager
 
-from models import get_db, close_db, init_db, User
+from models import get_db, get_pool, close_db, init_db, User
 from routes import register_blueprints
 
 # ---------------------------------------------------------------------------
@@ -73,6 +74,8 @@ app.teardown_appcontext(close_db)
 # Inicializar BD y registrar blueprints
 # ---------------------------------------------------------------------------
 init_db()
+get_pool()  # abre ya las primeras conexiones de este proceso
+get_pool(readonly=True)
 register_blueprints(app)
 
 
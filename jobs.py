@@ -0,0 +1,130 @@
+"""Importaciones en segundo plano: tabla ``import_jobs`` y pool de hilos.
+
+La subida se guarda en un temporal, se crea el job y la petición vuelve de
+inmediato con su id.  Un hilo del pool ejecuta la importación (con su propio
+contexto de aplicación y su propia conexión) y va actualizando el progreso
+en la tabla, que se consulta desde ``/api/import_jobs/<id>``.  Al estar en
+SQLite el estado es visible desde cualquier worker de gunicorn.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from werkzeug.datastructures import FileStorage
+
+from models import CLAVES_NATURALES, get_db, write_transaction
+
+IMPORT_WORKERS = 1         # SQLite admite un solo escritor: las importaciones van en serie
+JOB_MAX_ERRORS = 1000      # errores guardados por job (el total va en num_errores)
+JOB_STALE_SECONDS = 600    # un job en curso sin actualizar en este tiempo se da por interrumpido
+
+ESTADO_PENDIENTE = 'pendiente'
+ESTADO_EN_CURSO = 'en_curso'
+ESTADO_TERMINADO = 'terminado'
+ESTADO_ERROR = 'error'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix='import')
+        return _executor
+
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+
+def submit_import(tipo, file, run, usuario, volver=None, dry_run=False, **params):
+    """Encola la importación de *file* y devuelve el id del job.
+
+    *run(file, progress=..., dry_run=..., **params)* hace el trabajo real y
+    devuelve el dict de :func:`utils.bulk_insert` (más ``volver`` opcional).
+    *volver* es la URL a la que enlaza la página de resultado.  Con *dry_run*
+    el job solo valida el fichero (ver :func:`utils.dry_run_import`).
+    """
+    filename = (file.filename or '') if file else ''
+    fd, path = tempfile.mkstemp(prefix='import-', suffix=os.path.splitext(filename)[1])
+    with os.fdopen(fd, 'wb') as tmp:
+        if file:
+            file.save(tmp)
+
+    with write_transaction() as db:
+        cur = db.execute(
+            'INSERT INTO import_jobs (tipo, archivo, usuario, estado, simulacion, volver, creado, actualizado) '
+            'VALUES (?,?,?,?,?,?,?,?)',
+            (tipo, filename, usuario, ESTADO_PENDIENTE, int(dry_run), volver, _now(), _now()),
+        )
+    job_id = cur.lastrowid
+
+    app = current_app._get_current_object()
+    _get_executor().submit(_run_job, app, job_id, path, filename, run, dict(params, dry_run=dry_run))
+    return job_id
+
+
+def _save_progress(db, job_id, res, estado=ESTADO_EN_CURSO):
+    with write_transaction(db):
+        db.execute(
+            'UPDATE import_jobs SET estado = ?, procesadas = ?, insertadas = ?, actualizadas = ?, '
+            'sin_cambios = ?, num_errores = ?, errores = ?, segundos = ?, actualizado = ? WHERE id = ?',
+            (estado, res.get('processed', 0), res.get('inserted', 0), res.get('updated', 0),
+             res.get('unchanged', 0), len(res.get('errors', [])),
+             json.dumps(res.get('errors', [])[:JOB_MAX_ERRORS], ensure_ascii=False),
+             res.get('seconds'), _now(), job_id),
+        )
+
+
+def _run_job(app, job_id, path, filename, run, params):
+    """Cuerpo del hilo: ejecuta *run* y guarda el resultado en ``import_jobs``."""
+    with app.app_context():
+        db = get_db()
+        started = time.perf_counter()
+        with write_transaction(db):
+            db.execute('UPDATE import_jobs SET estado = ?, actualizado = ? WHERE id = ?',
+                       (ESTADO_EN_CURSO, _now(), job_id))
+        try:
+            with open(path, 'rb') as fh:
+                res = run(FileStorage(stream=fh, filename=filename),
+                          progress=lambda r: _save_progress(db, job_id, r), **params)
+            res['seconds'] = time.perf_counter() - started
+            with write_transaction(db):
+                if res.get('volver'):
+                    db.execute('UPDATE import_jobs SET volver = ? WHERE id = ?', (res['volver'], job_id))
+                _save_progress(db, job_id, res, ESTADO_TERMINADO)
+        except Exception as e:
+            app.logger.exception('Import job %s falló', job_id)
+            db.rollback()
+            _save_progress(db, job_id, {'errors': [f'Error interno: {e}'],
+                                        'seconds': time.perf_counter() - started}, ESTADO_ERROR)
+        finally:
+            os.remove(path)
+
+
+def get_job(db, job_id):
+    """Devuelve el job como dict (con ``errores`` decodificado) o None."""
+    row = db.execute('SELECT * FROM import_jobs WHERE id = ?', (job_id,)).fetchone()
+    if not row:
+        return None
+    job = dict(row)
+    job['errores'] = json.loads(job['errores'] or '[]')
+    if job['estado'] == ESTADO_EN_CURSO:
+        limite = (datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)).isoformat()
+        if job['actualizado'] < limite:
+            job['estado'] = ESTADO_ERROR
+            job['errores'].append('La importación se interrumpió (el proceso se reinició).')
+    job['terminado'] = job['estado'] in (ESTADO_TERMINADO, ESTADO_ERROR)
+    # Las importaciones de tablas con clave natural son upserts (ver utils.upsert_sql)
+    job['upsert'] = job['tipo'] in CLAVES_NATURALES
+    segundos = job['segundos'] or 0
+    job['filas_por_segundo'] = round(job['procesadas'] / segundos) if segundos else None
+    return job
@@ -1,10 +1,17 @@
 """Modelos, conexión a BD e inicialización de esquema."""
 
+import io
+import logging
 import os
+import random
 import sqlite3
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
 from datetime import datetime
 
-from flask import g
+from flask import g, has_request_context, request
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash
 
@@ -15,19 +22,320 @@ DB_PATH = os.path.join(BASE_DIR, 'entregas.db')
 # Conexión a BD
 # ---------------------------------------------------------------------------
 
-def get_db():
-    db = getattr(g, '_database', None)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))  # conexiones libres que guarda cada worker
+DB_POOL_WARM = 2               # conexiones abiertas al crear el pool
+DB_POOL_CHECK_SECONDS = 30     # una conexión libre más tiempo que esto se comprueba antes de darla
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))  # espera por el bloqueo de escritura
+DB_WRITE_RETRIES = int(os.environ.get('DB_WRITE_RETRIES', 3))  # reintentos de BEGIN tras agotar la espera
+DB_WRITE_BACKOFF = 0.05        # segundos del primer reintento (se dobla en cada uno)
+DB_CACHE_KIB = 16 * 1024       # caché de páginas por conexión
+DB_MMAP_BYTES = 128 * 1024 * 1024
+
+# Se aplican una vez, al abrir cada conexión del pool
+_PRAGMAS_CONEXION = (
+    'PRAGMA synchronous=NORMAL',   # seguro con WAL: solo se arriesga la última transacción ante un corte de luz
+    f'PRAGMA cache_size=-{DB_CACHE_KIB}',
+    f'PRAGMA mmap_size={DB_MMAP_BYTES}',
+    'PRAGMA temp_store=MEMORY',
+    f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}',
+)
+
+
+class PooledConnection(sqlite3.Connection):
+    """Conexión del pool: ``close()`` la devuelve al pool en vez de cerrarla.
+
+    Así el código que ya cierra la conexión al acabar (respuestas en
+    streaming, :class:`BlobReader`, jobs) la recicla sin cambios.
+    """
+
+    _pool = None
+    _liberada = 0.0
+
+    def close(self):
+        pool = self._pool
+        if pool is not None:
+            pool.release(self)
+        else:
+            super().close()
+
+    def _cerrar(self):
+        self._pool = None
+        super().close()
+
+
+class ConnectionPool:
+    """Pool de conexiones SQLite de un proceso (un worker de gunicorn).
+
+    Las conexiones se prestan de una en una (``check_same_thread=False`` solo
+    para poder devolverlas desde otro hilo, p. ej. al acabar un streaming) y
+    no hay límite de préstamos: con SQLite abrir una conexión extra es barato
+    y bloquear esperando una libre podría atascar las respuestas en
+    streaming.  *size* limita las que se guardan libres para reutilizar.
+    El cerrojo es ``threading.Lock``, que con gevent parcheado es cooperativo.
+    """
+
+    def __init__(self, path, size=DB_POOL_SIZE, warm=DB_POOL_WARM, readonly=False):
+        self.path = path
+        self.size = size
+        self.readonly = readonly
+        self.pid = os.getpid()
+        self._libres = []
+        self._lock = threading.Lock()
+        self._stats = {'creadas': 0, 'reutilizadas': 0, 'descartadas': 0,
+                       'fallos_chequeo': 0, 'prestadas': 0, 'max_prestadas': 0}
+        for _ in range(min(warm, size)):
+            conn = self._connect()
+            conn._liberada = time.monotonic()
+            self._libres.append(conn)
+
+    def _connect(self):
+        kwargs = {'timeout': DB_BUSY_TIMEOUT_MS / 1000, 'check_same_thread': False,
+                  'factory': PooledConnection}
+        if self.readonly:
+            conn = sqlite3.connect(f'file:{urllib.parse.quote(self.path)}?mode=ro', uri=True, **kwargs)
+        else:
+            conn = sqlite3.connect(self.path, **kwargs)
+        conn.row_factory = sqlite3.Row
+        for pragma in _PRAGMAS_CONEXION:
+            conn.execute(pragma)
+        if self.readonly:
+            conn.execute('PRAGMA query_only=1')  # tampoco tablas temporales
+        conn._pool = self
+        with self._lock:
+            self._stats['creadas'] += 1
+        return conn
+
+    @staticmethod
+    def _sana(conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        """Presta una conexión: la libre usada más recientemente o una nueva."""
+        while True:
+            with self._lock:
+                conn = self._libres.pop() if self._libres else None
+            if conn is None:
+                conn = self._connect()
+                break
+            if time.monotonic() - conn._liberada < DB_POOL_CHECK_SECONDS or self._sana(conn):
+                with self._lock:
+                    self._stats['reutilizadas'] += 1
+                break
+            with self._lock:
+                self._stats['fallos_chequeo'] += 1
+            conn._cerrar()
+        with self._lock:
+            self._stats['prestadas'] += 1
+            self._stats['max_prestadas'] = max(self._stats['max_prestadas'], self._stats['prestadas'])
+        return conn
+
+    def release(self, conn):
+        """Devuelve *conn*; se cierra si queda rota o el pool ya tiene bastantes libres."""
+        with self._lock:
+            self._stats['prestadas'] -= 1
+        try:
+            if conn.in_transaction:
+                conn.rollback()  # petición que falló a mitad de una escritura
+            reutilizable = os.getpid() == self.pid
+        except sqlite3.Error:
+            reutilizable = False
+        if reutilizable:
+            conn._liberada = time.monotonic()
+            with self._lock:
+                if len(self._libres) < self.size:
+                    self._libres.append(conn)
+                    return
+        with self._lock:
+            self._stats['descartadas'] += 1
+        conn._cerrar()
+
+    def close_all(self):
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for conn in libres:
+            conn._cerrar()
+
+    def stats(self):
+        """Métricas del pool (para ``/administracion/db_pool``)."""
+        with self._lock:
+            return dict(self._stats, libres=len(self._libres), tamano=self.size,
+                        pid=self.pid, ruta=self.path, solo_lectura=self.readonly)
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def get_pool(readonly=False):
+    """Pool de este proceso (de escritura o de solo lectura).
+
+    Se crea de nuevo tras un fork o si cambia ``DB_PATH``.
+    """
+    with _pool_lock:
+        pool = _pools.get(readonly)
+        if pool is None or pool.pid != os.getpid() or pool.path != DB_PATH:
+            if pool is not None and pool.pid == os.getpid():
+                pool.close_all()
+            # Tras un fork las conexiones heredadas no se tocan: son del padre
+            pool = _pools[readonly] = ConnectionPool(DB_PATH, readonly=readonly)
+        return pool
+
+
+# Conexión de la petición en ``g`` según su tipo
+_G_CONEXION = {False: '_database', True: '_database_ro'}
+
+
+def _lectura():
+    """True si la petición en curso es de solo lectura (GET/HEAD)."""
+    return has_request_context() and request.method in ('GET', 'HEAD')
+
+
+def get_db(readonly=None):
+    """Conexión de la petición, del pool que corresponda.
+
+    Las peticiones GET/HEAD (vistas y exportaciones) usan conexiones de solo
+    lectura (``mode=ro`` + ``query_only``), que nunca compiten por el bloqueo
+    de escritura; el resto, y el código fuera de una petición (jobs), la de
+    escritura.  Una vista GET que tenga que escribir pide ``readonly=False``
+    (ver :func:`get_write_db`).
+    """
+    if readonly is None:
+        readonly = _lectura()
+    key = _G_CONEXION[readonly]
+    db = g.get(key)
     if db is None:
-        db = g._database = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
-        db.execute('PRAGMA journal_mode=WAL')  # Mejor rendimiento concurrente
+        db = get_pool(readonly).acquire()
+        setattr(g, key, db)
     return db
 
 
+def get_write_db():
+    """Conexión de escritura de la petición, aunque sea un GET."""
+    return get_db(readonly=False)
+
+
 def close_db(exception=None):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    for key in _G_CONEXION.values():
+        db = g.pop(key, None)
+        if db is not None:
+            db.close()
+
+
+def detach_db(readonly=None):
+    """Saca la conexión de la petición de ``g`` para que el teardown no la devuelva.
+
+    Lo usan las respuestas en streaming que siguen leyendo del cursor después
+    de que la vista retorne; quien la recibe debe cerrarla (``close()`` la
+    devuelve al pool).  *readonly* como en :func:`get_db`.
+    """
+    if readonly is None:
+        readonly = _lectura()
+    return g.pop(_G_CONEXION[readonly], None)
+
+
+# ---------------------------------------------------------------------------
+# Escrituras serializadas
+# ---------------------------------------------------------------------------
+
+# Cola de escritores del proceso: SQLite admite un solo escritor, así que los
+# hilos de un worker esperan aquí en vez de pelearse por el bloqueo del
+# fichero; entre workers decide busy_timeout (+ reintentos en el BEGIN).
+_write_lock = threading.RLock()
+_write_local = threading.local()
+_write_stats = {'escrituras': 0, 'fallidas': 0, 'reintentos': 0, 'bloqueadas': 0,
+                'espera_cola_ms': 0.0, 'max_espera_cola_ms': 0.0,
+                'espera_bloqueo_ms': 0.0, 'max_espera_bloqueo_ms': 0.0,
+                'duracion_ms': 0.0, 'max_duracion_ms': 0.0}
+_write_stats_lock = threading.Lock()
+
+
+def _begin_immediate(db):
+    """``BEGIN IMMEDIATE`` con reintentos y espera exponencial si la BD sigue bloqueada."""
+    for intento in range(DB_WRITE_RETRIES + 1):
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            return intento
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+            if intento == DB_WRITE_RETRIES:
+                with _write_stats_lock:
+                    _write_stats['bloqueadas'] += 1
+                raise
+            time.sleep(DB_WRITE_BACKOFF * (2 ** intento) * (1 + random.random()))
+
+
+def _anotar(clave, ms):
+    _write_stats[clave] += ms
+    max_clave = f'max_{clave}'
+    _write_stats[max_clave] = max(_write_stats[max_clave], ms)
+
+
+@contextmanager
+def write_transaction(db=None):
+    """Transacción de escritura serializada: ``with write_transaction() as db: ...``.
+
+    Toma el turno de la cola de escritores del proceso, abre la transacción
+    con ``BEGIN IMMEDIATE`` (el bloqueo se pide al empezar, no a mitad) y
+    hace commit al salir, o rollback si hay una excepción.  Anidada en otra
+    del mismo hilo se une a la exterior.  Si la conexión ya tiene una
+    transacción implícita abierta (una escritura fuera de este camino)
+    lanza ``RuntimeError`` en vez de confirmarla.  Deja métricas en
+    :func:`write_stats`.
+    """
+    db = db if db is not None else get_write_db()
+    if getattr(_write_local, 'depth', 0):
+        _write_local.depth += 1
+        try:
+            yield db
+        finally:
+            _write_local.depth -= 1
+        return
+    t0 = time.perf_counter()
+    with _write_lock:
+        t1 = time.perf_counter()
+        _write_local.depth = 1
+        ok = False
+        try:
+            if db.in_transaction:
+                # Una escritura hecha fuera de write_transaction: no se confirma
+                # a ciegas trabajo ajeno, se avisa del error
+                raise RuntimeError('write_transaction: la conexión ya tiene una transacción abierta')
+            reintentos = _begin_immediate(db)
+            t2 = time.perf_counter()
+            try:
+                yield db
+                db.commit()
+                ok = True
+            except BaseException:
+                db.rollback()
+                raise
+        finally:
+            _write_local.depth = 0
+            t3 = time.perf_counter()
+            with _write_stats_lock:
+                _anotar('espera_cola_ms', (t1 - t0) * 1000)
+                if ok:
+                    _write_stats['escrituras'] += 1
+                    _write_stats['reintentos'] += reintentos
+                    _anotar('espera_bloqueo_ms', (t2 - t1) * 1000)
+                    _anotar('duracion_ms', (t3 - t2) * 1000)
+                else:
+                    _write_stats['fallidas'] += 1
+
+
+def write_stats():
+    """Métricas de escritura de este proceso (tiempos en ms)."""
+    with _write_stats_lock:
+        stats = dict(_write_stats)
+    n = stats['escrituras']
+    stats['media_duracion_ms'] = stats['duracion_ms'] / n if n else None
+    stats['media_espera_bloqueo_ms'] = stats['espera_bloqueo_ms'] / n if n else None
+    return stats
 
 # ---------------------------------------------------------------------------
 # Modelo de usuario
@@ -53,12 +361,458 @@ class User(UserMixin):
     def tiene_permiso(self, permiso):
         return permiso in ROLES_PERMISOS.get(self.rol, [])
 
+# ---------------------------------------------------------------------------
+# Tipos de operación de móviles (entregas.tipo_norm)
+# ---------------------------------------------------------------------------
+
+TIPO_OTRO = 0
+TIPO_ENTREGA = 1
+TIPO_RECEPCION = 2
+
+
+def normalize_tipo(tipo):
+    """Convierte las grafías de ``entregas.tipo`` ('Entregas', 'recepción',
+    'RECEPCIONES', ...) en su valor canónico para ``tipo_norm``."""
+    t = (tipo or '').strip().lower()
+    if t.startswith('entrega'):
+        return TIPO_ENTREGA
+    if t.startswith('recepci'):
+        return TIPO_RECEPCION
+    return TIPO_OTRO
+
 # ---------------------------------------------------------------------------
 # Inicialización de esquema
 # ---------------------------------------------------------------------------
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
+# Tablas cuyas escrituras incrementan su contador en ``versiones_tabla``
+TABLAS_VERSIONADAS = ('entregas', 'computers', 'incidencias',
+                      'usuarios_gtd_sgpmr', 'inventario_telefonos', 'datos_usuario')
+
+
+def get_table_version(db, tabla):
+    """Devuelve el contador de escrituras de *tabla* (0 si no está versionada)."""
+    row = db.execute('SELECT version FROM versiones_tabla WHERE tabla = ?', (tabla,)).fetchone()
+    return row[0] if row else 0
+
+
+# Índices FTS5 (tokenizer trigram) para búsqueda por subcadena: tabla → columnas
+FTS_TABLAS = {
+    'entregas': ('imei', 'usuario'),
+    'incidencias': ('imei', 'usuario'),
+    'computers': ('hostname', 'numero_serie'),
+    'usuarios_gtd_sgpmr': ('usuario_sgpmr', 'nombre_apellidos'),
+    'inventario_telefonos': ('imei',),
+    'datos_usuario': ('dni', 'apellidos_nombre', 'notas'),
+}
+FTS_ENABLED = False  # lo decide init_db en cada arranque (ver _detectar_fts)
+
+
+def _fts_soportado(conn):
+    """True si este SQLite tiene fts5 con el tokenizer trigram (>= 3.34)."""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp._fts_sonda USING fts5(x, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        return False
+    conn.execute('DROP TABLE temp._fts_sonda')
+    return True
+
+
+def _quitar_fts(conn):
+    """Borra los triggers y las tablas ``<tabla>_fts`` que hayan quedado de un
+    intento anterior: sin fts5 los triggers harían fallar cada escritura."""
+    for tabla in FTS_TABLAS:
+        fts = f'{tabla}_fts'
+        for sufijo in ('ai', 'ad', 'au'):
+            conn.execute(f'DROP TRIGGER IF EXISTS trg_{fts}_{sufijo}')
+        try:
+            conn.execute(f'DROP TABLE IF EXISTS {fts}')
+        except sqlite3.OperationalError:
+            pass  # sin el módulo no se puede borrar la tabla virtual; sin triggers ya no estorba
+
+
+def _init_fts(conn):
+    """Crea las tablas ``<tabla>_fts``, sus triggers de sincronización y las rellena.
+
+    Sin soporte (ver :func:`_fts_soportado`) no crea nada y las búsquedas
+    siguen usando LIKE.  Cualquier otro fallo se propaga para que la
+    transacción del llamador lo deshaga entero (fts5 no admite deshacerlo con
+    un SAVEPOINT).  Es idempotente: :func:`init_db` lo repite en cada arranque
+    mientras FTS no esté completo.
+    """
+    if not _fts_soportado(conn):
+        _quitar_fts(conn)
+        return
+    for tabla, cols in FTS_TABLAS.items():
+        fts = f'{tabla}_fts'
+        col_list = ', '.join(cols)
+        new_vals = ', '.join(f'new.{c}' for c in cols)
+        old_vals = ', '.join(f'old.{c}' for c in cols)
+        conn.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                {col_list}, content='{tabla}', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+        # Si falta el trigger (índice nuevo o tabla base recreada) hay que reconstruir
+        needs_rebuild = not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+            (f'trg_{fts}_ai',),
+        ).fetchone()
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_ai AFTER INSERT ON {tabla} BEGIN
+                INSERT INTO {fts} (rowid, {col_list}) VALUES (new.id, {new_vals});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_ad AFTER DELETE ON {tabla} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_au AFTER UPDATE OF {col_list} ON {tabla} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals});
+                INSERT INTO {fts} (rowid, {col_list}) VALUES (new.id, {new_vals});
+            END
+        ''')
+        if needs_rebuild:
+            conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+
+def _detectar_fts(conn):
+    """Activa :data:`FTS_ENABLED` si existen todas las tablas ``<tabla>_fts``
+    con sus tres triggers y este SQLite puede abrirlas (fts5 con trigram).
+
+    Se llama en cada arranque, también cuando la BD ya está migrada: el
+    módulo se importa de nuevo en cada worker y el flag no vive en la BD.
+    """
+    global FTS_ENABLED
+    try:
+        for tabla in FTS_TABLAS:
+            conn.execute(f'SELECT rowid FROM {tabla}_fts LIMIT 0').fetchall()
+            triggers = conn.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (?, ?, ?)",
+                tuple(f'trg_{tabla}_fts_{sufijo}' for sufijo in ('ai', 'ad', 'au')),
+            ).fetchone()[0]
+            if triggers != 3:
+                FTS_ENABLED = False
+                return
+        FTS_ENABLED = True
+    except sqlite3.OperationalError:
+        FTS_ENABLED = False
+
+
+# Contadores del dashboard: columna → (tabla, condición SQL sobre la fila {r})
+STATS_COUNTERS = {
+    'entregas_moviles':      ('entregas',    '{r}.tipo_norm IS %d' % TIPO_ENTREGA),
+    'entregas_computers':    ('computers',   "{r}.tipo IS 'Entrega'"),
+    'incidencias_moviles':   ('incidencias', '1'),
+    'incidencias_computers': ('computers',   "{r}.tipo IS 'Incidencia'"),
+}
+# Columnas cuya modificación puede cambiar la condición de cada tabla
+_STATS_UPDATE_COLS = {'entregas': 'tipo_norm', 'computers': 'tipo'}
+
+
+def rebuild_stats_counters(conn):
+    """Recalcula ``stats_counters`` desde cero (corrige cualquier desviación)."""
+    sets = ', '.join(
+        f'{col} = (SELECT COUNT(*) FROM {tabla} WHERE {cond.format(r=tabla)})'
+        for col, (tabla, cond) in STATS_COUNTERS.items()
+    )
+    conn.execute('INSERT OR IGNORE INTO stats_counters (id) VALUES (1)')
+    conn.execute(f'UPDATE stats_counters SET {sets} WHERE id = 1')
+
+
+def get_stats_counters(db):
+    """Lectura por clave primaria de los contadores del dashboard."""
+    row = db.execute('SELECT * FROM stats_counters WHERE id = 1').fetchone()
+    return {col: (row[col] if row else 0) for col in STATS_COUNTERS}
+
+
+def _init_stats_counters(conn):
+    """Crea ``stats_counters`` y los triggers que la mantienen de forma incremental."""
+    cols = ', '.join(f'{col} INTEGER NOT NULL DEFAULT 0' for col in STATS_COUNTERS)
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            {cols}
+        )
+    ''')
+
+    needs_rebuild = False
+    for tabla in ('entregas', 'computers', 'incidencias'):
+        counters = [(col, cond) for col, (t, cond) in STATS_COUNTERS.items() if t == tabla]
+        ins = ', '.join(f'{col} = {col} + ({cond.format(r="new")})' for col, cond in counters)
+        dele = ', '.join(f'{col} = {col} - ({cond.format(r="old")})' for col, cond in counters)
+        triggers = {
+            f'trg_{tabla}_stats_ai': f'AFTER INSERT ON {tabla} BEGIN UPDATE stats_counters SET {ins} WHERE id = 1; END',
+            f'trg_{tabla}_stats_ad': f'AFTER DELETE ON {tabla} BEGIN UPDATE stats_counters SET {dele} WHERE id = 1; END',
+        }
+        if tabla in _STATS_UPDATE_COLS:
+            upd = ', '.join(
+                f'{col} = {col} + ({cond.format(r="new")}) - ({cond.format(r="old")})'
+                for col, cond in counters
+            )
+            col_upd = _STATS_UPDATE_COLS[tabla]
+            triggers[f'trg_{tabla}_stats_au'] = (
+                f'AFTER UPDATE OF {col_upd} ON {tabla} WHEN old.{col_upd} IS NOT new.{col_upd} '
+                f'BEGIN UPDATE stats_counters SET {upd} WHERE id = 1; END'
+            )
+        for name, body in triggers.items():
+            # Trigger ausente (tabla nueva o tabla base recreada) → recalcular
+            if not conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)
+            ).fetchone():
+                needs_rebuild = True
+                conn.execute(f'CREATE TRIGGER {name} {body}')
+
+    if needs_rebuild or not conn.execute('SELECT 1 FROM stats_counters WHERE id = 1').fetchone():
+        rebuild_stats_counters(conn)
+
+
+# ---------------------------------------------------------------------------
+# Estado actual de cada dispositivo móvil (dispositivo_estado)
+# ---------------------------------------------------------------------------
+
+def _sql_recalcular_estado(imei_expr):
+    """SQL que recalcula la fila de dispositivo_estado de un IMEI desde el histórico."""
+    return f'''
+        DELETE FROM dispositivo_estado WHERE imei = {imei_expr};
+        INSERT INTO dispositivo_estado (imei, usuario, movimiento_id, estado, desde)
+            SELECT imei, usuario, id, tipo_norm, timestamp FROM entregas
+            WHERE imei = {imei_expr} AND tipo_norm IN ({TIPO_ENTREGA}, {TIPO_RECEPCION})
+            ORDER BY timestamp DESC, id DESC LIMIT 1;
+    '''
+
+
+def rebuild_dispositivo_estado(conn):
+    """Reconstruye dispositivo_estado con el último movimiento de cada IMEI."""
+    conn.execute('DELETE FROM dispositivo_estado')
+    conn.execute(f'''
+        INSERT INTO dispositivo_estado (imei, usuario, movimiento_id, estado, desde)
+        SELECT imei, usuario, id, tipo_norm, timestamp FROM (
+            SELECT imei, usuario, id, tipo_norm, timestamp,
+                   ROW_NUMBER() OVER (PARTITION BY imei ORDER BY timestamp DESC, id DESC) AS rn
+            FROM entregas
+            WHERE imei IS NOT NULL AND imei <> '' AND tipo_norm IN ({TIPO_ENTREGA}, {TIPO_RECEPCION})
+        ) WHERE rn = 1
+    ''')
+
+
+def dispositivo_disponible(db, imei):
+    """True si el IMEI no figura como entregado (sin recepción posterior)."""
+    row = db.execute('SELECT estado FROM dispositivo_estado WHERE imei = ?', (imei,)).fetchone()
+    return row is None or row['estado'] != TIPO_ENTREGA
+
+
+def _init_dispositivo_estado(conn):
+    """Crea dispositivo_estado y los triggers que la sincronizan con entregas."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS dispositivo_estado (
+            imei TEXT PRIMARY KEY,
+            usuario TEXT,
+            movimiento_id INTEGER,
+            estado INTEGER NOT NULL,
+            desde TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_dispositivo_estado_estado '
+                 'ON dispositivo_estado(estado, desde DESC, movimiento_id DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_entregas_imei_ts ON entregas(imei, timestamp DESC, id DESC)')
+
+    triggers = {
+        # Nuevo movimiento: sustituye al actual si es más reciente
+        'trg_entregas_estado_ai': f'''
+            AFTER INSERT ON entregas
+            WHEN new.imei IS NOT NULL AND new.imei <> '' AND new.tipo_norm IN ({TIPO_ENTREGA}, {TIPO_RECEPCION})
+            BEGIN
+                INSERT INTO dispositivo_estado (imei, usuario, movimiento_id, estado, desde)
+                VALUES (new.imei, new.usuario, new.id, new.tipo_norm, new.timestamp)
+                ON CONFLICT(imei) DO UPDATE SET
+                    usuario = excluded.usuario, movimiento_id = excluded.movimiento_id,
+                    estado = excluded.estado, desde = excluded.desde
+                WHERE (excluded.desde, excluded.movimiento_id)
+                      >= (dispositivo_estado.desde, dispositivo_estado.movimiento_id);
+            END''',
+        # Se borra el movimiento vigente: recalcular desde el histórico restante
+        'trg_entregas_estado_ad': f'''
+            AFTER DELETE ON entregas
+            WHEN EXISTS (SELECT 1 FROM dispositivo_estado WHERE imei = old.imei AND movimiento_id = old.id)
+            BEGIN {_sql_recalcular_estado('old.imei')} END''',
+        # Edición de un movimiento: recalcular el IMEI anterior y el nuevo
+        'trg_entregas_estado_au': f'''
+            AFTER UPDATE OF imei, usuario, tipo_norm, timestamp ON entregas
+            BEGIN {_sql_recalcular_estado('old.imei')} {_sql_recalcular_estado('new.imei')} END''',
+    }
+    needs_rebuild = False
+    for name, body in triggers.items():
+        if not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)
+        ).fetchone():
+            needs_rebuild = True
+            conn.execute(f'CREATE TRIGGER {name} {body}')
+    if needs_rebuild:
+        rebuild_dispositivo_estado(conn)
+
+
+# ---------------------------------------------------------------------------
+# Adjuntos de incidencias
+# ---------------------------------------------------------------------------
+
+class BlobReader(io.RawIOBase):
+    """Lectura incremental (``blobopen``) de un BLOB con conexión propia.
+
+    La conexión de la petición vuelve al pool en el teardown, antes de que el
+    servidor termine de enviar la respuesta; por eso el lector toma la suya
+    del pool y la devuelve al cerrarse él mismo.
+    """
+
+    def __init__(self, tabla, columna, rowid):
+        super().__init__()
+        self._conn = get_pool(readonly=True).acquire()
+        try:
+            self._blob = self._conn.blobopen(tabla, columna, rowid, readonly=True)
+        except Exception:
+            self._conn.close()
+            raise
+        self.length = len(self._blob)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._blob.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._blob.seek(offset, whence)
+        return self._blob.tell()
+
+    def tell(self):
+        return self._blob.tell()
+
+    def close(self):
+        if not self.closed:
+            self._blob.close()
+            self._conn.close()
+        super().close()
+
+
+def open_blob(tabla, columna, rowid):
+    """Abre un BLOB para lectura por bloques. Devuelve (fichero, tamaño).
+
+    Sin ``blobopen`` (Python < 3.11) se lee completo en un BytesIO.
+    """
+    if hasattr(sqlite3.Connection, 'blobopen'):
+        reader = BlobReader(tabla, columna, rowid)
+        return reader, reader.length
+    conn = get_pool(readonly=True).acquire()
+    try:
+        data = conn.execute(f'SELECT {columna} FROM {tabla} WHERE id = ?', (rowid,)).fetchone()[0]
+    finally:
+        conn.close()
+    return io.BytesIO(data), len(data)
+
+
+def _migrar_adjuntos(conn):
+    """Mueve los adjuntos guardados en ``incidencias.archivo_contenido`` al
+    almacén en disco (ver :func:`utils.store_attachment`) y vacía el BLOB.
+
+    Se procesa fila a fila para no cargar más de un adjunto en memoria.  No
+    confirma: si la migración se corta, los ficheros ya copiados se reutilizan
+    al repetirla (el almacén se direcciona por su sha256).
+    """
+    pendientes = [r[0] for r in conn.execute(
+        'SELECT id FROM incidencias WHERE archivo_contenido IS NOT NULL AND archivo_sha256 IS NULL'
+    ).fetchall()]
+    if not pendientes:
+        return
+
+    from utils import store_attachment
+    for inc_id in pendientes:
+        if hasattr(conn, 'blobopen'):  # Python 3.11+: lectura incremental del BLOB
+            with conn.blobopen('incidencias', 'archivo_contenido', inc_id, readonly=True) as blob:
+                sha256, size = store_attachment(blob, max_bytes=None)
+        else:
+            data = conn.execute('SELECT archivo_contenido FROM incidencias WHERE id = ?', (inc_id,)).fetchone()[0]
+            sha256, size = store_attachment(io.BytesIO(data), max_bytes=None)
+        conn.execute(
+            'UPDATE incidencias SET archivo_sha256 = ?, archivo_tamano = ?, archivo_contenido = NULL WHERE id = ?',
+            (sha256, size, inc_id),
+        )
+
+
+# Tablas maestras → columna que identifica cada fila (usada por los upserts
+# de las importaciones).  Los valores vacíos/NULL no cuentan como clave.
+CLAVES_NATURALES = {
+    'inventario_telefonos': 'imei',
+    'datos_usuario': 'dni',
+    'usuarios_gtd_sgpmr': 'dni_nie',
+}
+
+_migracion_log = logging.getLogger(__name__)
+
+
+def normalize_clave(valor):
+    """Forma canónica de una clave natural: sin espacios alrededor y en mayúsculas.
+
+    La usan las importaciones, los formularios y la migración que crea los
+    índices únicos, así que un mismo DNI o IMEI siempre se guarda igual.
+    """
+    return valor.strip().upper() if isinstance(valor, str) else valor
+
+
+def _init_claves_naturales(conn):
+    """Crea los índices únicos ``uq_<tabla>_<columna>`` de :data:`CLAVES_NATURALES`.
+
+    Antes se normalizan las claves (:func:`normalize_clave`) y se fusionan
+    las filas que comparten clave igual que lo habría hecho un upsert: queda
+    la de menor id (con su ``fecha_creacion``) y los datos de la más
+    reciente.  Las filas originales de cada grupo se copian antes a
+    ``<tabla>_duplicados`` y la fusión queda en el log.
+    """
+    from utils import UPSERT_FIJAS
+    conn.create_function('normalizar_clave', 1, normalize_clave, deterministic=True)
+    for tabla, col in CLAVES_NATURALES.items():
+        indice = f'uq_{tabla}_{col}'
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                        (indice,)).fetchone():
+            continue
+        norm = f'normalizar_clave({col})'
+        repetidas = f"SELECT {norm} FROM {tabla} WHERE {norm} <> '' GROUP BY 1 HAVING COUNT(*) > 1"
+        copia = f'{tabla}_duplicados'
+        if conn.execute(f'SELECT 1 FROM {tabla} WHERE {norm} IN ({repetidas}) LIMIT 1').fetchone():
+            # Copia de las filas tal como estaban, antes de normalizar y fusionar
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {copia} AS SELECT * FROM {tabla} WHERE 0')
+            conn.execute(f'INSERT INTO {copia} SELECT * FROM {tabla} WHERE {norm} IN ({repetidas})')
+        conn.execute(f'UPDATE {tabla} SET {col} = {norm} WHERE {col} IS NOT {norm}')
+        grupos = conn.execute(
+            f"SELECT {col}, MIN(id), MAX(id), COUNT(*) FROM {tabla} WHERE {col} <> '' "
+            f"GROUP BY {col} HAVING COUNT(*) > 1"
+        ).fetchall()
+        if grupos:
+            cols = ', '.join(c[1] for c in conn.execute(f'PRAGMA table_info({tabla})')
+                             if c[1] not in ('id', col) + UPSERT_FIJAS)
+            for clave, primera, ultima, _ in grupos:
+                if cols:
+                    conn.execute(f'UPDATE {tabla} SET ({cols}) = (SELECT {cols} FROM {tabla} WHERE id = ?) '
+                                 f'WHERE id = ?', (ultima, primera))
+                conn.execute(f'DELETE FROM {tabla} WHERE {col} = ? AND id <> ?', (clave, primera))
+            _migracion_log.warning(
+                '%s: %d filas con %s repetido fusionadas en %d (originales en %s): %s',
+                tabla, sum(g[3] for g in grupos), col, len(grupos), copia,
+                ', '.join(str(g[0]) for g in grupos[:50]) + (' ...' if len(grupos) > 50 else ''))
+        conn.execute(f"CREATE UNIQUE INDEX {indice} ON {tabla}({col}) WHERE {col} <> ''")
+
+
+# ---------------------------------------------------------------------------
+# Migraciones de esquema
+# ---------------------------------------------------------------------------
+
+def _migrar_tablas_base(conn):
+    """Tablas principales, incluidas las columnas añadidas en versiones antiguas."""
     cursor = conn.cursor()
 
     # --- entregas ---
@@ -87,7 +841,8 @@ def init_db():
                 situm TEXT, usuario TEXT, imei TEXT,
                 telefono TEXT, notas_telefono TEXT,
                 tipo TEXT, timestamp TEXT,
-                codigo_validacion TEXT, email_usuario TEXT
+                codigo_validacion TEXT, email_usuario TEXT,
+                tipo_norm INTEGER
             )
         ''')
     else:
@@ -96,6 +851,10 @@ def init_db():
         if 'email_usuario' not in columns:
             conn.execute("ALTER TABLE entregas ADD COLUMN email_usuario TEXT")
 
+    cursor.execute("PRAGMA table_info(entregas)")
+    if 'tipo_norm' not in [c[1] for c in cursor.fetchall()]:
+        conn.execute("ALTER TABLE entregas ADD COLUMN tipo_norm INTEGER")
+
     # --- validaciones_email ---
     cursor.execute("PRAGMA table_info(validaciones_email)")
     if not cursor.fetchall():
@@ -127,15 +886,22 @@ def init_db():
 
     # --- incidencias ---
     cursor.execute("PRAGMA table_info(incidencias)")
-    if not cursor.fetchall():
+    inc_cols = [c[1] for c in cursor.fetchall()]
+    if not inc_cols:
         conn.execute('''
             CREATE TABLE incidencias (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 imei TEXT, usuario TEXT, telefono TEXT,
                 notas TEXT, archivo_nombre TEXT,
-                archivo_contenido BLOB, timestamp TEXT
+                archivo_contenido BLOB, timestamp TEXT,
+                archivo_sha256 TEXT, archivo_tamano INTEGER
             )
         ''')
+    else:
+        if 'archivo_sha256' not in inc_cols:
+            conn.execute("ALTER TABLE incidencias ADD COLUMN archivo_sha256 TEXT")
+        if 'archivo_tamano' not in inc_cols:
+            conn.execute("ALTER TABLE incidencias ADD COLUMN archivo_tamano INTEGER")
 
     # --- usuarios ---
     cursor.execute("PRAGMA table_info(usuarios)")
@@ -205,15 +971,204 @@ def init_db():
         if 'notas' not in datos_cols:
             conn.execute("ALTER TABLE datos_usuario ADD COLUMN notas TEXT")
 
-    # --- Índices para consultas frecuentes ---
+
+def _migrar_import_jobs(conn):
+    """Tabla ``import_jobs`` de las importaciones en segundo plano (ver jobs.py)."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL, archivo TEXT, usuario TEXT,
+            estado TEXT NOT NULL,
+            simulacion INTEGER NOT NULL DEFAULT 0,
+            procesadas INTEGER NOT NULL DEFAULT 0,
+            insertadas INTEGER NOT NULL DEFAULT 0,
+            actualizadas INTEGER NOT NULL DEFAULT 0,
+            sin_cambios INTEGER NOT NULL DEFAULT 0,
+            num_errores INTEGER NOT NULL DEFAULT 0,
+            errores TEXT, segundos REAL, volver TEXT,
+            creado TEXT, actualizado TEXT
+        )
+    ''')
+    job_cols = [c[1] for c in conn.execute('PRAGMA table_info(import_jobs)').fetchall()]
+    for col in ('actualizadas', 'sin_cambios', 'simulacion'):
+        if col not in job_cols:
+            conn.execute(f'ALTER TABLE import_jobs ADD COLUMN {col} INTEGER NOT NULL DEFAULT 0')
+
+
+def _migrar_pdf_archivo(conn):
+    """Índice ``pdf_archivo`` de los PDFs de entrega archivados (ver utils.archive_pdf)."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pdf_archivo (
+            entrega_id INTEGER PRIMARY KEY,
+            ruta TEXT NOT NULL,
+            tamano INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            creado TEXT NOT NULL
+        )
+    ''')
+    # Los ids de entregas borradas pueden reutilizarse: que no hereden el PDF
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_pdf_archivo_entregas_ad AFTER DELETE ON entregas BEGIN
+            DELETE FROM pdf_archivo WHERE entrega_id = old.id;
+        END
+    ''')
+
+
+def _migrar_indices(conn):
+    """Índices de las consultas frecuentes y ``tipo_norm`` de las entregas."""
     conn.execute('CREATE INDEX IF NOT EXISTS idx_entregas_imei ON entregas(imei)')
     conn.execute('CREATE INDEX IF NOT EXISTS idx_entregas_tipo ON entregas(tipo)')
     conn.execute('CREATE INDEX IF NOT EXISTS idx_entregas_timestamp ON entregas(timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_entregas_tipo_norm_ts ON entregas(tipo_norm, timestamp DESC, id DESC)')
     conn.execute('CREATE INDEX IF NOT EXISTS idx_computers_tipo ON computers(tipo)')
     conn.execute('CREATE INDEX IF NOT EXISTS idx_computers_proyecto ON computers(proyecto)')
     conn.execute('CREATE INDEX IF NOT EXISTS idx_computers_timestamp ON computers(timestamp)')
     conn.execute('CREATE INDEX IF NOT EXISTS idx_incidencias_imei ON incidencias(imei)')
     conn.execute('CREATE INDEX IF NOT EXISTS idx_incidencias_timestamp ON incidencias(timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_incidencias_archivo_sha256 ON incidencias(archivo_sha256)')
+    for tabla in ('usuarios_gtd_sgpmr', 'inventario_telefonos', 'datos_usuario'):
+        # Orden por defecto de los listados paginados (ver routes/extras.py)
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{tabla}_fecha ON {tabla}(fecha_creacion DESC, id DESC)')
+
+    # Rellenar tipo_norm en filas antiguas; las que inserten herramientas
+    # externas sin él las completa el trigger (antes se hacía en cada arranque)
+    conn.execute(f'''
+        UPDATE entregas SET tipo_norm = {_SQL_TIPO_NORM.format(t='tipo')}
+        WHERE tipo_norm IS NULL
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_entregas_tipo_norm
+        AFTER INSERT ON entregas WHEN new.tipo_norm IS NULL
+        BEGIN
+            UPDATE entregas SET tipo_norm = {_SQL_TIPO_NORM.format(t='new.tipo')} WHERE id = new.id;
+        END
+    ''')
+
+
+def _migrar_versiones_tabla(conn):
+    """Contador ``versiones_tabla`` de escrituras para invalidar cachés."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS versiones_tabla (
+            tabla TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for tabla in TABLAS_VERSIONADAS:
+        conn.execute('INSERT OR IGNORE INTO versiones_tabla (tabla, version) VALUES (?, 0)', (tabla,))
+        for evento in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{tabla}_version_{evento.lower()}
+                AFTER {evento} ON {tabla}
+                BEGIN
+                    UPDATE versiones_tabla SET version = version + 1 WHERE tabla = '{tabla}';
+                END
+            ''')
+
+
+_SQL_TIPO_NORM = f'''CASE
+            WHEN LOWER(TRIM({{t}})) LIKE 'entrega%' THEN {TIPO_ENTREGA}
+            WHEN LOWER(TRIM({{t}})) LIKE 'recepci%' THEN {TIPO_RECEPCION}
+            ELSE {TIPO_OTRO}
+        END'''
+
+# Pasos de migración en orden; la versión del esquema (``PRAGMA user_version``)
+# es el número de pasos aplicados.  Los cambios de esquema se añaden como un
+# paso nuevo al final: nunca se reordenan ni se quitan pasos.  Cada paso se
+# aplica en una sola transacción junto con su número de versión, así que no
+# debe confirmar por su cuenta.  Además debe ser idempotente: las BD
+# anteriores a este sistema empiezan en la versión 0 y los repasan todos.
+MIGRACIONES = [
+    _migrar_tablas_base,        # 1
+    _migrar_import_jobs,        # 2
+    _migrar_pdf_archivo,        # 3
+    _init_claves_naturales,     # 4
+    _migrar_indices,            # 5
+    _migrar_versiones_tabla,    # 6
+    _migrar_adjuntos,           # 7
+    _init_fts,                  # 8
+    _init_stats_counters,       # 9
+    _init_dispositivo_estado,   # 10
+]
+SCHEMA_VERSION = len(MIGRACIONES)
+
+
+@contextmanager
+def _file_lock(path):
+    """Cerrojo exclusivo entre procesos sobre el fichero *path*."""
+    with open(path, 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK se rinde tras unos 10 s: se sigue esperando
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def init_db():
+    """Lleva la BD a la última versión del esquema (ver :data:`MIGRACIONES`).
+
+    Con la BD al día el arranque solo lee ``PRAGMA user_version`` y
+    comprueba si hay FTS; si no está completo se reintenta :func:`_init_fts`
+    (ver allí).  Si faltan pasos se aplican bajo un cerrojo de
+    fichero: cuando arrancan varios workers a la vez migra uno y los demás
+    esperan y encuentran la BD ya migrada.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        if _schema_version(conn) >= SCHEMA_VERSION:
+            _detectar_fts(conn)
+            if FTS_ENABLED:
+                return
+    finally:
+        conn.close()
 
-    conn.commit()
-    conn.close()
+    with _file_lock(DB_PATH + '.migrate.lock'):
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')  # queda guardado en el fichero: las conexiones del pool ya lo usan
+            version = _schema_version(conn)
+            for numero, paso in enumerate(MIGRACIONES[version:], version + 1):
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    paso(conn)
+                    conn.execute(f'PRAGMA user_version = {numero}')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+                conn.execute('COMMIT')
+            _detectar_fts(conn)
+            if not FTS_ENABLED:
+                # El paso de FTS ya consta como hecho pero no quedó completo (SQLite
+                # sin soporte entonces, o un fallo a medias): se repite, es idempotente
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    _init_fts(conn)
+                    conn.execute('COMMIT')
+                except sqlite3.OperationalError as e:
+                    conn.execute('ROLLBACK')
+                    _migracion_log.warning('No se pudieron crear los índices FTS: %s', e)
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+                _detectar_fts(conn)
+        finally:
+            conn.close()
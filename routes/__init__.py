@@ -8,6 +8,8 @@ from .computers import computers_bp
 from .history import history_bp
 from .incidents import incidents_bp
 from .extras import extras_bp
+from .jobs import jobs_bp
+from .api import api_bp
 
 
 def register_blueprints(app):
@@ -19,3 +21,5 @@ def register_blueprints(app):
     app.register_blueprint(history_bp)
     app.register_blueprint(incidents_bp)
     app.register_blueprint(extras_bp)
+    app.register_blueprint(jobs_bp)
+    app.register_blueprint(api_bp)
@@ -1,12 +1,12 @@
 """Blueprint de administración de usuarios."""
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_required, current_user
 from werkzeug.security import generate_password_hash
 from datetime import datetime
 import sqlite3
 
-from models import get_db, ROLES_PERMISOS
+from models import get_db, get_pool, write_stats, write_transaction, ROLES_PERMISOS
 from routes._decorators import require_permission
 
 admin_bp = Blueprint('admin', __name__)
@@ -22,6 +22,14 @@ def administracion():
     return render_template('administracion.html', usuarios=usuarios, roles=ROLES_PERMISOS.keys())
 
 
+@admin_bp.route('/administracion/db_pool')
+@require_permission('administracion')
+def db_pool_stats():
+    """Métricas de conexiones y escrituras de este worker (cada worker tiene las suyas)."""
+    return jsonify(success=True, escritura=get_pool().stats(), lectura=get_pool(readonly=True).stats(),
+                   escrituras=write_stats())
+
+
 @admin_bp.route('/usuarios/crear', methods=['GET', 'POST'])
 @require_permission('crear_usuario')
 def crear_usuario():
@@ -38,13 +46,12 @@ def crear_usuario():
             flash('Rol inválido', 'error')
             return redirect(url_for('admin.crear_usuario'))
 
-        db = get_db()
         try:
-            db.execute(
-                'INSERT INTO usuarios (username, password, rol, activo, fecha_creacion) VALUES (?,?,?,?,?)',
-                (username, generate_password_hash(password), rol, 1, datetime.utcnow().isoformat()),
-            )
-            db.commit()
+            with write_transaction() as db:
+                db.execute(
+                    'INSERT INTO usuarios (username, password, rol, activo, fecha_creacion) VALUES (?,?,?,?,?)',
+                    (username, generate_password_hash(password), rol, 1, datetime.utcnow().isoformat()),
+                )
             flash(f'Usuario {username} creado correctamente', 'success')
             return redirect(url_for('admin.administracion'))
         except sqlite3.IntegrityError:
@@ -70,9 +77,9 @@ def editar_usuario(usuario_id):
             flash('Rol inválido', 'error')
             return redirect(url_for('admin.editar_usuario', usuario_id=usuario_id))
 
-        db.execute('UPDATE usuarios SET rol = ?, activo = ? WHERE id = ?',
-                   (rol, 1 if activo == '1' else 0, usuario_id))
-        db.commit()
+        with write_transaction() as db:
+            db.execute('UPDATE usuarios SET rol = ?, activo = ? WHERE id = ?',
+                       (rol, 1 if activo == '1' else 0, usuario_id))
         flash('Usuario actualizado correctamente', 'success')
         return redirect(url_for('admin.administracion'))
 
@@ -99,9 +106,9 @@ def cambiar_contrasena_usuario(usuario_id):
             flash('La nueva contraseña y la confirmación no coinciden', 'error')
             return redirect(url_for('admin.cambiar_contrasena_usuario', usuario_id=usuario_id))
 
-        db.execute('UPDATE usuarios SET password = ? WHERE id = ?',
-                   (generate_password_hash(new_pw), usuario_id))
-        db.commit()
+        with write_transaction() as db:
+            db.execute('UPDATE usuarios SET password = ? WHERE id = ?',
+                       (generate_password_hash(new_pw), usuario_id))
         flash('Contraseña actualizada correctamente', 'success')
         return redirect(url_for('admin.administracion'))
 
@@ -122,7 +129,7 @@ def eliminar_usuario(usuario_id):
         flash('Usuario no encontrado', 'error')
         return redirect(url_for('admin.administracion'))
 
-    db.execute('DELETE FROM usuarios WHERE id = ?', (usuario_id,))
-    db.commit()
+    with write_transaction() as db:
+        db.execute('DELETE FROM usuarios WHERE id = ?', (usuario_id,))
     flash('Usuario eliminado correctamente', 'success')
     return redirect(url_for('admin.administracion'))
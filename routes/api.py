@@ -0,0 +1,133 @@
+"""Blueprint de API JSON (solo lectura) de los listados + vista con scroll virtual.
+
+``/api/<recurso>`` reutiliza las mismas consultas que las vistas HTML (y por
+tanto los mismos filtros de la URL) y devuelve bloques paginados por cursor
+con los campos pedidos.  ``/vista/<recurso>`` es la tabla con scroll virtual
+de ``static/app.js`` que consume esa API.
+"""
+
+from flask import Blueprint, render_template, request, jsonify, abort
+from flask_login import login_required, current_user
+
+from models import get_db, TIPO_ENTREGA, TIPO_RECEPCION
+from routes.extras import (
+    _lista_query, _FILTROS_USUARIOS_GTD, _FILTROS_INVENTARIO, _FILTROS_DATOS_USUARIO,
+)
+from routes.history import _build_entregas_query, _build_computers_query, _search_params_moviles, _KEYSET
+from routes.incidents import _build_incidencias_query
+from utils import api_list
+
+api_bp = Blueprint('api', __name__)
+
+
+def _query_entregas():
+    tipo = TIPO_RECEPCION if request.args.get('tipo', '').lower().startswith('recep') else TIPO_ENTREGA
+    return _build_entregas_query(tipo, _search_params_moviles())
+
+
+_TIPOS_COMPUTER = {'entrega': 'Entrega', 'recepcion': 'Recepción', 'recepción': 'Recepción',
+                   'incidencia': 'Incidencia'}
+
+
+def _query_computers():
+    tipo = _TIPOS_COMPUTER.get(request.args.get('tipo', '').lower(), 'Entrega')
+    return _build_computers_query(tipo)[:2]
+
+
+# Recurso → configuración:
+#   permiso: el mismo que la vista HTML equivalente
+#   query:   función que construye (query, params) desde request.args
+#   keyset:  columnas del cursor (orden descendente)
+#   campos:  [(campo, cabecera)] proyectables, en el orden de la tabla
+#   filtros: [(parámetro, etiqueta, opciones|None)] que entiende la query
+RECURSOS = {
+    'entregas': {
+        'titulo': 'Entregas y recepciones de móviles',
+        'permiso': 'ver_historico',
+        'query': _query_entregas,
+        'keyset': _KEYSET,
+        'campos': [('id', 'ID'), ('timestamp', 'Fecha'), ('tipo', 'Tipo'), ('situm', 'Situm'),
+                   ('usuario', 'Usuario'), ('imei', 'IMEI'), ('telefono', 'Teléfono'),
+                   ('notas_telefono', 'Notas')],
+        'filtros': [('tipo', 'Tipo', ['entrega', 'recepcion']), ('imei', 'IMEI', None),
+                    ('usuario', 'Usuario', None), ('fecha_inicio', 'Desde', None),
+                    ('fecha_fin', 'Hasta', None)],
+    },
+    'computers': {
+        'titulo': 'Computers',
+        'permiso': 'ver_historico',
+        'query': _query_computers,
+        'keyset': _KEYSET,
+        'campos': [('id', 'ID'), ('timestamp', 'Fecha'), ('tipo', 'Tipo'), ('proyecto', 'Proyecto'),
+                   ('hostname', 'Hostname'), ('numero_serie', 'Nº Serie'),
+                   ('apellidos_nombre', 'Persona'), ('notas', 'Notas'), ('usuario', 'Operador')],
+        'filtros': [('tipo', 'Tipo', ['entrega', 'recepcion', 'incidencia']), ('hostname', 'Hostname', None),
+                    ('sn', 'Nº Serie', None), ('proyecto', 'Proyecto', None)],
+    },
+    'incidencias': {
+        'titulo': 'Incidencias de móviles',
+        'permiso': 'ver_incidencias',
+        'query': lambda: _build_incidencias_query()[:2],
+        'keyset': ('timestamp', 'id'),
+        'campos': [('id', 'ID'), ('timestamp', 'Fecha'), ('imei', 'IMEI'), ('usuario', 'Usuario'),
+                   ('telefono', 'Teléfono'), ('notas', 'Notas'), ('archivo_nombre', 'Adjunto')],
+        'filtros': [('imei', 'IMEI', None), ('usuario', 'Usuario', None),
+                    ('fecha_inicio', 'Desde', None), ('fecha_fin', 'Hasta', None)],
+    },
+    'inventario_telefonos': {
+        'titulo': 'Inventario de teléfonos',
+        'permiso': 'registrar',
+        'query': lambda: _lista_query('inventario_telefonos', _FILTROS_INVENTARIO)[:2],
+        'keyset': ('id',),
+        'campos': [('id', 'ID'), ('imei', 'IMEI'), ('numero_serie', 'Número Serie'), ('modelo', 'Modelo'),
+                   ('telefono_asociado', 'Teléfono Asociado'), ('fecha_creacion', 'Fecha Creación')],
+        'filtros': [('imei', 'IMEI', None)],
+    },
+    'datos_usuario': {
+        'titulo': 'Datos de usuario',
+        'permiso': 'registrar',
+        'query': lambda: _lista_query('datos_usuario', _FILTROS_DATOS_USUARIO)[:2],
+        'keyset': ('id',),
+        'campos': [('id', 'ID'), ('dni', 'DNI'), ('apellidos_nombre', 'Apellidos y Nombre'),
+                   ('telefono_personal', 'Teléfono Personal'), ('email_personal', 'Email Personal'),
+                   ('email_corp', 'Email Corp'), ('notas', 'Notas'), ('fecha_creacion', 'Fecha Creación')],
+        'filtros': [('dni', 'DNI', None), ('nombre', 'Apellidos y Nombre', None), ('notas', 'Notas', None)],
+    },
+    'usuarios_gtd_sgpmr': {
+        'titulo': 'Usuarios GTD SGPMR',
+        'permiso': 'registrar',
+        'query': lambda: _lista_query('usuarios_gtd_sgpmr', _FILTROS_USUARIOS_GTD)[:2],
+        'keyset': ('id',),
+        'campos': [('id', 'ID'), ('usuario_gtd', 'Usuario GTD'), ('usuario_sgpmr', 'Usuario SGPMR'),
+                   ('nombre_apellidos', 'Nombre y Apellidos'), ('correo_electronico', 'Correo Electrónico'),
+                   ('dni_nie', 'DNI/NIE'), ('fecha_creacion', 'Fecha Creación')],
+        'filtros': [('nombre', 'Nombre y Apellidos', None), ('usuario_sgpmr', 'Usuario SGPMR', None)],
+    },
+}
+
+
+def _get_recurso(recurso):
+    """Configuración de *recurso* si existe y el usuario tiene su permiso, o None."""
+    cfg = RECURSOS.get(recurso)
+    if not cfg or not current_user.tiene_permiso(cfg['permiso']):
+        return None
+    return cfg
+
+
+@api_bp.route('/api/<recurso>')
+@login_required
+def api_lista(recurso):
+    cfg = _get_recurso(recurso)
+    if not cfg:
+        return jsonify(success=False, error='Recurso no encontrado'), 404
+    query, params = cfg['query']()
+    return api_list(get_db(), query, params, [c for c, _ in cfg['campos']], cfg['keyset'], table=recurso)
+
+
+@api_bp.route('/vista/<recurso>')
+@login_required
+def vista_lista(recurso):
+    cfg = _get_recurso(recurso)
+    if not cfg:
+        abort(404)
+    return render_template('lista_virtual.html', recurso=recurso, cfg=cfg)
@@ -4,7 +4,7 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from models import get_db, User
+from models import get_db, write_transaction, User
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -67,8 +67,8 @@ def perfil():
     db = get_db()
     if request.method == 'POST':
         notas = request.form.get('notas', '').strip()
-        db.execute('UPDATE usuarios SET notas = ? WHERE id = ?', (notas, current_user.id))
-        db.commit()
+        with write_transaction() as db:
+            db.execute('UPDATE usuarios SET notas = ? WHERE id = ?', (notas, current_user.id))
         flash('Notas actualizadas correctamente', 'success')
         return redirect(url_for('auth.perfil'))
 
@@ -110,9 +110,9 @@ def cambiar_contrasena():
             flash('La contraseña debe tener al menos 6 caracteres', 'error')
             return redirect(url_for('auth.cambiar_contrasena'))
 
-        db.execute('UPDATE usuarios SET password = ? WHERE id = ?',
-                   (generate_password_hash(new_pw), current_user.id))
-        db.commit()
+        with write_transaction() as db:
+            db.execute('UPDATE usuarios SET password = ? WHERE id = ?',
+                       (generate_password_hash(new_pw), current_user.id))
         flash('Contraseña actualizada correctamente', 'success')
         return redirect(url_for('auth.perfil'))
 
@@ -1,13 +1,16 @@
 """Blueprint de computers: CRUD genérico que elimina la duplicación de rutas."""
 
 from datetime import datetime
+from urllib.parse import urlencode
 
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required, current_user
 
-from models import get_db
+from jobs import submit_import
+from models import get_db, write_transaction
 from routes._decorators import require_permission
-from utils import parse_import_file, get_value
+from routes.jobs import import_job_response, dry_run_requested
+from utils import parse_import_file, import_rows, ImportRowError
 
 computers_bp = Blueprint('computers', __name__)
 
@@ -39,14 +42,13 @@ def _computer_crud(tipo, proyecto, template, flash_msg):
             flash('Hostname es requerido', 'error')
             return render_template(template)
 
-        db = get_db()
-        db.execute(
-            'INSERT INTO computers (hostname, numero_serie, apellidos_nombre, notas, tipo, usuario, timestamp, proyecto) '
-            'VALUES (?,?,?,?,?,?,?,?)',
-            (hostname, numero_serie, apellidos_nombre, notas, tipo,
-             current_user.username, datetime.now().isoformat(), proyecto),
-        )
-        db.commit()
+        with write_transaction() as db:
+            db.execute(
+                'INSERT INTO computers (hostname, numero_serie, apellidos_nombre, notas, tipo, usuario, timestamp, proyecto) '
+                'VALUES (?,?,?,?,?,?,?,?)',
+                (hostname, numero_serie, apellidos_nombre, notas, tipo,
+                 current_user.username, datetime.now().isoformat(), proyecto),
+            )
         flash(flash_msg, 'success')
         return redirect(url_for('main.index'))
 
@@ -93,11 +95,11 @@ def editar_computer(computer_id):
     notas = request.form.get('notas', '').strip()
     tipo = request.form.get('tipo', 'Entrega').strip()
 
-    db.execute('''
-        UPDATE computers SET proyecto=?, hostname=?, numero_serie=?, apellidos_nombre=?, notas=?, tipo=?
-        WHERE id=?
-    ''', (proyecto, hostname, numero_serie, apellidos_nombre, notas, tipo, computer_id))
-    db.commit()
+    with write_transaction() as db:
+        db.execute('''
+            UPDATE computers SET proyecto=?, hostname=?, numero_serie=?, apellidos_nombre=?, notas=?, tipo=?
+            WHERE id=?
+        ''', (proyecto, hostname, numero_serie, apellidos_nombre, notas, tipo, computer_id))
     flash('Registro actualizado correctamente', 'success')
 
     redirect_map = {
@@ -111,6 +113,55 @@ def editar_computer(computer_id):
 # Importar computers (usa parser genérico)
 # ---------------------------------------------------------------------------
 
+# Campo → cabeceras aceptadas (ver utils.compile_header_map)
+_CAMPOS_COMPUTER = {
+    'proyecto':         ['proyecto', 'PROYECTO'],
+    'hostname':         ['hostname', 'HOSTNAME', 'equipo'],
+    # accept common variations for serial number column, including "S/N"
+    'numero_serie':     ['numero_serie', 'serial', 'sn', 'SN', 's/n'],
+    'apellidos_nombre': ['apellidos_nombre', 'persona', 'usuario_equipo'],
+    'notas':            ['notas', 'observaciones'],
+    'tipo':             ['tipo', 'TIPO'],
+}
+
+
+def _run_import_computers(file, progress=None, default_proj=None, operador=None, volver_base=None,
+                          dry_run=False):
+    """Importación de computers (se ejecuta como job, ver :mod:`jobs`)."""
+    rows, errors = parse_import_file(file, _CAMPOS_COMPUTER)
+
+    # Tipos de operación válidos → capitalización normalizada
+    tipo_map = {'entrega': 'Entrega', 'recepción': 'Recepción', 'recepcion': 'Recepción', 'incidencia': 'Incidencia'}
+    timestamp = datetime.now().isoformat()
+    proyecto_importado = default_proj
+
+    def to_values(r):
+        nonlocal proyecto_importado
+        proyecto, hostname, numero_serie, apellidos_nombre, notas, tipo_raw = r
+        proyecto = proyecto or default_proj or 'Mitie'
+        if proyecto_importado is None:
+            proyecto_importado = proyecto
+        # Normalizar tipo: si no es un tipo de operación válido, usar 'Entrega'
+        tipo = tipo_map.get(tipo_raw.lower(), 'Entrega')
+
+        if not hostname:
+            raise ImportRowError('sin hostname, omitida.')
+        return (hostname, numero_serie, apellidos_nombre, notas, tipo,
+                operador, timestamp, proyecto)
+
+    res = import_rows(
+        get_db(), 'computers',
+        ('hostname', 'numero_serie', 'apellidos_nombre', 'notas', 'tipo', 'usuario', 'timestamp', 'proyecto'),
+        rows, to_values, dry_run=dry_run, progress=progress,
+        match=('hostname', 'numero_serie', 'tipo', 'proyecto'),
+    )
+    res['errors'] = errors + res['errors']
+    # Volver al histórico con el filtro de proyecto correspondiente
+    if proyecto_importado:
+        res['volver'] = f"{volver_base}?{urlencode({'proyecto': proyecto_importado})}"
+    return res
+
+
 @computers_bp.route('/history_computers/import', methods=['GET', 'POST'])
 @require_permission('registrar')
 def import_computers():
@@ -128,62 +179,9 @@ def import_computers():
     if request.method == 'GET':
         return render_template('import_computers.html', default_project=default_proj)
 
-    file = request.files.get('file')
-    rows, errors = parse_import_file(file)
-    if errors and not rows:
-        for e in errors:
-            flash(e, 'error')
-        # preserve the project parameter when redirecting back to the form
-        if default_proj:
-            return redirect(url_for('computers.import_computers', proyecto=default_proj))
-        else:
-            return redirect(url_for('computers.import_computers'))
-
-    inserted = 0
-    db = get_db()
-    # Tipos de operación válidos
-    _TIPOS_VALIDOS = {'entrega', 'recepción', 'recepcion', 'incidencia'}
-    proyecto_importado = default_proj
-    for r in rows:
-        proyecto = get_value(r, ['proyecto', 'PROYECTO']) or default_proj or 'Mitie'
-        if proyecto_importado is None:
-            proyecto_importado = proyecto
-        hostname = get_value(r, ['hostname', 'HOSTNAME', 'equipo'])
-        # accept common variations for serial number column, including "S/N"
-        numero_serie = get_value(r, ['numero_serie', 'serial', 'sn', 'SN', 's/n'])
-        apellidos_nombre = get_value(r, ['apellidos_nombre', 'persona', 'usuario_equipo'])
-        notas = get_value(r, ['notas', 'observaciones'])
-        tipo_raw = get_value(r, ['tipo', 'TIPO']) or 'Entrega'
-        # Normalizar tipo: si no es un tipo de operación válido, usar 'Entrega'
-        tipo = tipo_raw.strip()
-        if tipo.lower() not in _TIPOS_VALIDOS:
-            tipo = 'Entrega'
-        else:
-            # Normalizar la capitalización
-            tipo_map = {'entrega': 'Entrega', 'recepción': 'Recepción', 'recepcion': 'Recepción', 'incidencia': 'Incidencia'}
-            tipo = tipo_map.get(tipo.lower(), 'Entrega')
-
-        if not hostname:
-            errors.append('Fila sin hostname omitida.')
-            continue
-
-        try:
-            db.execute(
-                'INSERT INTO computers (hostname, numero_serie, apellidos_nombre, notas, tipo, usuario, timestamp, proyecto) '
-                'VALUES (?,?,?,?,?,?,?,?)',
-                (hostname, numero_serie, apellidos_nombre, notas, tipo,
-                 current_user.username, datetime.now().isoformat(), proyecto),
-            )
-            inserted += 1
-        except Exception as e:
-            errors.append(f'Error insertando equipo {hostname}: {e}')
-    db.commit()
-
-    flash(f'Se insertaron {inserted} registros de computers.', 'success' if inserted else 'warning')
-    for err in errors[:5]:
-        flash(err, 'error')
-    # Redirigir al histórico con el filtro de proyecto correspondiente
-    if proyecto_importado:
-        return redirect(url_for('history.history_computers_entrega', proyecto=proyecto_importado))
-    else:
-        return redirect(url_for('history.history_computers_entrega'))
+    volver_base = url_for('history.history_computers_entrega')
+    job_id = submit_import('computers', request.files.get('file'), _run_import_computers,
+                           current_user.username, volver=volver_base,
+                           default_proj=default_proj, operador=current_user.username,
+                           volver_base=volver_base, dry_run=dry_run_requested())
+    return import_job_response(job_id)
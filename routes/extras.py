@@ -4,49 +4,97 @@ import sqlite3
 from datetime import datetime
 
 from flask import Blueprint, render_template, request, redirect, url_for, flash
-from flask_login import login_required
+from flask_login import login_required, current_user
 
-from models import get_db
+from jobs import submit_import
+from models import get_db, normalize_clave, write_transaction
 from routes._decorators import require_permission
-from utils import parse_import_file, check_admin_password
+from routes.jobs import import_job_response, dry_run_requested
+from utils import (parse_import_file, check_admin_password, import_rows, ImportRowError,
+                   check_imei_column, check_phone_column,
+                   paginate_query, search_filter, send_export)
 
 extras_bp = Blueprint('extras', __name__)
 
 
+# ===================================================================
+# Listados (paginados y filtrados en el servidor)
+# ===================================================================
+
+_ORDEN_RECIENTES = 'fecha_creacion DESC, id DESC'  # cubierto por idx_<tabla>_fecha
+
+
+def _lista_query(tabla, filtros):
+    """Query + params (sin ORDER BY) de un listado de extras.
+
+    *filtros* mapea parámetro de la URL → columna; cada valor se busca como
+    subcadena con :func:`utils.search_filter` (índice FTS si existe).
+    Devuelve (query, params, valores) con los valores leídos de la URL.
+    """
+    valores = {arg: request.args.get(arg, '').strip() for arg in filtros}
+    text_sql, text_params = search_filter(tabla, {col: valores[arg] for arg, col in filtros.items()})
+    return f'SELECT * FROM {tabla} WHERE 1=1{text_sql}', text_params, valores
+
+
+def _render_lista(tabla, filtros, template, var, orden=_ORDEN_RECIENTES, **ctx):
+    query, params, valores = _lista_query(tabla, filtros)
+    pag = paginate_query(get_db(), f'{query} ORDER BY {orden}', params, table=tabla)
+    filtros = {arg: valor for arg, valor in valores.items() if valor}
+    return render_template(template, **{var: pag.pop('rows')}, **pag, filtros=filtros, **ctx)
+
+
+def _export_lista(tabla, filtros, campos, basename):
+    """Exporta el listado filtrado completo; *campos* es [(cabecera, columna)]."""
+    query, params, _ = _lista_query(tabla, filtros)
+    rows = get_db().execute(f'{query} ORDER BY {_ORDEN_RECIENTES}', params)
+    data = ([r[col] or '' for _, col in campos] for r in rows)
+    return send_export([cab for cab, _ in campos], data, basename)
+
+
 # ===================================================================
 # Usuarios GTD / SGPMR
 # ===================================================================
 
+_FILTROS_USUARIOS_GTD = {'usuario_sgpmr': 'usuario_sgpmr', 'nombre': 'nombre_apellidos'}
+
+
 @extras_bp.route('/usuarios_gtd_sgpmr')
 @require_permission('registrar')
 def usuarios_gtd_sgpmr():
-    db = get_db()
-    usuarios = db.execute('SELECT * FROM usuarios_gtd_sgpmr ORDER BY fecha_creacion DESC').fetchall()
-    return render_template('usuarios_gtd_sgpmr.html', usuarios=usuarios)
+    return _render_lista('usuarios_gtd_sgpmr', _FILTROS_USUARIOS_GTD, 'usuarios_gtd_sgpmr.html', 'usuarios')
+
+
+@extras_bp.route('/usuarios_gtd_sgpmr/export')
+@require_permission('registrar')
+def export_usuarios_gtd_sgpmr():
+    return _export_lista('usuarios_gtd_sgpmr', _FILTROS_USUARIOS_GTD, [
+        ('Usuario GTD', 'usuario_gtd'), ('Usuario SGPMR', 'usuario_sgpmr'),
+        ('Nombre y Apellidos', 'nombre_apellidos'), ('Correo Electrónico', 'correo_electronico'),
+        ('DNI/NIE', 'dni_nie'), ('Fecha Creación', 'fecha_creacion'),
+    ], 'usuarios_gtd_sgpmr')
 
 
 @extras_bp.route('/usuarios_gtd_sgpmr/crear', methods=['GET', 'POST'])
 @require_permission('registrar')
 def crear_usuario_gtd_sgpmr():
-    db = get_db()
     if request.method == 'POST':
         usuario_gtd = request.form.get('usuario_gtd', '').strip()
         usuario_sgpmr = request.form.get('usuario_sgpmr', '').strip()
         nombre_apellidos = request.form.get('nombre_apellidos', '').strip()
         correo_electronico = request.form.get('correo_electronico', '').strip()
-        dni_nie = request.form.get('dni_nie', '').strip()
+        dni_nie = normalize_clave(request.form.get('dni_nie', ''))
 
         if not nombre_apellidos:
             flash('El nombre y apellidos es requerido', 'error')
             return redirect(url_for('extras.crear_usuario_gtd_sgpmr'))
 
         try:
-            db.execute('''
-                INSERT INTO usuarios_gtd_sgpmr (usuario_gtd, usuario_sgpmr, nombre_apellidos, correo_electronico, dni_nie, fecha_creacion)
-                VALUES (?,?,?,?,?,?)
-            ''', (usuario_gtd or None, usuario_sgpmr or None, nombre_apellidos,
-                  correo_electronico or None, dni_nie or None, datetime.utcnow().isoformat()))
-            db.commit()
+            with write_transaction() as db:
+                db.execute('''
+                    INSERT INTO usuarios_gtd_sgpmr (usuario_gtd, usuario_sgpmr, nombre_apellidos, correo_electronico, dni_nie, fecha_creacion)
+                    VALUES (?,?,?,?,?,?)
+                ''', (usuario_gtd or None, usuario_sgpmr or None, nombre_apellidos,
+                      correo_electronico or None, dni_nie or None, datetime.utcnow().isoformat()))
             flash('Usuario creado correctamente', 'success')
             return redirect(url_for('extras.usuarios_gtd_sgpmr'))
         except sqlite3.IntegrityError as e:
@@ -70,19 +118,19 @@ def editar_usuario_gtd_sgpmr(usuario_id):
         usuario_sgpmr = request.form.get('usuario_sgpmr', '').strip()
         nombre_apellidos = request.form.get('nombre_apellidos', '').strip()
         correo_electronico = request.form.get('correo_electronico', '').strip()
-        dni_nie = request.form.get('dni_nie', '').strip()
+        dni_nie = normalize_clave(request.form.get('dni_nie', ''))
 
         if not nombre_apellidos:
             flash('El nombre y apellidos es requerido', 'error')
             return redirect(url_for('extras.editar_usuario_gtd_sgpmr', usuario_id=usuario_id))
 
         try:
-            db.execute('''
-                UPDATE usuarios_gtd_sgpmr SET usuario_gtd=?, usuario_sgpmr=?, nombre_apellidos=?, correo_electronico=?, dni_nie=?
-                WHERE id=?
-            ''', (usuario_gtd or None, usuario_sgpmr or None, nombre_apellidos,
-                  correo_electronico or None, dni_nie or None, usuario_id))
-            db.commit()
+            with write_transaction() as db:
+                db.execute('''
+                    UPDATE usuarios_gtd_sgpmr SET usuario_gtd=?, usuario_sgpmr=?, nombre_apellidos=?, correo_electronico=?, dni_nie=?
+                    WHERE id=?
+                ''', (usuario_gtd or None, usuario_sgpmr or None, nombre_apellidos,
+                      correo_electronico or None, dni_nie or None, usuario_id))
             flash('Usuario actualizado correctamente', 'success')
             return redirect(url_for('extras.usuarios_gtd_sgpmr'))
         except sqlite3.IntegrityError as e:
@@ -100,75 +148,78 @@ def eliminar_usuario_gtd_sgpmr(usuario_id):
         flash('Contraseña de administrador incorrecta', 'error')
         return redirect(url_for('extras.usuarios_gtd_sgpmr'))
 
-    db = get_db()
-    db.execute('DELETE FROM usuarios_gtd_sgpmr WHERE id = ?', (usuario_id,))
-    db.commit()
+    with write_transaction() as db:
+        db.execute('DELETE FROM usuarios_gtd_sgpmr WHERE id = ?', (usuario_id,))
     flash('Usuario eliminado correctamente', 'success')
     return redirect(url_for('extras.usuarios_gtd_sgpmr'))
 
 
+def _run_importar_usuarios_gtd_sgpmr(file, progress=None, dry_run=False):
+    """Importación de usuarios GTD/SGPMR (se ejecuta como job, ver :mod:`jobs`)."""
+    rows, errors = parse_import_file(file, {
+        'usuario_gtd': ['usuario_gtd'], 'usuario_sgpmr': ['usuario_sgpmr'],
+        'nombre_apellidos': ['nombre_apellidos'], 'correo_electronico': ['correo_electronico'],
+        'dni_nie': ['dni_nie'],
+    })
+    timestamp = datetime.utcnow().isoformat()
+
+    def to_values(row):
+        usuario_gtd, usuario_sgpmr, nombre_apellidos, correo_electronico, dni_nie = row
+        if not nombre_apellidos:
+            raise ImportRowError("nombre_apellidos es requerido")
+        return (
+            usuario_gtd or None, usuario_sgpmr or None, nombre_apellidos,
+            correo_electronico or None, dni_nie or None, timestamp,
+        )
+
+    res = import_rows(get_db(), 'usuarios_gtd_sgpmr',
+                      ('usuario_gtd', 'usuario_sgpmr', 'nombre_apellidos', 'correo_electronico',
+                       'dni_nie', 'fecha_creacion'),
+                      rows, to_values, dry_run=dry_run, progress=progress)
+    res['errors'] = errors + res['errors']
+    return res
+
+
 @extras_bp.route('/usuarios_gtd_sgpmr/importar', methods=['GET', 'POST'])
 @require_permission('registrar')
 def importar_usuarios_gtd_sgpmr():
     if request.method == 'GET':
         return render_template('importar_usuarios_gtd_sgpmr.html')
 
-    archivo = request.files.get('archivo')
-    rows, file_errors = parse_import_file(archivo)
-    if file_errors and not rows:
-        for e in file_errors:
-            flash(e, 'error')
-        return redirect(url_for('extras.importar_usuarios_gtd_sgpmr'))
-
-    db = get_db()
-    inserted = 0
-    errors = list(file_errors)
-    for idx, row in enumerate(rows, 2):
-        try:
-            nombre_apellidos = str(row.get('nombre_apellidos') or '').strip()
-            if not nombre_apellidos:
-                errors.append(f"Fila {idx}: nombre_apellidos es requerido")
-                continue
-            db.execute('''
-                INSERT INTO usuarios_gtd_sgpmr (usuario_gtd, usuario_sgpmr, nombre_apellidos, correo_electronico, dni_nie, fecha_creacion)
-                VALUES (?,?,?,?,?,?)
-            ''', (
-                str(row.get('usuario_gtd') or '').strip() or None,
-                str(row.get('usuario_sgpmr') or '').strip() or None,
-                nombre_apellidos,
-                str(row.get('correo_electronico') or '').strip() or None,
-                str(row.get('dni_nie') or '').strip() or None,
-                datetime.utcnow().isoformat(),
-            ))
-            inserted += 1
-        except sqlite3.IntegrityError as e:
-            errors.append(f"Fila {idx}: {e}")
-    db.commit()
-
-    flash(f'Se importaron {inserted} usuarios correctamente. Errores: {len(errors)}',
-          'success' if inserted else 'warning')
-    for err in errors[:10]:
-        flash(err, 'error')
-    return redirect(url_for('extras.usuarios_gtd_sgpmr'))
+    job_id = submit_import('usuarios_gtd_sgpmr', request.files.get('archivo'),
+                           _run_importar_usuarios_gtd_sgpmr, current_user.username,
+                           volver=url_for('extras.usuarios_gtd_sgpmr'),
+                           dry_run=dry_run_requested())
+    return import_job_response(job_id)
 
 
 # ===================================================================
 # Inventario de Teléfonos
 # ===================================================================
 
+_FILTROS_INVENTARIO = {'imei': 'imei'}
+
+
 @extras_bp.route('/inventario_telefonos')
 @require_permission('registrar')
 def inventario_telefonos():
-    db = get_db()
-    telefonos = db.execute('SELECT * FROM inventario_telefonos ORDER BY fecha_creacion DESC').fetchall()
-    return render_template('inventario_telefonos.html', telefonos=telefonos)
+    return _render_lista('inventario_telefonos', _FILTROS_INVENTARIO, 'inventario_telefonos.html', 'telefonos')
+
+
+@extras_bp.route('/inventario_telefonos/export')
+@require_permission('registrar')
+def export_inventario_telefonos():
+    return _export_lista('inventario_telefonos', _FILTROS_INVENTARIO, [
+        ('IMEI', 'imei'), ('Número Serie', 'numero_serie'), ('Modelo', 'modelo'),
+        ('Teléfono Asociado', 'telefono_asociado'), ('Fecha Creación', 'fecha_creacion'),
+    ], 'inventario_telefonos')
 
 
 @extras_bp.route('/inventario_telefonos/crear', methods=['GET', 'POST'])
 @require_permission('registrar')
 def crear_inventario_telefonos():
     if request.method == 'POST':
-        imei = request.form.get('imei', '').strip()
+        imei = normalize_clave(request.form.get('imei', ''))
         numero_serie = request.form.get('numero_serie', '').strip()
         modelo = request.form.get('modelo', '').strip()
         telefono_asociado = request.form.get('telefono_asociado', '').strip()
@@ -177,14 +228,13 @@ def crear_inventario_telefonos():
             flash('El IMEI es requerido', 'error')
             return redirect(url_for('extras.crear_inventario_telefonos'))
 
-        db = get_db()
         try:
-            db.execute('''
-                INSERT INTO inventario_telefonos (imei, numero_serie, modelo, telefono_asociado, fecha_creacion)
-                VALUES (?,?,?,?,?)
-            ''', (imei, numero_serie or None, modelo or None, telefono_asociado or None,
-                  datetime.utcnow().isoformat()))
-            db.commit()
+            with write_transaction() as db:
+                db.execute('''
+                    INSERT INTO inventario_telefonos (imei, numero_serie, modelo, telefono_asociado, fecha_creacion)
+                    VALUES (?,?,?,?,?)
+                ''', (imei, numero_serie or None, modelo or None, telefono_asociado or None,
+                      datetime.utcnow().isoformat()))
             flash('Teléfono registrado correctamente', 'success')
             return redirect(url_for('extras.inventario_telefonos'))
         except sqlite3.IntegrityError as e:
@@ -204,7 +254,7 @@ def editar_inventario_telefonos(telefono_id):
         return redirect(url_for('extras.inventario_telefonos'))
 
     if request.method == 'POST':
-        imei = request.form.get('imei', '').strip()
+        imei = normalize_clave(request.form.get('imei', ''))
         numero_serie = request.form.get('numero_serie', '').strip()
         modelo = request.form.get('modelo', '').strip()
         telefono_asociado = request.form.get('telefono_asociado', '').strip()
@@ -214,11 +264,11 @@ def editar_inventario_telefonos(telefono_id):
             return redirect(url_for('extras.editar_inventario_telefonos', telefono_id=telefono_id))
 
         try:
-            db.execute('''
-                UPDATE inventario_telefonos SET imei=?, numero_serie=?, modelo=?, telefono_asociado=?
-                WHERE id=?
-            ''', (imei, numero_serie or None, modelo or None, telefono_asociado or None, telefono_id))
-            db.commit()
+            with write_transaction() as db:
+                db.execute('''
+                    UPDATE inventario_telefonos SET imei=?, numero_serie=?, modelo=?, telefono_asociado=?
+                    WHERE id=?
+                ''', (imei, numero_serie or None, modelo or None, telefono_asociado or None, telefono_id))
             flash('Teléfono actualizado correctamente', 'success')
             return redirect(url_for('extras.inventario_telefonos'))
         except sqlite3.IntegrityError as e:
@@ -236,9 +286,8 @@ def eliminar_inventario_telefonos(telefono_id):
         flash('Contraseña de administrador incorrecta', 'error')
         return redirect(url_for('extras.inventario_telefonos'))
 
-    db = get_db()
-    db.execute('DELETE FROM inventario_telefonos WHERE id = ?', (telefono_id,))
-    db.commit()
+    with write_transaction() as db:
+        db.execute('DELETE FROM inventario_telefonos WHERE id = ?', (telefono_id,))
     flash('Teléfono eliminado correctamente', 'success')
     return redirect(url_for('extras.inventario_telefonos'))
 
@@ -256,77 +305,78 @@ def delete_selected_inventario_telefonos():
     if ids_param:
         id_list = [int(i) for i in ids_param.split(',') if i.strip().isdigit()]
         if id_list:
-            db = get_db()
             ph = ','.join(['?'] * len(id_list))
-            db.execute(f'DELETE FROM inventario_telefonos WHERE id IN ({ph})', id_list)
-            db.commit()
+            with write_transaction() as db:
+                db.execute(f'DELETE FROM inventario_telefonos WHERE id IN ({ph})', id_list)
             flash('Teléfonos eliminados correctamente', 'success')
 
     return redirect(url_for('extras.inventario_telefonos'))
 
 
+def _run_importar_inventario_telefonos(file, progress=None, dry_run=False):
+    """Importación de inventario de teléfonos (se ejecuta como job, ver :mod:`jobs`)."""
+    rows, errors = parse_import_file(file, {
+        'imei': ['imei'], 'numero_serie': ['numero_serie'],
+        'modelo': ['modelo'], 'telefono_asociado': ['telefono_asociado'],
+    })
+    timestamp = datetime.utcnow().isoformat()
+
+    def to_values(row):
+        imei, numero_serie, modelo, telefono_asociado = row
+        if not imei:
+            raise ImportRowError("IMEI es requerido")
+        return (imei, numero_serie or None, modelo or None, telefono_asociado or None, timestamp)
+
+    res = import_rows(get_db(), 'inventario_telefonos',
+                      ('imei', 'numero_serie', 'modelo', 'telefono_asociado', 'fecha_creacion'),
+                      rows, to_values, dry_run=dry_run, progress=progress,
+                      column_checks={'imei': check_imei_column, 'telefono_asociado': check_phone_column})
+    res['errors'] = errors + res['errors']
+    return res
+
+
 @extras_bp.route('/inventario_telefonos/importar', methods=['GET', 'POST'])
 @require_permission('registrar')
 def importar_inventario_telefonos():
     if request.method == 'GET':
         return render_template('importar_inventario_telefonos.html')
 
-    archivo = request.files.get('archivo')
-    rows, file_errors = parse_import_file(archivo)
-    if file_errors and not rows:
-        for e in file_errors:
-            flash(e, 'error')
-        return redirect(url_for('extras.importar_inventario_telefonos'))
-
-    db = get_db()
-    inserted = 0
-    errors = list(file_errors)
-    for idx, row in enumerate(rows, 2):
-        try:
-            imei = str(row.get('imei') or '').strip()
-            if not imei:
-                errors.append(f"Fila {idx}: IMEI es requerido")
-                continue
-
-            db.execute('''
-                INSERT INTO inventario_telefonos (imei, numero_serie, modelo, telefono_asociado, fecha_creacion)
-                VALUES (?,?,?,?,?)
-            ''', (
-                imei,
-                str(row.get('numero_serie') or '').strip() or None,
-                str(row.get('modelo') or '').strip() or None,
-                str(row.get('telefono_asociado') or '').strip() or None,
-                datetime.utcnow().isoformat(),
-            ))
-            inserted += 1
-        except sqlite3.IntegrityError as e:
-            errors.append(f"Fila {idx}: {e}")
-    db.commit()
-
-    flash(f'Se importaron {inserted} teléfonos correctamente. Errores: {len(errors)}',
-          'success' if inserted else 'warning')
-    for err in errors[:10]:
-        flash(err, 'error')
-    return redirect(url_for('extras.inventario_telefonos'))
+    job_id = submit_import('inventario_telefonos', request.files.get('archivo'), _run_importar_inventario_telefonos,
+                           current_user.username, volver=url_for('extras.inventario_telefonos'),
+                           dry_run=dry_run_requested())
+    return import_job_response(job_id)
 
 
 # ===================================================================
 # Datos de Usuario
 # ===================================================================
 
+_FILTROS_DATOS_USUARIO = {'dni': 'dni', 'nombre': 'apellidos_nombre', 'notas': 'notas'}
+# Columnas ordenables del listado (?sort=<clave>&dir=asc|desc)
+_ORDEN_DATOS_USUARIO = {
+    'dni': 'dni', 'nombre': 'apellidos_nombre', 'telefono': 'telefono_personal',
+    'email': 'email_personal', 'email_corp': 'email_corp', 'notas': 'notas',
+    'fecha': 'fecha_creacion',
+}
+
+
 @extras_bp.route('/datos_usuario')
 @require_permission('registrar')
 def datos_usuario():
-    db = get_db()
-    usuarios = db.execute('SELECT * FROM datos_usuario ORDER BY fecha_creacion DESC').fetchall()
-    return render_template('datos_usuario.html', usuarios=usuarios)
+    sort = request.args.get('sort', '')
+    desc = request.args.get('dir') == 'desc'
+    orden = _ORDEN_RECIENTES
+    if sort in _ORDEN_DATOS_USUARIO:
+        orden = f"{_ORDEN_DATOS_USUARIO[sort]} {'DESC' if desc else 'ASC'}, id DESC"
+    return _render_lista('datos_usuario', _FILTROS_DATOS_USUARIO, 'datos_usuario.html', 'usuarios',
+                         orden=orden, sort=sort if sort in _ORDEN_DATOS_USUARIO else '', desc=desc)
 
 
 @extras_bp.route('/datos_usuario/crear', methods=['GET', 'POST'])
 @require_permission('registrar')
 def crear_datos_usuario():
     if request.method == 'POST':
-        dni = request.form.get('dni', '').strip()
+        dni = normalize_clave(request.form.get('dni', ''))
         apellidos_nombre = request.form.get('apellidos_nombre', '').strip()
         telefono_personal = request.form.get('telefono_personal', '').strip()
         email_personal = request.form.get('email_personal', '').strip()
@@ -337,14 +387,13 @@ def crear_datos_usuario():
             flash('DNI y Apellidos y Nombre son campos requeridos', 'error')
             return redirect(url_for('extras.crear_datos_usuario'))
 
-        db = get_db()
         try:
-            db.execute('''
-                INSERT INTO datos_usuario (dni, apellidos_nombre, telefono_personal, email_personal, email_corp, notas, fecha_creacion)
-                VALUES (?,?,?,?,?,?,?)
-            ''', (dni, apellidos_nombre, telefono_personal or None,
-                  email_personal or None, email_corp or None, notas or None, datetime.utcnow().isoformat()))
-            db.commit()
+            with write_transaction() as db:
+                db.execute('''
+                    INSERT INTO datos_usuario (dni, apellidos_nombre, telefono_personal, email_personal, email_corp, notas, fecha_creacion)
+                    VALUES (?,?,?,?,?,?,?)
+                ''', (dni, apellidos_nombre, telefono_personal or None,
+                      email_personal or None, email_corp or None, notas or None, datetime.utcnow().isoformat()))
             flash('Datos de usuario creados correctamente', 'success')
             return redirect(url_for('extras.datos_usuario'))
         except sqlite3.IntegrityError as e:
@@ -364,7 +413,7 @@ def editar_datos_usuario(usuario_id):
         return redirect(url_for('extras.datos_usuario'))
 
     if request.method == 'POST':
-        dni = request.form.get('dni', '').strip()
+        dni = normalize_clave(request.form.get('dni', ''))
         apellidos_nombre = request.form.get('apellidos_nombre', '').strip()
         telefono_personal = request.form.get('telefono_personal', '').strip()
         email_personal = request.form.get('email_personal', '').strip()
@@ -376,12 +425,12 @@ def editar_datos_usuario(usuario_id):
             return redirect(url_for('extras.editar_datos_usuario', usuario_id=usuario_id))
 
         try:
-            db.execute('''
-                UPDATE datos_usuario SET dni=?, apellidos_nombre=?, telefono_personal=?, email_personal=?, email_corp=?, notas=?
-                WHERE id=?
-            ''', (dni, apellidos_nombre, telefono_personal or None,
-                  email_personal or None, email_corp or None, notas or None, usuario_id))
-            db.commit()
+            with write_transaction() as db:
+                db.execute('''
+                    UPDATE datos_usuario SET dni=?, apellidos_nombre=?, telefono_personal=?, email_personal=?, email_corp=?, notas=?
+                    WHERE id=?
+                ''', (dni, apellidos_nombre, telefono_personal or None,
+                      email_personal or None, email_corp or None, notas or None, usuario_id))
             flash('Datos de usuario actualizados correctamente', 'success')
             return redirect(url_for('extras.datos_usuario'))
         except sqlite3.IntegrityError as e:
@@ -399,9 +448,8 @@ def eliminar_datos_usuario(usuario_id):
         flash('Contraseña de administrador incorrecta', 'error')
         return redirect(url_for('extras.datos_usuario'))
 
-    db = get_db()
-    db.execute('DELETE FROM datos_usuario WHERE id = ?', (usuario_id,))
-    db.commit()
+    with write_transaction() as db:
+        db.execute('DELETE FROM datos_usuario WHERE id = ?', (usuario_id,))
     flash('Datos de usuario eliminados correctamente', 'success')
     return redirect(url_for('extras.datos_usuario'))
 
@@ -419,57 +467,48 @@ def delete_selected_datos_usuario():
     if ids_param:
         id_list = [int(i) for i in ids_param.split(',') if i.strip().isdigit()]
         if id_list:
-            db = get_db()
             ph = ','.join(['?'] * len(id_list))
-            db.execute(f'DELETE FROM datos_usuario WHERE id IN ({ph})', id_list)
-            db.commit()
+            with write_transaction() as db:
+                db.execute(f'DELETE FROM datos_usuario WHERE id IN ({ph})', id_list)
             flash('Registros eliminados correctamente', 'success')
 
     return redirect(url_for('extras.datos_usuario'))
 
 
+def _run_importar_datos_usuario(file, progress=None, dry_run=False):
+    """Importación de datos de usuario (se ejecuta como job, ver :mod:`jobs`)."""
+    rows, errors = parse_import_file(file, {
+        'dni': ['dni'], 'apellidos_nombre': ['apellidos_nombre', 'nombre'],
+        'telefono_personal': ['telefono_personal', 'telefono'], 'email_personal': ['email_personal'],
+        'email_corp': ['email_corp', 'email_corporativo'], 'notas': ['notas', 'observaciones'],
+    })
+    timestamp = datetime.utcnow().isoformat()
+
+    def to_values(row):
+        dni, apellidos_nombre, telefono_personal, email_personal, email_corp, notas = row
+        if not dni or not apellidos_nombre:
+            raise ImportRowError("DNI y Apellidos y Nombre son requeridos")
+        return (
+            dni, apellidos_nombre, telefono_personal or None, email_personal or None,
+            email_corp or None, notas or None, timestamp,
+        )
+
+    res = import_rows(get_db(), 'datos_usuario',
+                      ('dni', 'apellidos_nombre', 'telefono_personal', 'email_personal',
+                       'email_corp', 'notas', 'fecha_creacion'),
+                      rows, to_values, dry_run=dry_run, progress=progress,
+                      column_checks={'telefono_personal': check_phone_column})
+    res['errors'] = errors + res['errors']
+    return res
+
+
 @extras_bp.route('/datos_usuario/importar', methods=['GET', 'POST'])
 @require_permission('registrar')
 def importar_datos_usuario():
     if request.method == 'GET':
         return render_template('importar_datos_usuario.html')
 
-    archivo = request.files.get('archivo')
-    rows, file_errors = parse_import_file(archivo)
-    if file_errors and not rows:
-        for e in file_errors:
-            flash(e, 'error')
-        return redirect(url_for('extras.importar_datos_usuario'))
-
-    db = get_db()
-    inserted = 0
-    errors = list(file_errors)
-    for idx, row in enumerate(rows, 2):
-        try:
-            dni = str(row.get('dni') or '').strip()
-            apellidos_nombre = str(row.get('apellidos_nombre') or row.get('nombre') or '').strip()
-            if not dni or not apellidos_nombre:
-                errors.append(f"Fila {idx}: DNI y Apellidos y Nombre son requeridos")
-                continue
-            db.execute('''
-                INSERT INTO datos_usuario (dni, apellidos_nombre, telefono_personal, email_personal, email_corp, notas, fecha_creacion)
-                VALUES (?,?,?,?,?,?,?)
-            ''', (
-                dni,
-                apellidos_nombre,
-                str(row.get('telefono_personal') or row.get('telefono') or '').strip() or None,
-                str(row.get('email_personal') or '').strip() or None,
-                str(row.get('email_corp') or row.get('email_corporativo') or '').strip() or None,
-                str(row.get('notas') or row.get('observaciones') or '').strip() or None,
-                datetime.utcnow().isoformat(),
-            ))
-            inserted += 1
-        except sqlite3.IntegrityError as e:
-            errors.append(f"Fila {idx}: {e}")
-    db.commit()
-
-    flash(f'Se importaron {inserted} registros correctamente. Errores: {len(errors)}',
-          'success' if inserted else 'warning')
-    for err in errors[:10]:
-        flash(err, 'error')
-    return redirect(url_for('extras.datos_usuario'))
+    job_id = submit_import('datos_usuario', request.files.get('archivo'), _run_importar_datos_usuario,
+                           current_user.username, volver=url_for('extras.datos_usuario'),
+                           dry_run=dry_run_requested())
+    return import_job_response(job_id)
@@ -1,17 +1,23 @@
 """Blueprint de histórico: vistas paginadas, exportación y borrado."""
 
+import os
 import re
 from datetime import datetime
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file
-from flask_login import login_required
+from flask import Blueprint, Response, render_template, request, redirect, url_for, flash, abort, send_file
+from flask_login import login_required, current_user
 
-from models import get_db
+from jobs import submit_import
+from models import get_db, get_write_db, detach_db, write_transaction, normalize_tipo, TIPO_ENTREGA, TIPO_RECEPCION
 from routes._decorators import require_permission
+from routes.jobs import import_job_response, dry_run_requested
 from utils import (
-    paginate_query, build_excel, verify_delete_password,
+    paginate_query, send_export, verify_delete_password,
     format_phone, is_mitie_email, is_valid_imei,
-    parse_import_file, get_value,
+    parse_import_file, search_filter,
+    import_rows, ImportRowError, check_imei_column,
+    iter_entrega_pdfs, iter_zip, _closing_stream,
+    archived_pdf_file, get_archived_pdf, PDF_ZIP_MAX,
 )
 
 history_bp = Blueprint('history', __name__)
@@ -31,18 +37,22 @@ def _search_params_moviles():
     }
 
 
-def _build_entregas_query(tipos, search):
-    """Construye query + params para buscar en tabla entregas filtrado por tipos."""
-    tipo_placeholders = ','.join(['?' for _ in tipos])
-    query = f'SELECT * FROM entregas WHERE LOWER(tipo) IN ({tipo_placeholders})'
-    params = list(tipos)
+# Orden estable de los históricos (coincide con la clave de paginación keyset)
+_ORDER_RECIENTES = ' ORDER BY timestamp DESC, id DESC'
+_KEYSET = ('timestamp', 'id')
 
-    if search['imei_search']:
-        query += ' AND imei LIKE ?'
-        params.append(f"%{search['imei_search']}%")
-    if search['usuario_search']:
-        query += ' AND usuario LIKE ?'
-        params.append(f"%{search['usuario_search']}%")
+
+def _build_entregas_query(tipo_norm, search):
+    """Construye query + params (sin ORDER BY) para buscar en entregas de un tipo_norm."""
+    query = 'SELECT * FROM entregas WHERE tipo_norm = ?'
+    params = [tipo_norm]
+
+    text_sql, text_params = search_filter('entregas', {
+        'imei': search['imei_search'],
+        'usuario': search['usuario_search'],
+    })
+    query += text_sql
+    params += text_params
     if search['fecha_inicio']:
         query += ' AND timestamp >= ?'
         params.append(f"{search['fecha_inicio']}T00:00:00")
@@ -50,12 +60,33 @@ def _build_entregas_query(tipos, search):
         query += ' AND timestamp <= ?'
         params.append(f"{search['fecha_fin']}T23:59:59")
 
-    query += ' ORDER BY timestamp DESC'
     return query, params
 
 
+def _selected_entregas_query(tipo_norm):
+    """Query + params (sin ORDER BY) de las entregas de *tipo_norm* a exportar:
+    las de ``?ids=`` o las de los filtros.  None si ``?ids=`` no trae ninguna."""
+    ids_param = request.args.get('ids', '').strip()
+    if ids_param:
+        id_list = [int(i) for i in ids_param.split(',') if i.strip().isdigit()]
+        if not id_list:
+            return None
+        ph = ','.join(['?'] * len(id_list))
+        return f'SELECT * FROM entregas WHERE tipo_norm = ? AND id IN ({ph})', [tipo_norm] + id_list
+    return _build_entregas_query(tipo_norm, _search_params_moviles())
+
+
+def _selected_entregas(db, tipo_norm):
+    """Cursor de las entregas de *tipo_norm* a exportar (ver :func:`_selected_entregas_query`)."""
+    selected = _selected_entregas_query(tipo_norm)
+    if selected is None:
+        return []
+    query, params = selected
+    return db.execute(query + _ORDER_RECIENTES, params)
+
+
 def _build_computers_query(tipo):
-    """Construye query + params para el histórico de computers."""
+    """Construye query + params (sin ORDER BY) para el histórico de computers."""
     hostname_search = request.args.get('hostname', '').strip()
     sn_search = request.args.get('sn', '').strip()
     proyecto_filter = request.args.get('proyecto', '').strip()
@@ -63,17 +94,16 @@ def _build_computers_query(tipo):
     query = 'SELECT * FROM computers WHERE tipo = ?'
     params = [tipo]
 
-    if hostname_search:
-        query += ' AND hostname LIKE ?'
-        params.append(f'%{hostname_search}%')
-    if sn_search:
-        query += ' AND numero_serie LIKE ?'
-        params.append(f'%{sn_search}%')
+    text_sql, text_params = search_filter('computers', {
+        'hostname': hostname_search,
+        'numero_serie': sn_search,
+    })
+    query += text_sql
+    params += text_params
     if proyecto_filter:
         query += ' AND proyecto = ?'
         params.append(proyecto_filter)
 
-    query += ' ORDER BY timestamp DESC'
     return query, params, hostname_search, sn_search, proyecto_filter
 
 
@@ -91,9 +121,10 @@ def history():
 @require_permission('ver_historico')
 def history_entrega():
     search = _search_params_moviles()
-    query, params = _build_entregas_query(['entrega', 'entregas'], search)
+    query, params = _build_entregas_query(TIPO_ENTREGA, search)
     db = get_db()
-    pag = paginate_query(db, query, params)
+    pag = paginate_query(db, query, params, keyset=_KEYSET,
+                         table='entregas', approx=not any(search.values()))
     return render_template('history_entrega.html', **pag, **search)
 
 
@@ -101,12 +132,33 @@ def history_entrega():
 @require_permission('ver_historico')
 def history_recepcion():
     search = _search_params_moviles()
-    query, params = _build_entregas_query(['recepción', 'recepcion', 'recepciones'], search)
+    query, params = _build_entregas_query(TIPO_RECEPCION, search)
     db = get_db()
-    pag = paginate_query(db, query, params)
+    pag = paginate_query(db, query, params, keyset=_KEYSET,
+                         table='entregas', approx=not any(search.values()))
     return render_template('history_recepcion.html', **pag, **search)
 
 
+@history_bp.route('/dispositivos_fuera')
+@require_permission('ver_historico')
+def dispositivos_fuera():
+    """Dispositivos entregados y aún no recepcionados (lectura de dispositivo_estado)."""
+    imei_search = request.args.get('imei', '').strip()
+    usuario_search = request.args.get('usuario', '').strip()
+
+    query = 'SELECT * FROM dispositivo_estado WHERE estado = ?'
+    params = [TIPO_ENTREGA]
+    if imei_search:
+        query += ' AND imei LIKE ?'; params.append(f'%{imei_search}%')
+    if usuario_search:
+        query += ' AND usuario LIKE ?'; params.append(f'%{usuario_search}%')
+
+    db = get_db()
+    pag = paginate_query(db, query, params, keyset=('desde', 'movimiento_id'))
+    return render_template('dispositivos_fuera.html', **pag,
+                           imei_search=imei_search, usuario_search=usuario_search)
+
+
 # ===================================================================
 # Histórico computers (genérico)
 # ===================================================================
@@ -114,44 +166,18 @@ def history_recepcion():
 @history_bp.route('/history_recepcion/import', methods=['POST'])
 @require_permission('administracion')
 def import_history_recepcion():
-    file = request.files.get('file')
-    rows, errors = parse_import_file(file)
-
-    inserted = 0
-    if rows:
-        db = get_db()
-        for r in rows:
-            situm = get_value(r, ['situm', 'SITUM'])
-            usuario = get_value(r, ['usuario', 'user', 'nombre'])
-            imei = get_value(r, ['imei', 'IMEI'])
-            raw_tel = get_value(r, ['telefono', 'phone', 'telefono_movil']) or ''
-            telefono = format_phone(raw_tel)
-            if raw_tel and telefono is None:
-                errors.append(f'Fila con IMEI={imei}: teléfono inválido "{raw_tel}"')
-                continue
-            notas_telefono = get_value(r, ['notas_telefono', 'notas', 'notes', 'modelo', 'model'])
-            try:
-                db.execute(
-                    'INSERT INTO entregas (situm, usuario, imei, telefono, notas_telefono, tipo, timestamp) VALUES (?,?,?,?,?,?,?)',
-                    (situm, usuario, imei, telefono, notas_telefono, 'recepcion', datetime.utcnow().isoformat()),
-                )
-                inserted += 1
-            except Exception as e:
-                errors.append(f'Error insertando fila con IMEI={imei}: {e}')
-        db.commit()
-
-    if inserted:
-        flash(f'Se importaron {inserted} registros de recepción', 'success')
-    if errors:
-        flash(f'Se omitieron {len(errors)} filas durante la importación', 'warning')
-
-    return redirect(url_for('history.history_recepcion'))
+    job_id = submit_import('recepciones', request.files.get('file'), _run_import_entregas,
+                           current_user.username, volver=url_for('history.history_recepcion'),
+                           tipo_fijo='recepcion', dry_run=dry_run_requested())
+    return import_job_response(job_id)
 
 
 def _render_computers_history(tipo, title_prefix):
     query, params, hostname_search, sn_search, proyecto_filter = _build_computers_query(tipo)
     db = get_db()
-    pag = paginate_query(db, query, params)
+    filtered = hostname_search or sn_search or proyecto_filter
+    pag = paginate_query(db, query, params, keyset=_KEYSET,
+                         table='computers', approx=not filtered)
     display_title = f"{title_prefix} {'- ' + proyecto_filter if proyecto_filter else ''}"
     return render_template(
         'history_computers.html', **pag,
@@ -188,70 +214,82 @@ def history_computers_incidencias():
 @history_bp.route('/history/export')
 @require_permission('ver_historico')
 def export_history():
-    return redirect(url_for('history.export_history_entrega'))
+    return redirect(url_for('history.export_history_entrega', **request.args))
 
 
 @history_bp.route('/history_entrega/export')
 @require_permission('ver_historico')
 def export_history_entrega():
-    db = get_db()
-    ids_param = request.args.get('ids', '').strip()
-    search = _search_params_moviles()
+    rows = _selected_entregas(get_db(), TIPO_ENTREGA)
 
-    if ids_param:
-        id_list = [int(i) for i in ids_param.split(',') if i.strip().isdigit()]
-        if not id_list:
-            rows = []
-        else:
-            ph = ','.join(['?'] * len(id_list))
-            rows = db.execute(
-                f'SELECT * FROM entregas WHERE LOWER(tipo) IN ("entrega","entregas") AND id IN ({ph}) ORDER BY timestamp DESC',
-                id_list,
-            ).fetchall()
-    else:
-        query, params = _build_entregas_query(['entrega', 'entregas'], search)
-        # Remove the SELECT * and replace for export (still works with *)
-        rows = db.execute(query, params).fetchall()
-
-    data = [[
+    data = ([
         r['situm'] or '', r['usuario'] or '', r['imei'] or '', r['telefono'] or '',
         r['email_usuario'] or '', r['codigo_validacion'] or 'Sin firma', r['timestamp'] or '',
-    ] for r in rows]
+    ] for r in rows)
+
+    return send_export(['Situm', 'Usuario', 'IMEI', 'Teléfono', 'Email', 'Firma', 'Fecha (UTC)'],
+                     data, 'historico_entregas')
 
-    bio = build_excel(['Situm', 'Usuario', 'IMEI', 'Teléfono', 'Email', 'Firma', 'Fecha (UTC)'], data)
-    return send_file(bio, as_attachment=True, download_name='historico_entregas.xlsx',
-                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
+@history_bp.route('/history_entrega/pdfs')
+@require_permission('ver_historico')
+def export_pdfs_entrega():
+    """ZIP con los PDFs de las entregas seleccionadas (``?ids=``) o filtradas.
+
+    Se genera en streaming: los PDFs ya archivados se reutilizan y el resto
+    se maqueta en el pool de procesos (ver :func:`utils.iter_entrega_pdfs`).
+    """
+    selected = _selected_entregas_query(TIPO_ENTREGA)
+    db = get_write_db()
+    total = 0
+    if selected:
+        query, params = selected
+        total = db.execute(f'SELECT COUNT(*) FROM ({query} LIMIT ?)', params + [PDF_ZIP_MAX + 1]).fetchone()[0]
+    if not total:
+        flash('No hay entregas que incluir en el ZIP.', 'error')
+        return redirect(url_for('history.history_entrega', **request.args))
+    if total > PDF_ZIP_MAX:
+        flash(f'El ZIP admite como máximo {PDF_ZIP_MAX} entregas: acota la búsqueda con los filtros '
+              'o selecciona los registros.', 'error')
+        return redirect(url_for('history.history_entrega', **request.args))
+    # La conexión de escritura sigue abierta durante el envío: el cursor se
+    # lee a medida que se mandan los PDFs y con ella se indexan los antiguos
+    db = detach_db(readonly=False)
+    rows = db.execute(query + _ORDER_RECIENTES, params)
+    rv = Response(_closing_stream(iter_zip(iter_entrega_pdfs(rows, db)), db), mimetype='application/zip')
+    rv.headers.set('Content-Disposition', 'attachment',
+                   filename=f"entregas_pdf_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.zip")
+    return rv
+
+
+@history_bp.route('/history_entrega/<int:entrega_id>/pdf')
+@require_permission('ver_historico')
+def entrega_pdf(entrega_id):
+    """Copia archivada del PDF de una entrega, sin regenerarla."""
+    info = get_archived_pdf(get_db(), entrega_id)
+    if not info:
+        abort(404)
+    try:
+        path = archived_pdf_file(info['ruta'])
+    except ValueError:
+        abort(404)  # ruta guardada fuera de pdfs/entregas: nunca se sirve
+    if not os.path.exists(path):
+        abort(404)  # el índice solo se escribe con el fichero ya en disco: lo han borrado
+    return send_file(path, mimetype='application/pdf', as_attachment=True,
+                     download_name=os.path.basename(info['ruta']), conditional=True, etag=info['sha256'])
 
 @history_bp.route('/history_recepcion/export')
 @require_permission('ver_historico')
 def export_history_recepcion():
-    db = get_db()
-    ids_param = request.args.get('ids', '').strip()
-    search = _search_params_moviles()
+    rows = _selected_entregas(get_db(), TIPO_RECEPCION)
 
-    if ids_param:
-        id_list = [int(i) for i in ids_param.split(',') if i.strip().isdigit()]
-        if not id_list:
-            rows = []
-        else:
-            ph = ','.join(['?'] * len(id_list))
-            rows = db.execute(
-                f'SELECT * FROM entregas WHERE LOWER(tipo) IN ("recepción","recepcion","recepciones") AND id IN ({ph}) ORDER BY timestamp DESC',
-                id_list,
-            ).fetchall()
-    else:
-        query, params = _build_entregas_query(['recepción', 'recepcion', 'recepciones'], search)
-        rows = db.execute(query, params).fetchall()
-
-    data = [[
+    data = ([
         r['situm'] or '', r['usuario'] or '', r['imei'] or '', r['telefono'] or '',
         r['notas_telefono'] or '', r['timestamp'] or '',
-    ] for r in rows]
+    ] for r in rows)
 
-    bio = build_excel(['Situm', 'Usuario', 'IMEI', 'Teléfono', 'Notas de Teléfono', 'Fecha (UTC)'], data)
-    return send_file(bio, as_attachment=True, download_name='historico_recepciones.xlsx',
-                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return send_export(['Situm', 'Usuario', 'IMEI', 'Teléfono', 'Notas de Teléfono', 'Fecha (UTC)'],
+                     data, 'historico_recepciones')
 
 
 @history_bp.route('/history_computers/export')
@@ -267,25 +305,21 @@ def export_history_computers():
     params = []
     if tipo_filter:
         query += ' AND tipo = ?'; params.append(tipo_filter)
-    if hostname_search:
-        query += ' AND hostname LIKE ?'; params.append(f'%{hostname_search}%')
-    if sn_search:
-        query += ' AND numero_serie LIKE ?'; params.append(f'%{sn_search}%')
+    text_sql, text_params = search_filter('computers', {'hostname': hostname_search, 'numero_serie': sn_search})
+    query += text_sql; params += text_params
     if proyecto_filter:
         query += ' AND proyecto = ?'; params.append(proyecto_filter)
     query += ' ORDER BY timestamp DESC'
 
-    rows = db.execute(query, params).fetchall()
-    data = [[
+    rows = db.execute(query, params)
+    data = ([
         r['proyecto'] or 'Mitie', r['hostname'] or '', r['numero_serie'] or '',
         r['apellidos_nombre'] or '', r['notas'] or '', r['usuario'] or '',
         r['timestamp'] or '', r['tipo'] or '',
-    ] for r in rows]
+    ] for r in rows)
 
-    bio = build_excel(['Proyecto', 'Hostname', 'S/N', 'Persona', 'Notas', 'Registrado por', 'Fecha', 'Tipo'], data)
-    filename = f"historico_computers_{tipo_filter or 'todos'}.xlsx"
-    return send_file(bio, as_attachment=True, download_name=filename,
-                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return send_export(['Proyecto', 'Hostname', 'S/N', 'Persona', 'Notas', 'Registrado por', 'Fecha', 'Tipo'],
+                       data, f"historico_computers_{tipo_filter or 'todos'}")
 
 
 # ===================================================================
@@ -300,13 +334,12 @@ def clear_history():
         flash('Contraseña incorrecta', 'error')
         return redirect(url_for('history.history_entrega'))
 
-    db = get_db()
-    db.execute('DELETE FROM entregas')
-    db.commit()
+    with write_transaction() as db:
+        db.execute('DELETE FROM entregas')
     return redirect(url_for('history.history_entrega'))
 
 
-def _delete_selected_entregas(tipos, redirect_endpoint):
+def _delete_selected_entregas(tipo_norm, redirect_endpoint):
     """Borrar registros seleccionados de la tabla entregas."""
     password = request.form.get('password', '').strip()
     ids_param = request.form.get('ids', '').strip()
@@ -318,14 +351,12 @@ def _delete_selected_entregas(tipos, redirect_endpoint):
     if ids_param:
         id_list = [int(i) for i in ids_param.split(',') if i.strip().isdigit()]
         if id_list:
-            db = get_db()
             ph_ids = ','.join(['?'] * len(id_list))
-            ph_tipos = ','.join(['?'] * len(tipos))
-            db.execute(
-                f'DELETE FROM entregas WHERE id IN ({ph_ids}) AND LOWER(tipo) IN ({ph_tipos})',
-                id_list + list(tipos),
-            )
-            db.commit()
+            with write_transaction() as db:
+                db.execute(
+                    f'DELETE FROM entregas WHERE id IN ({ph_ids}) AND tipo_norm = ?',
+                    id_list + [tipo_norm],
+                )
 
     return redirect(url_for(redirect_endpoint))
 
@@ -333,19 +364,19 @@ def _delete_selected_entregas(tipos, redirect_endpoint):
 @history_bp.route('/history/delete-selected', methods=['POST'])
 @require_permission('borrar_registros')
 def delete_selected():
-    return _delete_selected_entregas(['entrega', 'entregas'], 'history.history_entrega')
+    return _delete_selected_entregas(TIPO_ENTREGA, 'history.history_entrega')
 
 
 @history_bp.route('/history_entrega/delete-selected', methods=['POST'])
 @require_permission('borrar_registros')
 def delete_selected_entrega():
-    return _delete_selected_entregas(['entrega', 'entregas'], 'history.history_entrega')
+    return _delete_selected_entregas(TIPO_ENTREGA, 'history.history_entrega')
 
 
 @history_bp.route('/history_recepcion/delete-selected', methods=['POST'])
 @require_permission('borrar_registros')
 def delete_selected_recepcion():
-    return _delete_selected_entregas(['recepcion', 'recepción', 'recepciones'], 'history.history_recepcion')
+    return _delete_selected_entregas(TIPO_RECEPCION, 'history.history_recepcion')
 
 
 @history_bp.route('/history_computers/delete-selected', methods=['POST'])
@@ -361,10 +392,9 @@ def delete_selected_computers():
     if ids_param:
         id_list = [int(i) for i in ids_param.split(',') if i.strip().isdigit()]
         if id_list:
-            db = get_db()
             ph = ','.join(['?'] * len(id_list))
-            db.execute(f'DELETE FROM computers WHERE id IN ({ph})', id_list)
-            db.commit()
+            with write_transaction() as db:
+                db.execute(f'DELETE FROM computers WHERE id IN ({ph})', id_list)
 
     return redirect(request.referrer or url_for('main.index'))
 
@@ -405,11 +435,11 @@ def editar_registro(registro_id):
         flash('Teléfono inválido — debe ser numérico de 9 dígitos o con prefijo +34/0034/34', 'error')
         return redirect(url_for('history.editar_registro', registro_id=registro_id))
 
-    db.execute(
-        'UPDATE entregas SET situm=?, usuario=?, imei=?, telefono=?, notas_telefono=? WHERE id=?',
-        (situm, usuario, imei_digits, telefono, notas_telefono, registro_id),
-    )
-    db.commit()
+    with write_transaction(db):
+        db.execute(
+            'UPDATE entregas SET situm=?, usuario=?, imei=?, telefono=?, notas_telefono=? WHERE id=?',
+            (situm, usuario, imei_digits, telefono, notas_telefono, registro_id),
+        )
     flash('Registro actualizado correctamente', 'success')
     return redirect(url_for('history.history'))
 
@@ -418,37 +448,50 @@ def editar_registro(registro_id):
 # Importar entregas móviles (usa parser genérico)
 # ===================================================================
 
+_COLUMNAS_ENTREGA = ('situm', 'usuario', 'imei', 'telefono', 'notas_telefono', 'tipo', 'tipo_norm', 'timestamp')
+# Columnas que delatan una fila ya importada (avisos del modo simulación)
+_MATCH_ENTREGA = ('imei', 'tipo_norm', 'usuario')
+# Campo → cabeceras aceptadas (ver utils.compile_header_map)
+_CAMPOS_ENTREGA = {
+    'situm':          ['situm', 'SITUM'],
+    'usuario':        ['usuario', 'user', 'nombre'],
+    'imei':           ['imei', 'IMEI'],
+    'telefono':       ['telefono', 'phone', 'telefono_movil'],
+    'notas_telefono': ['notas_telefono', 'notas', 'notes', 'modelo', 'model'],
+    'tipo':           ['tipo', 'type'],
+}
+
+
+def _run_import_entregas(file, progress=None, tipo_fijo=None, dry_run=False):
+    """Importación de móviles (se ejecuta como job, ver :mod:`jobs`).
+
+    Sin *tipo_fijo* el tipo de operación se toma de la columna ``tipo``.
+    """
+    rows, errors = parse_import_file(file, _CAMPOS_ENTREGA)
+    timestamp = datetime.utcnow().isoformat()
+
+    def to_values(r):
+        situm, usuario, imei, raw_tel, notas_telefono, tipo = r
+        telefono = format_phone(raw_tel)
+        if raw_tel and telefono is None:
+            raise ImportRowError(f'IMEI={imei}: teléfono inválido "{raw_tel}"')
+        tipo = tipo_fijo or tipo or 'entrega'
+        return (situm, usuario, imei, telefono, notas_telefono, tipo, normalize_tipo(tipo), timestamp)
+
+    res = import_rows(get_db(), 'entregas', _COLUMNAS_ENTREGA, rows, to_values,
+                      dry_run=dry_run, progress=progress,
+                      match=_MATCH_ENTREGA, column_checks={'imei': check_imei_column})
+    res['errors'] = errors + res['errors']
+    return res
+
+
 @history_bp.route('/import', methods=['GET', 'POST'])
 @require_permission('registrar')
 def import_file():
     if request.method == 'GET':
         return render_template('import.html')
 
-    file = request.files.get('file')
-    rows, errors = parse_import_file(file)
-
-    inserted = 0
-    if rows:
-        db = get_db()
-        for r in rows:
-            situm = get_value(r, ['situm', 'SITUM'])
-            usuario = get_value(r, ['usuario', 'user', 'nombre'])
-            imei = get_value(r, ['imei', 'IMEI'])
-            raw_tel = get_value(r, ['telefono', 'phone', 'telefono_movil']) or ''
-            telefono = format_phone(raw_tel)
-            if raw_tel and telefono is None:
-                errors.append(f'Fila con IMEI={imei}: teléfono inválido "{raw_tel}"')
-                continue
-            notas_telefono = get_value(r, ['notas_telefono', 'notas', 'notes', 'modelo', 'model'])
-            tipo = get_value(r, ['tipo', 'type']) or 'entrega'
-            try:
-                db.execute(
-                    'INSERT INTO entregas (situm, usuario, imei, telefono, notas_telefono, tipo, timestamp) VALUES (?,?,?,?,?,?,?)',
-                    (situm, usuario, imei, telefono, notas_telefono, tipo, datetime.utcnow().isoformat()),
-                )
-                inserted += 1
-            except Exception as e:
-                errors.append(f'Error insertando fila con IMEI={imei}: {e}')
-        db.commit()
-
-    return render_template('import_result.html', inserted=inserted, errors=errors)
+    job_id = submit_import('entregas', request.files.get('file'), _run_import_entregas,
+                           current_user.username, volver=url_for('history.history_entrega'),
+                           dry_run=dry_run_requested())
+    return import_job_response(job_id)
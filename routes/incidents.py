@@ -1,55 +1,67 @@
 """Blueprint de incidencias."""
 
-import io
+import os
 import re
 import sqlite3
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file
+from flask import Blueprint, Response, render_template, request, redirect, url_for, flash, send_file
 from flask_login import login_required
 
-from models import get_db
+from models import get_db, write_transaction, open_blob
 from routes._decorators import require_permission
 from utils import (
-    paginate_query, build_excel, verify_delete_password,
-    format_phone, is_valid_imei,
+    paginate_query, send_export, verify_delete_password,
+    format_phone, is_valid_imei, search_filter,
+    attachment_path, remove_unreferenced_attachments,
 )
 
 incidents_bp = Blueprint('incidents', __name__)
 
 
-@incidents_bp.route('/incidents')
-@require_permission('ver_incidencias')
-def incidents():
-    imei_search = request.args.get('imei', '').strip()
-    usuario_search = request.args.get('usuario', '').strip()
-    fecha_inicio = request.args.get('fecha_inicio', '').strip()
-    fecha_fin = request.args.get('fecha_fin', '').strip()
+def _build_incidencias_query():
+    """Query + params (sin ORDER BY) del listado de incidencias según ``request.args``.
 
-    query = 'SELECT * FROM incidencias WHERE 1=1'
+    Devuelve (query, params, search) con los valores de búsqueda leídos.
+    """
+    search = {
+        'imei_search':    request.args.get('imei', '').strip(),
+        'usuario_search': request.args.get('usuario', '').strip(),
+        'fecha_inicio':   request.args.get('fecha_inicio', '').strip(),
+        'fecha_fin':      request.args.get('fecha_fin', '').strip(),
+    }
+    # Nunca leer el contenido de los adjuntos en los listados
+    query = 'SELECT id, imei, usuario, telefono, notas, archivo_nombre, timestamp FROM incidencias WHERE 1=1'
     params = []
-    if imei_search:
-        query += ' AND imei LIKE ?'; params.append(f'%{imei_search}%')
-    if usuario_search:
-        query += ' AND usuario LIKE ?'; params.append(f'%{usuario_search}%')
-    if fecha_inicio:
-        query += ' AND timestamp >= ?'; params.append(f'{fecha_inicio}T00:00:00')
-    if fecha_fin:
-        query += ' AND timestamp <= ?'; params.append(f'{fecha_fin}T23:59:59')
-    query += ' ORDER BY timestamp DESC'
+    text_sql, text_params = search_filter('incidencias', {
+        'imei': search['imei_search'], 'usuario': search['usuario_search'],
+    })
+    query += text_sql; params += text_params
+    if search['fecha_inicio']:
+        query += ' AND timestamp >= ?'; params.append(f"{search['fecha_inicio']}T00:00:00")
+    if search['fecha_fin']:
+        query += ' AND timestamp <= ?'; params.append(f"{search['fecha_fin']}T23:59:59")
+    return query, params, search
+
 
+@incidents_bp.route('/incidents')
+@require_permission('ver_incidencias')
+def incidents():
+    query, params, search = _build_incidencias_query()
     db = get_db()
-    pag = paginate_query(db, query, params)
+    pag = paginate_query(db, query, params, keyset=('timestamp', 'id'),
+                         table='incidencias', approx=not params)
     return render_template('incidents.html', incidents=pag['rows'],
                            page=pag['page'], total_pages=pag['total_pages'], total=pag['total'],
-                           imei_search=imei_search, usuario_search=usuario_search,
-                           fecha_inicio=fecha_inicio, fecha_fin=fecha_fin)
+                           total_aprox=pag['total_aprox'],
+                           next_cursor=pag['next_cursor'], prev_cursor=pag['prev_cursor'],
+                           **search)
 
 
 @incidents_bp.route('/incidencia/<int:inc_id>/editar', methods=['GET', 'POST'])
 @require_permission('administracion')
 def editar_incidencia(inc_id):
     db = get_db()
-    i = db.execute('SELECT * FROM incidencias WHERE id = ?', (inc_id,)).fetchone()
+    i = db.execute('SELECT id, imei, usuario, telefono, notas FROM incidencias WHERE id = ?', (inc_id,)).fetchone()
     if not i:
         flash('Incidencia no encontrada', 'error')
         return redirect(url_for('incidents.incidents'))
@@ -72,9 +84,9 @@ def editar_incidencia(inc_id):
         flash('Teléfono inválido — debe ser numérico de 9 dígitos o con prefijo +34/0034/34', 'error')
         return redirect(url_for('incidents.editar_incidencia', inc_id=inc_id))
 
-    db.execute('UPDATE incidencias SET imei=?, usuario=?, telefono=?, notas=? WHERE id=?',
-               (imei_digits, usuario, telefono, notas, inc_id))
-    db.commit()
+    with write_transaction() as db:
+        db.execute('UPDATE incidencias SET imei=?, usuario=?, telefono=?, notas=? WHERE id=?',
+                   (imei_digits, usuario, telefono, notas, inc_id))
     flash('Incidencia actualizada correctamente', 'success')
     return redirect(url_for('incidents.incidents'))
 
@@ -96,25 +108,22 @@ def export_incidents():
             rows = db.execute(
                 f'SELECT id, imei, usuario, telefono, notas, archivo_nombre, timestamp FROM incidencias WHERE id IN ({ph}) ORDER BY timestamp DESC',
                 id_list,
-            ).fetchall()
+            )
     else:
         query = 'SELECT id, imei, usuario, telefono, notas, archivo_nombre, timestamp FROM incidencias WHERE 1=1'
         params = []
-        if imei_search:
-            query += ' AND imei LIKE ?'; params.append(f'%{imei_search}%')
-        if usuario_search:
-            query += ' AND usuario LIKE ?'; params.append(f'%{usuario_search}%')
+        text_sql, text_params = search_filter('incidencias', {'imei': imei_search, 'usuario': usuario_search})
+        query += text_sql; params += text_params
         query += ' ORDER BY timestamp DESC'
-        rows = db.execute(query, params).fetchall()
+        rows = db.execute(query, params)
 
-    data = [[
+    data = ([
         r['imei'] or '', r['usuario'] or '', r['telefono'] or '',
         r['notas'] or '', r['archivo_nombre'] or '', r['timestamp'] or '',
-    ] for r in rows]
+    ] for r in rows)
 
-    bio = build_excel(['IMEI', 'Usuario', 'Teléfono', 'Notas', 'Archivo', 'Fecha (UTC)'], data)
-    return send_file(bio, as_attachment=True, download_name='incidencias.xlsx',
-                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return send_export(['IMEI', 'Usuario', 'Teléfono', 'Notas', 'Archivo', 'Fecha (UTC)'],
+                     data, 'incidencias')
 
 
 @incidents_bp.route('/incidents/delete-selected', methods=['POST'])
@@ -130,24 +139,56 @@ def delete_selected_incidents():
     if ids_param:
         id_list = [int(i) for i in ids_param.split(',') if i.strip().isdigit()]
         if id_list:
-            db = get_db()
             ph = ','.join(['?'] * len(id_list))
-            db.execute(f'DELETE FROM incidencias WHERE id IN ({ph})', id_list)
-            db.commit()
+            with write_transaction() as db:
+                hashes = [r[0] for r in db.execute(
+                    f'SELECT archivo_sha256 FROM incidencias WHERE id IN ({ph})', id_list).fetchall()]
+                db.execute(f'DELETE FROM incidencias WHERE id IN ({ph})', id_list)
+                remove_unreferenced_attachments(db, hashes)
 
     return redirect(url_for('incidents.incidents'))
 
 
+ATTACHMENT_MAX_AGE = 24 * 3600  # el adjunto de una incidencia no cambia nunca
+
+
 @incidents_bp.route('/incidents/download/<int:incident_id>')
 @require_permission('ver_incidencias')
 def download_incident_file(incident_id):
+    """Descarga el adjunto por bloques, con soporte de Range, ETag y Content-Length."""
     db = get_db()
-    incident = db.execute('SELECT * FROM incidencias WHERE id = ?', (incident_id,)).fetchone()
+    incident = db.execute(
+        'SELECT archivo_nombre, archivo_sha256, length(archivo_contenido) AS blob_len '
+        'FROM incidencias WHERE id = ?', (incident_id,)
+    ).fetchone()
     if not incident:
         return "Incidencia no encontrada", 404
 
-    return send_file(
-        io.BytesIO(incident['archivo_contenido']),
-        as_attachment=True,
-        download_name=incident['archivo_nombre'],
-    )
+    sha256 = incident['archivo_sha256']
+    if sha256:
+        # Copia en caché del navegador: ni siquiera se abre el fichero
+        if sha256 in request.if_none_match:
+            rv = Response(status=304)
+            rv.set_etag(sha256)
+        else:
+            path = attachment_path(sha256)
+            if not os.path.exists(path):
+                return "Archivo adjunto no encontrado", 404
+            rv = send_file(path, as_attachment=True, download_name=incident['archivo_nombre'],
+                           etag=sha256, conditional=True)
+    elif incident['blob_len'] is not None:
+        # Adjunto antiguo todavía en BLOB (init_db aún no lo ha migrado)
+        blob, length = open_blob('incidencias', 'archivo_contenido', incident_id)
+        rv = send_file(blob, as_attachment=True, download_name=incident['archivo_nombre'],
+                       conditional=False)
+        rv.content_length = length
+        rv.set_etag(f'blob-{incident_id}-{length}')
+        rv.make_conditional(request, accept_ranges=True, complete_length=length)
+    else:
+        return "La incidencia no tiene archivo adjunto", 404
+
+    rv.cache_control.no_cache = None
+    rv.cache_control.public = False
+    rv.cache_control.private = True
+    rv.cache_control.max_age = ATTACHMENT_MAX_AGE
+    return rv
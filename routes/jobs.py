@@ -0,0 +1,58 @@
+"""Blueprint de importaciones en segundo plano: página de resultado + API de progreso."""
+
+from flask import Blueprint, render_template, request, redirect, url_for, jsonify, abort
+from flask_login import login_required, current_user
+
+from jobs import get_job
+from models import get_db
+
+jobs_bp = Blueprint('jobs', __name__)
+
+
+def import_job_response(job_id):
+    """Respuesta de un endpoint de importación tras encolar el job.
+
+    Los clientes que piden JSON reciben el id (y la URL de progreso); el
+    formulario HTML se redirige a la página del job.
+    """
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(success=True, job_id=job_id,
+                       status_url=url_for('jobs.api_import_job', job_id=job_id)), 202
+    return redirect(url_for('jobs.import_job', job_id=job_id))
+
+
+def dry_run_requested():
+    """True si el formulario de importación pidió solo validar (botón ``dry_run``)."""
+    return request.values.get('dry_run', '').lower() in ('1', 'true', 'on')
+
+
+def _get_own_job(job_id):
+    """Job visible para el usuario actual (el que lo lanzó o un admin), o 404."""
+    job = get_job(get_db(), job_id)
+    if not job or (job['usuario'] != current_user.username
+                   and not current_user.tiene_permiso('administracion')):
+        abort(404)
+    return job
+
+
+@jobs_bp.route('/import_jobs/<int:job_id>')
+@login_required
+def import_job(job_id):
+    job = _get_own_job(job_id)
+    return render_template('import_result.html', job=job, inserted=job['insertadas'],
+                           errors=job['errores'], seconds=job['segundos'])
+
+
+@jobs_bp.route('/api/import_jobs/<int:job_id>')
+@login_required
+def api_import_job(job_id):
+    job = _get_own_job(job_id)
+    return jsonify(
+        success=True, id=job['id'], tipo=job['tipo'], archivo=job['archivo'],
+        estado=job['estado'], terminado=job['terminado'], simulacion=bool(job['simulacion']),
+        procesadas=job['procesadas'], insertadas=job['insertadas'],
+        actualizadas=job['actualizadas'], sin_cambios=job['sin_cambios'], upsert=job['upsert'],
+        num_errores=job['num_errores'], errores=job['errores'],
+        segundos=job['segundos'], filas_por_segundo=job['filas_por_segundo'],
+        volver=job['volver'],
+    )
@@ -7,11 +7,12 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from flask_login import login_required, current_user
 from datetime import datetime
 
-from models import get_db
+from models import write_transaction, dispositivo_disponible, TIPO_ENTREGA, TIPO_RECEPCION
 from routes._decorators import require_permission
 from utils import (
     format_phone, is_mitie_email, is_valid_imei,
     generate_entrega_pdf, send_validation_email_verbose,
+    spool_attachment, publish_attachment, discard_attachment, AttachmentTooLarge,
 )
 
 moviles_bp = Blueprint('moviles', __name__)
@@ -56,9 +57,8 @@ def api_send_email_otp():
             return jsonify(success=False, message='Email inválido'), 400
 
         codigo = f"{random.randint(100000, 999999)}"
-        db = get_db()
-        db.execute('INSERT INTO validaciones_email (email, codigo) VALUES (?, ?)', (email, codigo))
-        db.commit()
+        with write_transaction() as db:
+            db.execute('INSERT INTO validaciones_email (email, codigo) VALUES (?, ?)', (email, codigo))
 
         result = send_validation_email_verbose(email, codigo)
         if result['success']:
@@ -79,17 +79,17 @@ def api_verify_email_otp():
         email = (data.get('email') or '').strip()
         codigo = (data.get('codigo') or '').strip()
 
-        db = get_db()
-        row = db.execute('''
-            SELECT id FROM validaciones_email
-            WHERE email = ? AND codigo = ? AND usado = 0
-            AND timestamp >= datetime('now', '-30 minutes')
-            ORDER BY timestamp DESC LIMIT 1
-        ''', (email, codigo)).fetchone()
+        with write_transaction() as db:
+            row = db.execute('''
+                SELECT id FROM validaciones_email
+                WHERE email = ? AND codigo = ? AND usado = 0
+                AND timestamp >= datetime('now', '-30 minutes')
+                ORDER BY timestamp DESC LIMIT 1
+            ''', (email, codigo)).fetchone()
+            if row:
+                db.execute('UPDATE validaciones_email SET usado = 1 WHERE id = ?', (row['id'],))
 
         if row:
-            db.execute('UPDATE validaciones_email SET usado = 1 WHERE id = ?', (row['id'],))
-            db.commit()
             return jsonify(success=True)
 
         return jsonify(success=False, message='Código incorrecto o expirado'), 400
@@ -139,24 +139,21 @@ def entrega():
             flash(e, 'error')
         return redirect(url_for('main.index'))
 
-    db = get_db()
-
-    # Comprobar si el IMEI ya está entregado sin recepcionar
-    if imei:
-        last = db.execute(
-            'SELECT tipo FROM entregas WHERE imei = ? ORDER BY timestamp DESC LIMIT 1', (imei,)
-        ).fetchone()
-        if last and last['tipo'] == 'entrega':
-            flash(f'No se puede registrar la entrega: el dispositivo con IMEI {imei} no ha sido recepcionado aún.', 'error')
-            return redirect(url_for('main.index'))
-
-    db.execute(
-        'INSERT INTO entregas (situm, usuario, imei, telefono, notas_telefono, tipo, timestamp, codigo_validacion, email_usuario) VALUES (?,?,?,?,?,?,?,?,?)',
-        (situm, usuario, imei, telefono, notas_telefono, 'entrega', timestamp, codigo_otp, email_usuario),
-    )
-    db.commit()
+    # Comprobación + inserción en la misma transacción de escritura
+    with write_transaction() as db:
+        # Comprobar si el IMEI ya está entregado sin recepcionar
+        disponible = not imei or dispositivo_disponible(db, imei)
+        if disponible:
+            cur = db.execute(
+                'INSERT INTO entregas (situm, usuario, imei, telefono, notas_telefono, tipo, tipo_norm, timestamp, codigo_validacion, email_usuario) VALUES (?,?,?,?,?,?,?,?,?,?)',
+                (situm, usuario, imei, telefono, notas_telefono, 'entrega', TIPO_ENTREGA, timestamp, codigo_otp, email_usuario),
+            )
+    if not disponible:
+        flash(f'No se puede registrar la entrega: el dispositivo con IMEI {imei} no ha sido recepcionado aún.', 'error')
+        return redirect(url_for('main.index'))
 
-    pdf_buffer, pdf_filename = generate_entrega_pdf(situm, usuario, imei, telefono, notas_telefono, timestamp, codigo_otp)
+    pdf_buffer, pdf_filename = generate_entrega_pdf(situm, usuario, imei, telefono, notas_telefono, timestamp, codigo_otp,
+                                                    entrega_id=cur.lastrowid)
     return send_file(pdf_buffer, as_attachment=True, download_name=pdf_filename, mimetype='application/pdf')
 
 
@@ -176,12 +173,11 @@ def recepcion():
             flash(e, 'error')
         return redirect(url_for('main.index'))
 
-    db = get_db()
-    db.execute(
-        'INSERT INTO entregas (situm, usuario, imei, telefono, notas_telefono, tipo, timestamp) VALUES (?,?,?,?,?,?,?)',
-        (situm, usuario, imei, telefono, notas_telefono, 'recepcion', timestamp),
-    )
-    db.commit()
+    with write_transaction() as db:
+        db.execute(
+            'INSERT INTO entregas (situm, usuario, imei, telefono, notas_telefono, tipo, tipo_norm, timestamp) VALUES (?,?,?,?,?,?,?,?)',
+            (situm, usuario, imei, telefono, notas_telefono, 'recepcion', TIPO_RECEPCION, timestamp),
+        )
     return redirect(url_for('main.index'))
 
 
@@ -201,19 +197,29 @@ def incidencia():
         return redirect(url_for('main.index'))
 
     archivo_nombre = None
-    archivo_contenido = None
+    archivo_sha256 = None
+    archivo_tamano = None
+    spooled = None
     if 'archivo' in request.files and request.files['archivo'].filename != '':
         archivo = request.files['archivo']
         allowed = {'pdf', 'jpg', 'jpeg'}
         if '.' not in archivo.filename or archivo.filename.rsplit('.', 1)[1].lower() not in allowed:
             return redirect(url_for('main.index') + '?error=Invalid file type')
-        archivo_contenido = archivo.read()
+        try:
+            spooled = spool_attachment(archivo.stream)
+        except AttachmentTooLarge as e:
+            flash(str(e), 'error')
+            return redirect(url_for('main.index'))
         archivo_nombre = archivo.filename
+        archivo_sha256, archivo_tamano = spooled['sha256'], spooled['size']
 
-    db = get_db()
-    db.execute(
-        'INSERT INTO incidencias (imei, usuario, telefono, notas, archivo_nombre, archivo_contenido, timestamp) VALUES (?,?,?,?,?,?,?)',
-        (imei, usuario, telefono, notas, archivo_nombre, archivo_contenido, timestamp),
-    )
-    db.commit()
+    try:
+        # El fichero se publica con el bloqueo de escritura tomado (ver utils.publish_attachment)
+        with write_transaction() as db, publish_attachment(spooled):
+            db.execute(
+                'INSERT INTO incidencias (imei, usuario, telefono, notas, archivo_nombre, archivo_sha256, archivo_tamano, timestamp) VALUES (?,?,?,?,?,?,?,?)',
+                (imei, usuario, telefono, notas, archivo_nombre, archivo_sha256, archivo_tamano, timestamp),
+            )
+    finally:
+        discard_attachment(spooled)
     return redirect(url_for('main.index'))
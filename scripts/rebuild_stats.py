@@ -0,0 +1,30 @@
+"""Recalcula la tabla stats_counters del dashboard.
+
+Los contadores se mantienen por triggers; este script los recalcula desde
+cero si alguna herramienta externa los ha desincronizado.
+
+Ejecuta: python scripts/rebuild_stats.py
+"""
+
+import os
+import sqlite3
+import sys
+
+# Asegurar que el directorio raíz del proyecto está en sys.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import DB_PATH, get_stats_counters, init_db, rebuild_stats_counters
+
+
+def main():
+    init_db()
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    rebuild_stats_counters(conn)
+    conn.commit()
+    for clave, valor in get_stats_counters(conn).items():
+        print(f'{clave}: {valor}')
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""Comprueba init_db: migración completa, segundo arranque por la vía rápida y FTS activo en ambos."""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+# Asegurar que el directorio raíz del proyecto está en sys.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import models
+
+tmp = tempfile.mkdtemp()
+try:
+    models.DB_PATH = os.path.join(tmp, 'entregas.db')
+
+    # Primer arranque: BD nueva, se aplican todas las migraciones
+    models.init_db()
+    conn = sqlite3.connect(models.DB_PATH)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    conn.close()
+    print('Versión tras el primer arranque:', version, 'FTS:', models.FTS_ENABLED)
+    assert version == models.SCHEMA_VERSION
+    fts_esperado = models.FTS_ENABLED
+
+    # Segundo arranque (otro worker): vía rápida, el flag se decide igual
+    models.FTS_ENABLED = False
+    models.init_db()
+    print('FTS tras el segundo arranque:', models.FTS_ENABLED)
+    assert models.FTS_ENABLED == fts_esperado
+
+    # Con el SQLite de desarrollo (>= 3.34) la búsqueda debe ir por FTS
+    if sqlite3.sqlite_version_info >= (3, 34):
+        assert models.FTS_ENABLED
+    print('OK')
+finally:
+    shutil.rmtree(tmp)
@@ -0,0 +1,31 @@
+"""Comprueba que el PDF de entrega lleva el logo, con el XObject en caché y sin él."""
+import os
+import sys
+
+# Asegurar que el directorio raíz del proyecto está en sys.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+ARGS = ('S1', 'Tester', '350000000000000', '600000000', 'Nota', '2026-01-01T10:00:00', 'ABC123')
+
+logo = utils._get_pdf_template()['logo']
+assert logo, 'falta static/mitie_logo.png'
+
+# Con caché: el logo se incrusta una sola vez como imagen
+data = utils.render_entrega_pdf(*ARGS)
+print('Con caché:', len(data), 'bytes')
+assert data.startswith(b'%PDF-')
+assert data.count(b'/Subtype /Image') >= 1
+
+# Sin caché (API interna de reportlab distinta): se dibuja con drawImage
+xobj = logo['xobj']
+logo['xobj'] = object()  # cualquier fallo al registrarlo debe caer al camino sin caché
+try:
+    data = utils.render_entrega_pdf(*ARGS)
+finally:
+    logo['xobj'] = xobj
+print('Sin caché:', len(data), 'bytes')
+assert data.startswith(b'%PDF-')
+assert data.count(b'/Subtype /Image') >= 1
+assert not utils._LogoPDF.cache_ok
+print('OK')
@@ -233,6 +233,26 @@ document.addEventListener('DOMContentLoaded', function(){
     });
   }
 
+  // Botón "Descargar PDFs (ZIP)": los seleccionados o, si no hay, los del filtro actual
+  const pdfZipBtn = document.getElementById('pdf-zip-btn');
+  if(pdfZipBtn){
+    pdfZipBtn.addEventListener('click', function(e){
+      e.preventDefault();
+      const ids = [];
+      document.querySelectorAll('.row-select').forEach(function(cb){
+        if(cb.checked) ids.push(cb.value);
+      });
+      const url = pdfZipBtn.getAttribute('data-zip-url');
+      if(ids.length){
+        window.location.href = url + '?' + new URLSearchParams({ids: ids.join(',')}).toString();
+      } else {
+        const params = new URLSearchParams(window.location.search);
+        params.delete('cursor');
+        window.location.href = url + '?' + params.toString();
+      }
+    });
+  }
+
   // Botón "Borrar seleccionados"
   const deleteBtn = document.getElementById('delete-selected-btn');
   if(deleteBtn){
@@ -518,32 +538,6 @@ document.addEventListener('click', function(e){
 
 // Funcionalidad para la página Usuarios GTD SGPMR
 document.addEventListener('DOMContentLoaded', function(){
-  // Filtros combinados: Usuario SGPMR + Nombre y Apellidos
-  const filterSGPMR = document.getElementById('filter-usuario-sgpmr');
-  const filterNombre = document.getElementById('filter-nombre-apellidos');
-
-  function applyUsuariosFilters(){
-    const sgpmrValue = (filterSGPMR ? filterSGPMR.value : '').toLowerCase().trim();
-    const nombreValue = (filterNombre ? filterNombre.value : '').toLowerCase().trim();
-    const tableRows = document.querySelectorAll('table tbody tr');
-
-    tableRows.forEach(row => {
-      if(row.querySelector('td[colspan]')) return;
-      const sgpmrCell = row.querySelector('td:nth-child(3)'); // Usuario SGPMR
-      const nombreCell = row.querySelector('td:nth-child(4)'); // Nombre y Apellidos
-      const sgpmrText = sgpmrCell ? sgpmrCell.textContent.toLowerCase().trim() : '';
-      const nombreText = nombreCell ? nombreCell.textContent.toLowerCase().trim() : '';
-
-      const matchSGPMR = sgpmrValue === '' || sgpmrText.includes(sgpmrValue);
-      const matchNombre = nombreValue === '' || nombreText.includes(nombreValue);
-
-      row.style.display = (matchSGPMR && matchNombre) ? '' : 'none';
-    });
-  }
-
-  if(filterSGPMR) filterSGPMR.addEventListener('input', applyUsuariosFilters);
-  if(filterNombre) filterNombre.addEventListener('input', applyUsuariosFilters);
-
   // Select all checkbox
   const selectAllUsuarios = document.getElementById('select-all-usuarios-checkbox');
   if(selectAllUsuarios){
@@ -629,237 +623,56 @@ document.addEventListener('DOMContentLoaded', function(){
     });
   }
 
-  // Exportar usuarios a CSV
-  const exportBtn = document.getElementById('export-usuarios-btn');
-  if(exportBtn){
-    exportBtn.addEventListener('click', function(){
-      const table = document.querySelector('table');
-      if(!table) return;
-      
-      // Obtener encabezados (excluyendo checkbox y acciones)
-      const headers = [];
-      table.querySelectorAll('thead th').forEach((th, idx) => {
-        if(idx === 0 || idx === table.querySelectorAll('thead th').length - 1) return; // Skip checkbox y acciones
-        headers.push(th.textContent.trim());
-      });
-      
-      // Obtener filas
-      const rows = [];
-      table.querySelectorAll('tbody tr').forEach(tr => {
-        // Skip "no hay usuarios" row
-        if(tr.querySelector('td[colspan]')) return;
-        
-        const rowData = [];
-        tr.querySelectorAll('td').forEach((td, idx) => {
-          // Skip checkbox (idx 0) y acciones (última columna)
-          if(idx === 0 || idx === tr.querySelectorAll('td').length - 1) return;
-          rowData.push(td.textContent.trim());
-        });
-        if(rowData.length > 0) rows.push(rowData);
-      });
-      
-      // Crear CSV
-      let csv = headers.join(',') + '\n';
-      rows.forEach(row => {
-        // Escapar comillas en los valores
-        const escapedRow = row.map(cell => {
-          if(cell.includes(',') || cell.includes('"') || cell.includes('\n')){
-            return '"' + cell.replace(/"/g, '""') + '"';
-          }
-          return cell;
-        }).join(',');
-        csv += escapedRow + '\n';
-      });
-      
-      // Descargar archivo
-      const blob = new Blob([csv], { type: 'text/csv;charset=utf-8;' });
-      const link = document.createElement('a');
-      const url = URL.createObjectURL(blob);
-      link.setAttribute('href', url);
-      link.setAttribute('download', 'usuarios_gtd_sgpmr_' + new Date().toISOString().split('T')[0] + '.csv');
-      link.style.visibility = 'hidden';
-      document.body.appendChild(link);
-      link.click();
-      document.body.removeChild(link);
-    });
-  }
 });
-// Filtro por IMEI en la página de Inventario de Teléfonos
+// Listados paginados (usuarios GTD, inventario, datos de usuario): los filtros
+// se envían al servidor con debounce y se sustituyen las zonas marcadas con
+// data-live-region (filas, paginación...) por las de la respuesta.
 document.addEventListener('DOMContentLoaded', function(){
-  const filterInput = document.getElementById('filter-imei');
-  if(filterInput){
-    filterInput.addEventListener('input', function(){
-      const filterValue = this.value.toLowerCase().trim();
-      const tableRows = document.querySelectorAll('table tbody tr');
-      
-      tableRows.forEach(row => {
-        // Skip the "no hay teléfonos" row
-        if(row.querySelector('td[colspan]')) return;
-        
-        const imeiCell = row.querySelector('td:nth-child(2)'); // IMEI es la segunda columna
-        if(imeiCell){
-          const imeiValue = imeiCell.textContent.toLowerCase().trim();
-          if(filterValue === '' || imeiValue.includes(filterValue)){
-            row.style.display = '';
-          } else {
-            row.style.display = 'none';
-          }
-        }
-      });
+  document.querySelectorAll('form.live-filter').forEach(function(form){
+    let timer = null;
+    let controller = null;
+
+    function refresh(){
+      const params = new URLSearchParams(new FormData(form));
+      Array.from(params.keys()).forEach(function(k){ if(!params.get(k)) params.delete(k); });
+      const query = params.toString();
+      const url = form.getAttribute('action') + (query ? '?' + query : '');
+      if(controller) controller.abort();
+      controller = new AbortController();
+      fetch(url, { credentials: 'same-origin', signal: controller.signal })
+        .then(res => res.text())
+        .then(html => {
+          const doc = new DOMParser().parseFromString(html, 'text/html');
+          document.querySelectorAll('[data-live-region]').forEach(function(region){
+            const nueva = doc.getElementById(region.id);
+            if(nueva) region.replaceWith(nueva);
+          });
+          history.replaceState(null, '', url);
+        })
+        .catch(() => {});
+    }
+
+    form.addEventListener('input', function(){
+      clearTimeout(timer);
+      timer = setTimeout(refresh, 300);
     });
-  }
+    form.addEventListener('submit', function(e){
+      e.preventDefault();
+      clearTimeout(timer);
+      refresh();
+    });
+  });
 
-  // Exportar tabla a CSV
-  const exportBtn = document.getElementById('export-btn');
-  if(exportBtn){
-    exportBtn.addEventListener('click', function(){
-      const table = document.querySelector('table');
-      if(!table) return;
-      
-      // Obtener encabezados (excluyendo checkbox y acciones)
-      const headers = [];
-      table.querySelectorAll('thead th').forEach((th, idx) => {
-        if(idx === 0 || idx === table.querySelectorAll('thead th').length - 1) return; // Skip checkbox y acciones
-        headers.push(th.textContent.trim());
-      });
-      
-      // Obtener filas visibles
-      const rows = [];
-      table.querySelectorAll('tbody tr').forEach(tr => {
-        // Skip "no hay teléfonos" row y filas ocultas por filtro
-        if(tr.querySelector('td[colspan]') || tr.style.display === 'none') return;
-        
-        const rowData = [];
-        tr.querySelectorAll('td').forEach((td, idx) => {
-          // Skip checkbox (idx 0) y acciones (última columna)
-          if(idx === 0 || idx === tr.querySelectorAll('td').length - 1) return;
-          rowData.push(td.textContent.trim());
-        });
-        if(rowData.length > 0) rows.push(rowData);
-      });
-      
-      // Crear CSV
-      let csv = headers.join(',') + '\n';
-      rows.forEach(row => {
-        // Escapar comillas en los valores
-        const escapedRow = row.map(cell => {
-          if(cell.includes(',') || cell.includes('"') || cell.includes('\n')){
-            return '"' + cell.replace(/"/g, '""') + '"';
-          }
-          return cell;
-        }).join(',');
-        csv += escapedRow + '\n';
-      });
-      
-      // Descargar archivo
-      const blob = new Blob([csv], { type: 'text/csv;charset=utf-8;' });
-      const link = document.createElement('a');
-      const url = URL.createObjectURL(blob);
-      link.setAttribute('href', url);
-      link.setAttribute('download', 'inventario_telefonos_' + new Date().toISOString().split('T')[0] + '.csv');
-      link.style.visibility = 'hidden';
-      document.body.appendChild(link);
-      link.click();
-      document.body.removeChild(link);
+  // Exportar: el servidor exporta el listado completo con los filtros actuales
+  document.querySelectorAll('[data-export-url]').forEach(function(btn){
+    btn.addEventListener('click', function(){
+      window.location.href = btn.getAttribute('data-export-url') + window.location.search;
     });
-  }
+  });
 });
 
 // Funcionalidad para la página Datos de Usuario
 document.addEventListener('DOMContentLoaded', function(){
-  // Filtros combinados: DNI + Apellidos y Nombre + Notas
-  const filterDNI = document.getElementById('filter-datos-dni');
-  const filterNombre = document.getElementById('filter-datos-nombre');
-  const filterNotas = document.getElementById('filter-datos-notas');
-
-  function applyDatosUsuarioFilters(){
-    const dniValue = (filterDNI ? filterDNI.value : '').toLowerCase().trim();
-    const nombreValue = (filterNombre ? filterNombre.value : '').toLowerCase().trim();
-    const notasValue = (filterNotas ? filterNotas.value : '').toLowerCase().trim();
-    const tableRows = document.querySelectorAll('table tbody tr');
-
-    tableRows.forEach(row => {
-      if(row.querySelector('td[colspan]')) return;
-      const dniCell = row.querySelector('td:nth-child(2)');
-      const nombreCell = row.querySelector('td:nth-child(3)');
-      const notasCell = row.querySelector('td:nth-child(7)');
-      const dniText = dniCell ? dniCell.textContent.toLowerCase().trim() : '';
-      const nombreText = nombreCell ? nombreCell.textContent.toLowerCase().trim() : '';
-      const notasText = notasCell ? notasCell.textContent.toLowerCase().trim() : '';
-
-      const matchDNI = dniValue === '' || dniText.includes(dniValue);
-      const matchNombre = nombreValue === '' || nombreText.includes(nombreValue);
-      const matchNotas = notasValue === '' || notasText.includes(notasValue);
-
-      row.style.display = (matchDNI && matchNombre && matchNotas) ? '' : 'none';
-    });
-  }
-
-  if(filterDNI) filterDNI.addEventListener('input', applyDatosUsuarioFilters);
-  if(filterNombre) filterNombre.addEventListener('input', applyDatosUsuarioFilters);
-  if(filterNotas) filterNotas.addEventListener('input', applyDatosUsuarioFilters);
-
-  // ── Ordenación por columnas ──
-  (function(){
-    const sortableHeaders = document.querySelectorAll('th.sortable');
-    if(!sortableHeaders.length) return;
-
-    let currentSortCol = null;
-    let currentSortDir = 'asc';
-
-    sortableHeaders.forEach(function(th){
-      th.addEventListener('click', function(){
-        const colIndex = parseInt(th.getAttribute('data-col'));
-        const isDate = th.getAttribute('data-type') === 'date';
-
-        // Determinar dirección
-        if(currentSortCol === colIndex){
-          currentSortDir = currentSortDir === 'asc' ? 'desc' : 'asc';
-        } else {
-          currentSortCol = colIndex;
-          currentSortDir = 'asc';
-        }
-
-        // Actualizar flechas
-        sortableHeaders.forEach(function(h){
-          var arrow = h.querySelector('.sort-arrow');
-          if(arrow) arrow.textContent = '';
-        });
-        var activeArrow = th.querySelector('.sort-arrow');
-        if(activeArrow) activeArrow.textContent = currentSortDir === 'asc' ? ' ▲' : ' ▼';
-
-        // Obtener filas y ordenar
-        var tbody = document.querySelector('table tbody');
-        if(!tbody) return;
-        var rows = Array.from(tbody.querySelectorAll('tr'));
-        // Excluir fila de "No hay registros"
-        var dataRows = rows.filter(function(r){ return !r.querySelector('td[colspan]'); });
-
-        dataRows.sort(function(a, b){
-          var cellA = a.querySelectorAll('td')[colIndex];
-          var cellB = b.querySelectorAll('td')[colIndex];
-          var textA = cellA ? cellA.textContent.trim().toLowerCase() : '';
-          var textB = cellB ? cellB.textContent.trim().toLowerCase() : '';
-
-          if(isDate){
-            // Parsear fecha dd/mm/yyyy o yyyy-mm-dd
-            var dA = textA === '-' ? 0 : new Date(textA.split('/').reverse().join('-')).getTime() || new Date(textA).getTime() || 0;
-            var dB = textB === '-' ? 0 : new Date(textB.split('/').reverse().join('-')).getTime() || new Date(textB).getTime() || 0;
-            return currentSortDir === 'asc' ? dA - dB : dB - dA;
-          }
-
-          if(textA === '-') textA = '';
-          if(textB === '-') textB = '';
-          var cmp = textA.localeCompare(textB, 'es', {numeric: true, sensitivity: 'base'});
-          return currentSortDir === 'asc' ? cmp : -cmp;
-        });
-
-        // Reinsertar filas ordenadas
-        dataRows.forEach(function(r){ tbody.appendChild(r); });
-      });
-    });
-  })();
-
   // Select all checkbox
   const selectAllDatos = document.getElementById('select-all-datos-usuario-checkbox');
   if(selectAllDatos){
@@ -941,3 +754,117 @@ document.addEventListener('click', function(e){
     });
   }
 });
+
+// Tabla con scroll virtual sobre /api/<recurso> (ver templates/lista_virtual.html).
+// Solo se pintan las filas visibles (más un margen); los bloques se piden a la
+// API por cursor a medida que el scroll se acerca al final de lo cargado.
+function initVirtualTable(root){
+  const apiUrl = root.dataset.apiUrl;
+  const columns = JSON.parse(root.dataset.columns);  // [[campo, cabecera], ...]
+  const form = document.getElementById(root.dataset.filterForm);
+  const status = document.getElementById(root.dataset.status);
+  const header = root.querySelector('.vt-header');
+  const viewport = root.querySelector('.vt-viewport');
+  const spacer = root.querySelector('.vt-spacer');
+  const ROW_HEIGHT = 36;
+  const OVERSCAN = 10;   // filas extra por encima/debajo de la zona visible
+  const BLOCK = 200;     // filas por petición
+
+  let rows = [];
+  let nextCursor = null;
+  let total = null;
+  let totalAprox = false;
+  let loading = false;
+  let generation = 0;    // descarta respuestas de filtros anteriores
+  let controller = null;
+  let frame = null;
+
+  const template = 'repeat(' + columns.length + ', minmax(120px, 1fr))';
+  header.style.gridTemplateColumns = template;
+  header.innerHTML = columns.map(c => '<div>' + escapeHtml(c[1]) + '</div>').join('');
+
+  function escapeHtml(value){
+    return String(value).replace(/[&<>"']/g, ch => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[ch]));
+  }
+
+  function filterParams(){
+    const params = new URLSearchParams(form ? new FormData(form) : undefined);
+    Array.from(params.keys()).forEach(function(k){ if(!params.get(k)) params.delete(k); });
+    return params;
+  }
+
+  function updateStatus(){
+    if(!status) return;
+    if(total === null){ status.textContent = loading ? 'Cargando…' : ''; return; }
+    status.textContent = rows.length + ' de ' + (totalAprox ? 'más de ' : '') + total + ' registros cargados';
+  }
+
+  function load(){
+    if(loading || (rows.length && !nextCursor)) return;
+    loading = true;
+    const gen = generation;
+    const params = filterParams();
+    params.set('fields', columns.map(c => c[0]).join(','));
+    params.set('limit', BLOCK);
+    if(nextCursor) params.set('cursor', nextCursor);
+    controller = new AbortController();
+    fetch(apiUrl + '?' + params.toString(), { credentials: 'same-origin', signal: controller.signal })
+      .then(res => res.json())
+      .then(data => {
+        if(gen !== generation) return;
+        loading = false;
+        if(!data.success) { if(status) status.textContent = data.error || 'Error'; return; }
+        rows = rows.concat(data.rows);
+        nextCursor = data.next_cursor;
+        if(data.total !== null){ total = data.total; totalAprox = data.total_aprox; }
+        updateStatus();
+        render();
+      })
+      .catch(() => { if(gen === generation) loading = false; });
+    updateStatus();
+  }
+
+  function render(){
+    frame = null;
+    spacer.style.height = ((rows.length + (nextCursor ? 1 : 0)) * ROW_HEIGHT) + 'px';
+    const first = Math.max(0, Math.floor(viewport.scrollTop / ROW_HEIGHT) - OVERSCAN);
+    const last = Math.min(rows.length, Math.ceil((viewport.scrollTop + viewport.clientHeight) / ROW_HEIGHT) + OVERSCAN);
+    let html = '';
+    for(let i = first; i < last; i++){
+      html += '<div class="vt-row" style="top:' + (i * ROW_HEIGHT) + 'px;grid-template-columns:' + template + '">';
+      columns.forEach(function(c){
+        const value = rows[i][c[0]];
+        html += '<div>' + (value === null || value === '' ? '-' : escapeHtml(value)) + '</div>';
+      });
+      html += '</div>';
+    }
+    if(!rows.length && !loading && total === 0) html = '<div class="vt-empty">No hay registros</div>';
+    spacer.innerHTML = html;
+    if(nextCursor && last >= rows.length - OVERSCAN) load();
+  }
+
+  function reset(){
+    generation++;
+    if(controller) controller.abort();
+    rows = []; nextCursor = null; total = null; loading = false;
+    viewport.scrollTop = 0;
+    const query = filterParams().toString();
+    history.replaceState(null, '', window.location.pathname + (query ? '?' + query : ''));
+    load();
+  }
+
+  viewport.addEventListener('scroll', function(){
+    if(!frame) frame = requestAnimationFrame(render);
+  });
+  if(form){
+    let timer = null;
+    form.addEventListener('input', function(){ clearTimeout(timer); timer = setTimeout(reset, 300); });
+    form.addEventListener('change', function(){ clearTimeout(timer); timer = setTimeout(reset, 300); });
+    form.addEventListener('submit', function(e){ e.preventDefault(); clearTimeout(timer); reset(); });
+  }
+  load();
+}
+
+document.addEventListener('DOMContentLoaded', function(){
+  document.querySelectorAll('.virtual-table').forEach(initVirtualTable);
+});
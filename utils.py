@@ -1,25 +1,42 @@
 """Funciones de utilidad compartidas: validación, email, PDF, importación y paginación."""
 
+import atexit
+import base64
+import codecs
+import copy
 import csv
+import hashlib
 import io
+import json
+import logging
 import math
+import multiprocessing
 import os
+import queue
 import random
 import re
 import smtplib
+import sqlite3
 import ssl
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-from flask import request
+from flask import Response, current_app, jsonify, request, send_file
 from openpyxl import Workbook, load_workbook
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 from reportlab.lib.units import inch
 from reportlab.lib.utils import ImageReader
-from reportlab.platypus import Image, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+from reportlab.platypus import Flowable, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -27,6 +44,11 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Validación
 # ---------------------------------------------------------------------------
 
+_RE_NO_DIGITO = re.compile(r'\D')
+_RE_MITIE_EMAIL = re.compile(r'^[A-Za-z0-9._%+-]+@mitie\.es$', re.IGNORECASE)
+_RE_IMEI = re.compile(r'^\d{15}$')
+
+
 def format_phone(phone):
     """Normaliza teléfono: devuelve solo dígitos (9 dígitos nacionales).
 
@@ -35,7 +57,7 @@ def format_phone(phone):
     if not phone:
         return ''
     phone = str(phone).strip()
-    digits = re.sub(r'\D', '', phone)
+    digits = _RE_NO_DIGITO.sub('', phone)
     if not digits:
         return None
     if len(digits) == 9:
@@ -52,13 +74,28 @@ def format_phone(phone):
 def is_mitie_email(addr: str) -> bool:
     if not addr:
         return False
-    return bool(re.match(r'^[A-Za-z0-9._%+-]+@mitie\.es$', addr.strip(), re.IGNORECASE))
+    return bool(_RE_MITIE_EMAIL.match(addr.strip()))
 
 
 def is_valid_imei(imei: str) -> bool:
     if not imei:
         return False
-    return bool(re.match(r'^\d{15}$', imei.strip()))
+    return bool(_RE_IMEI.match(imei.strip()))
+
+
+# Validadores de columna completa para el modo simulación de las
+# importaciones (ver dry_run_import).  Reciben la lista de valores de la
+# columna y devuelven [(posición, aviso)].  Cada valor distinto se valida
+# una sola vez: en los ficheros reales los valores se repiten mucho.
+
+def check_imei_column(values):
+    malos = {v for v in set(values) if v and not is_valid_imei(str(v))}
+    return [(i, f'IMEI "{v}" no tiene 15 dígitos') for i, v in enumerate(values) if v in malos]
+
+
+def check_phone_column(values):
+    malos = {v for v in set(values) if v and format_phone(v) is None}
+    return [(i, f'teléfono "{v}" no es válido') for i, v in enumerate(values) if v in malos]
 
 
 # ---------------------------------------------------------------------------
@@ -135,43 +172,161 @@ Por consiguiente:
 """
 
 
-def generate_entrega_pdf(situm, usuario, imei, telefono, notas, timestamp, codigo_validacion=None):
-    """Genera PDF de entrega y devuelve (buffer, filename)."""
-    pdf_buffer = io.BytesIO()
-    doc = SimpleDocTemplate(pdf_buffer, pagesize=letter, topMargin=0.5 * inch, bottomMargin=0.5 * inch)
+_PDF_PAGESIZE = letter
+_PDF_MARGIN = 0.5 * inch
+_PDF_LOGO_PX = 600        # ancho en píxeles del logo embebido (≈300 ppp a 2 pulgadas)
+_PDF_LOGO_KEY = 'mitie_logo'  # nombre del XObject del logo (ver _LogoPDF)
 
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle('CustomTitle', parent=styles['Heading1'],
-                                 fontSize=14, textColor=colors.HexColor('#333333'),
-                                 spaceAfter=12, alignment=1)
-    normal_style = ParagraphStyle('CustomNormal', parent=styles['Normal'],
-                                  fontSize=9, leading=11, spaceAfter=6)
+_pdf_template = None
+_pdf_template_lock = threading.Lock()
 
-    elements = []
 
-    # Logo
+class _LogoPDF(Flowable):
+    """Logo del PDF de entrega con el XObject de imagen ya codificado.
+
+    Decodificar, comprimir y pasar a ASCII85 el PNG es casi todo el coste de
+    un PDF de entrega; aquí se hace una vez por proceso y en cada documento
+    solo se registra una copia del XObject con el nombre que usaría
+    ``canvas.drawImage``, que así lo reutiliza en vez de recrearlo.
+
+    Eso usa la API interna de reportlab: si falla por cualquier motivo (otra
+    versión de reportlab) el logo se dibuja con ``drawImage`` sin caché y no
+    se vuelve a intentar en este proceso.
+    """
+
+    cache_ok = True
+
+    def __init__(self, xobj, png, width, height):
+        super().__init__()
+        self.xobj, self.png = xobj, png
+        self.width, self.height = width, height
+        self.hAlign = 'CENTER'
+
+    def wrap(self, avail_width, avail_height):
+        return self.width, self.height
+
+    def draw(self):
+        canv = self.canv
+        if self.xobj is not None and _LogoPDF.cache_ok:
+            try:
+                self._draw_cached(canv)
+                return
+            except Exception:
+                _LogoPDF.cache_ok = False
+                logging.getLogger(__name__).warning(
+                    'Logo del PDF sin caché: la API interna de reportlab no es la esperada', exc_info=True)
+        canv.drawImage(ImageReader(io.BytesIO(self.png)), 0, 0, self.width, self.height, mask='auto')
+
+    def _draw_cached(self, canv):
+        doc = canv._doc
+        reg_name = doc.getXObjectName(self.xobj.name)
+        if reg_name not in doc.idToObject:
+            xobj = copy.copy(self.xobj)
+            smask = xobj.__dict__.pop('_smask', None)
+            canv._setXObjects(xobj)
+            doc.Reference(xobj, reg_name)
+            doc.addForm(xobj.name, xobj)
+            if smask:
+                smask = copy.copy(smask)
+                canv._setXObjects(smask)
+                xobj.smask = doc.Reference(smask, doc.getXObjectName(smask.name))
+        canv.drawImage(_PDF_LOGO_KEY, 0, 0, self.width, self.height, mask='auto')
+
+
+def _build_logo(usable_height):
+    """Logo reducido a ``_PDF_LOGO_PX`` y su XObject codificado, o None si no hay logo.
+
+    Sin el XObject (``xobj`` None: reportlab con otra API interna) el logo
+    se dibuja igualmente, sin caché.
+    """
+    from PIL import Image as PILImage
+
     logo_path = os.path.join(BASE_DIR, 'static', 'mitie_logo.png')
-    if os.path.exists(logo_path):
+    if not os.path.exists(logo_path):
+        return None
+    try:
+        with PILImage.open(logo_path) as im:
+            img_w, img_h = im.size
+            if img_w > _PDF_LOGO_PX:
+                im = im.resize((_PDF_LOGO_PX, max(1, round(img_h * _PDF_LOGO_PX / img_w))), PILImage.LANCZOS)
+            buf = io.BytesIO()
+            im.save(buf, 'PNG')
+        png = buf.getvalue()
+        desired_width = 2 * inch
+        desired_height = desired_width * (float(img_h) / float(img_w)) if img_w else desired_width * 0.5
+        max_height = usable_height * 0.25
+        if desired_height > max_height:
+            scale = max_height / desired_height
+            desired_width *= scale
+            desired_height = max_height
         try:
-            img_reader = ImageReader(logo_path)
-            img_w, img_h = img_reader.getSize()
-            desired_width = 2 * inch
-            desired_height = desired_width * (float(img_h) / float(img_w)) if img_w else desired_width * 0.5
-            page_height = doc.pagesize[1]
-            usable_height = page_height - doc.topMargin - doc.bottomMargin
-            max_height = usable_height * 0.25
-            if desired_height > max_height:
-                scale = max_height / desired_height
-                desired_width *= scale
-                desired_height = max_height
-            logo = Image(logo_path, width=desired_width, height=desired_height)
-            logo.hAlign = 'CENTER'
-            elements.append(logo)
-            elements.append(Spacer(1, 0.15 * inch))
+            from reportlab.lib.utils import _digester
+            from reportlab.pdfbase.pdfdoc import PDFImageXObject
+            xobj = PDFImageXObject(_digester(f'{_PDF_LOGO_KEY}auto'), ImageReader(io.BytesIO(png)), mask='auto')
         except Exception:
-            pass
+            xobj = None
+        return {'xobj': xobj, 'png': png, 'width': desired_width, 'height': desired_height}
+    except Exception:
+        return None
+
+
+def _get_pdf_template():
+    """Partes fijas del PDF de entrega, construidas una vez por proceso.
+
+    Estilos, logo ya codificado y párrafos fijos (con el texto de la
+    comunicación ya parseado).  Los flowables no se comparten entre
+    documentos: cada PDF usa copias (ver :func:`generate_entrega_pdf`).
+    """
+    global _pdf_template
+    with _pdf_template_lock:
+        if _pdf_template is None:
+            styles = getSampleStyleSheet()
+            title_style = ParagraphStyle('CustomTitle', parent=styles['Heading1'],
+                                         fontSize=14, textColor=colors.HexColor('#333333'),
+                                         spaceAfter=12, alignment=1)
+            normal_style = ParagraphStyle('CustomNormal', parent=styles['Normal'],
+                                          fontSize=9, leading=11, spaceAfter=6)
+            _pdf_template = {
+                'normal_style': normal_style,
+                'table_style': TableStyle([
+                    ('BACKGROUND', (0, 0), (1, 0), colors.HexColor('#4CAF50')),
+                    ('TEXTCOLOR', (0, 0), (1, 0), colors.HexColor('#ffffff')),
+                    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+                    ('FONTNAME', (0, 0), (1, 0), 'Helvetica-Bold'),
+                    ('FONTSIZE', (0, 0), (1, 0), 11),
+                    ('BOTTOMPADDING', (0, 0), (1, 0), 10),
+                    ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+                    ('FONTSIZE', (0, 1), (-1, -1), 9),
+                    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f0f0f0')]),
+                ]),
+                'logo': _build_logo(_PDF_PAGESIZE[1] - 2 * _PDF_MARGIN),
+                'titulo': Paragraph("REGISTRO DE ENTREGA DIGITAL", title_style),
+                'titulo_comunicacion': Paragraph("COMUNICACIÓN SOBRE SISTEMA DE GEOLOCALIZACIÓN", title_style),
+                'comunicacion': Paragraph(_TEXTO_COMUNICACION, normal_style),
+            }
+        return _pdf_template
+
+
+def render_entrega_pdf(situm, usuario, imei, telefono, notas, timestamp, codigo_validacion=None):
+    """Maqueta el PDF de entrega y devuelve sus bytes (sin archivarlo).
+
+    Solo la tabla de datos y la firma se construyen por documento; el resto
+    sale de :func:`_get_pdf_template`.
+    """
+    tpl = _get_pdf_template()
+    normal_style = tpl['normal_style']
+    pdf_buffer = io.BytesIO()
+    doc = SimpleDocTemplate(pdf_buffer, pagesize=_PDF_PAGESIZE, topMargin=_PDF_MARGIN, bottomMargin=_PDF_MARGIN)
+
+    elements = []
 
-    elements.append(Paragraph("REGISTRO DE ENTREGA DIGITAL", title_style))
+    # Logo
+    logo = tpl['logo']
+    if logo:
+        elements.append(_LogoPDF(logo['xobj'], logo['png'], logo['width'], logo['height']))
+        elements.append(Spacer(1, 0.15 * inch))
+
+    elements.append(copy.copy(tpl['titulo']))
     elements.append(Spacer(1, 0.2 * inch))
 
     data = [
@@ -184,23 +339,13 @@ def generate_entrega_pdf(situm, usuario, imei, telefono, notas, timestamp, codig
         ['Fecha', timestamp[:10] if timestamp else ''],
     ]
     table = Table(data, colWidths=[1.5 * inch, 4 * inch])
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (1, 0), colors.HexColor('#4CAF50')),
-        ('TEXTCOLOR', (0, 0), (1, 0), colors.HexColor('#ffffff')),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (1, 0), 11),
-        ('BOTTOMPADDING', (0, 0), (1, 0), 10),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ('FONTSIZE', (0, 1), (-1, -1), 9),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f0f0f0')]),
-    ]))
+    table.setStyle(tpl['table_style'])
     elements.append(table)
     elements.append(Spacer(1, 0.3 * inch))
 
-    elements.append(Paragraph("COMUNICACIÓN SOBRE SISTEMA DE GEOLOCALIZACIÓN", title_style))
+    elements.append(copy.copy(tpl['titulo_comunicacion']))
     elements.append(Spacer(1, 0.1 * inch))
-    elements.append(Paragraph(_TEXTO_COMUNICACION, normal_style))
+    elements.append(copy.copy(tpl['comunicacion']))
     elements.append(Spacer(1, 0.3 * inch))
 
     if codigo_validacion:
@@ -209,67 +354,734 @@ def generate_entrega_pdf(situm, usuario, imei, telefono, notas, timestamp, codig
         elements.append(Spacer(1, 0.2 * inch))
 
     doc.build(elements)
-    pdf_buffer.seek(0)
+    return pdf_buffer.getvalue()
+
+
+def generate_entrega_pdf(situm, usuario, imei, telefono, notas, timestamp, codigo_validacion=None,
+                         entrega_id=None):
+    """Genera PDF de entrega, encola su copia de servidor y devuelve (buffer, filename).
+
+    Con *entrega_id* la copia queda registrada en ``pdf_archivo`` (en cuanto
+    está en disco) para poder descargarla más tarde sin regenerarla.
+    """
+    data = render_entrega_pdf(situm, usuario, imei, telefono, notas, timestamp, codigo_validacion)
+    ruta = archived_pdf_path(imei, datetime.utcnow(), entrega_id)
+
+    # La copia del servidor la escribe el hilo de archivo; los mismos bytes
+    # (inmutables, sin copiar) sirven para la respuesta
+    archive_pdf(ruta, data, entrega_id=entrega_id)
+    return io.BytesIO(data), os.path.basename(ruta)
+
+
+# ---------------------------------------------------------------------------
+# Archivo de PDFs en segundo plano
+# ---------------------------------------------------------------------------
+
+PDF_ENTREGAS_DIR = os.path.join(BASE_DIR, 'pdfs', 'entregas')
+PDF_ARCHIVE_QUEUE_MAX = 64   # PDFs pendientes de escribir; con la cola llena se escribe en la petición
+PDF_ARCHIVE_BATCH = 16       # PDFs por lote de fsync
+
+_archive_queue = queue.Queue(maxsize=PDF_ARCHIVE_QUEUE_MAX)
+_archive_thread = None
+_archive_lock = threading.Lock()
+_archive_log = logging.getLogger(__name__)
+
+
+def archive_pdf(ruta, data, directory=PDF_ENTREGAS_DIR, entrega_id=None):
+    """Encola la copia de servidor de un PDF (``directory/ruta``, ver :func:`archived_pdf_path`).
+
+    La escribe un hilo dedicado (ver :func:`_archive_worker`), así que la
+    petición no espera al disco.  Si la cola está llena (disco lento o
+    caído) se escribe aquí mismo: se frena la petición pero no se pierde
+    la copia.  Con *entrega_id* la copia se registra en ``pdf_archivo``
+    solo después de quedar escrita con su nombre definitivo.
+    """
+    _start_archive_thread()
+    item = (directory, ruta, data, entrega_id)
+    try:
+        _archive_queue.put_nowait(item)
+    except queue.Full:
+        _write_archive_batch([item])
+
+
+def flush_pdf_archive(timeout=None):
+    """Espera a que se escriban los PDFs encolados (tests, parada del proceso)."""
+    if _archive_thread is None:
+        return
+    done = threading.Event()
+    _archive_queue.put(done)
+    done.wait(timeout)
+
+
+def _start_archive_thread():
+    global _archive_thread
+    with _archive_lock:
+        if _archive_thread is None:
+            atexit.register(flush_pdf_archive, 10)
+        if _archive_thread is None or not _archive_thread.is_alive():
+            _archive_thread = threading.Thread(target=_archive_worker, name='pdf-archive', daemon=True)
+            _archive_thread.start()
+
+
+def _archive_worker():
+    """Cuerpo del hilo: agrupa lo que haya en la cola y lo escribe en lotes."""
+    while True:
+        items = [_archive_queue.get()]
+        while len(items) < PDF_ARCHIVE_BATCH:
+            try:
+                items.append(_archive_queue.get_nowait())
+            except queue.Empty:
+                break
+        _write_archive_batch([i for i in items if isinstance(i, tuple)])
+        for i in items:
+            if isinstance(i, threading.Event):
+                i.set()
+
+
+def _write_archive_batch(items):
+    """Escribe un lote de PDFs con renombrado atómico.
+
+    Cada PDF va a un temporal oculto de su directorio; tras escribir el
+    lote completo se hace fsync de los ficheros, se renombran a su nombre
+    final y se hace un único fsync por directorio.  Así nunca queda un PDF
+    a medias con el nombre definitivo y el coste del fsync (alto en NFS) se
+    reparte entre todo el lote.  Al final se indexan en ``pdf_archivo``, en
+    una transacción, los PDFs del lote que llevan entrega y se escribieron.
+    """
+    pendientes = []
+    for directory, ruta, data, entrega_id in items:
+        try:
+            final_path = archived_pdf_file(ruta, directory)
+        except ValueError:
+            _archive_log.exception('PDF no archivado')
+            continue
+        try:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(final_path), prefix='.archivo-', suffix='.pdf')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            pendientes.append((tmp_path, final_path, (entrega_id, ruta, data)))
+        except OSError:
+            _archive_log.exception('No se pudo archivar el PDF %s', final_path)
+    directorios = set()
+    escritos = []
+    for tmp_path, final_path, indice in pendientes:
+        try:
+            fd = os.open(tmp_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, final_path)
+            directorios.add(os.path.dirname(final_path))
+            if indice[0] is not None:
+                escritos.append(indice)
+        except OSError:
+            _archive_log.exception('No se pudo archivar el PDF %s', final_path)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    for directory in directorios:
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass  # algunos sistemas no admiten fsync de directorios
+        finally:
+            os.close(fd)
+    if escritos:
+        _index_written_pdfs(escritos)
+
+
+def _index_written_pdfs(escritos):
+    """Registra en ``pdf_archivo`` los ``(entrega_id, ruta, bytes)`` ya escritos.
+
+    Usa su propia conexión del pool: el hilo de archivo no tiene petición.
+    """
+    from models import get_pool, write_transaction
+    db = get_pool().acquire()
+    try:
+        with write_transaction(db):
+            for entrega_id, ruta, data in escritos:
+                index_archived_pdf(db, entrega_id, ruta, data)
+    except sqlite3.Error:
+        _archive_log.exception('No se pudieron indexar %d PDFs archivados', len(escritos))
+    finally:
+        db.close()
+
+
+# ---------------------------------------------------------------------------
+# Índice de PDFs archivados (tabla pdf_archivo)
+# ---------------------------------------------------------------------------
+
+_RE_NOMBRE_INSEGURO = re.compile(r'[^0-9A-Za-z_-]')
+
+
+def archived_pdf_name(imei, when, entrega_id=None):
+    """Nombre de la copia archivada del PDF de *imei* generado en *when* (UTC).
+
+    El IMEI viene de las importaciones sin validar, así que solo se conservan
+    letras, dígitos, ``_`` y ``-``; con *entrega_id* el nombre empieza por el
+    id de la entrega.
+    """
+    nombre = _RE_NOMBRE_INSEGURO.sub('_', imei or '')
+    if entrega_id is not None:
+        nombre = f'{int(entrega_id)}_{nombre}'
+    return f"entrega_{nombre}_{when.strftime('%Y%m%d_%H%M%S')}.pdf"
+
+
+def archived_pdf_file(ruta, directory=PDF_ENTREGAS_DIR):
+    """Ruta absoluta de la copia archivada *ruta*.
+
+    Lanza ``ValueError`` si *ruta* sale de *directory* (``..``, rutas
+    absolutas o enlaces simbólicos).
+    """
+    root = os.path.realpath(directory)
+    path = os.path.realpath(os.path.join(root, ruta))
+    if os.path.commonpath([root, path]) != root or path == root:
+        raise ValueError(f'Ruta de PDF fuera del archivo: {ruta!r}')
+    return path
+
+
+def archived_pdf_path(imei, when, entrega_id=None):
+    """Ruta, relativa a ``PDF_ENTREGAS_DIR``, de la copia archivada: ``AAAA/MM/nombre``.
+
+    Repartir por año y mes evita un único directorio con decenas de miles
+    de ficheros.
+    """
+    return f"{when:%Y}/{when:%m}/{archived_pdf_name(imei, when, entrega_id)}"
+
+
+def index_archived_pdf(db, entrega_id, ruta, data):
+    """Registra (o sustituye) en ``pdf_archivo`` la copia archivada de una entrega.
+
+    No hace commit: lo hace quien llama.
+    """
+    db.execute(
+        'INSERT INTO pdf_archivo (entrega_id, ruta, tamano, sha256, creado) VALUES (?,?,?,?,?) '
+        'ON CONFLICT(entrega_id) DO UPDATE SET ruta = excluded.ruta, tamano = excluded.tamano, '
+        'sha256 = excluded.sha256, creado = excluded.creado',
+        (entrega_id, ruta, len(data), hashlib.sha256(data).hexdigest(), datetime.utcnow().isoformat()),
+    )
+
+
+def _legacy_pdf(index, entrega, directory):
+    """``(ruta, bytes)`` del PDF sin indexar de *entrega* en la raíz de *directory*, o None."""
+    name = find_archived_pdf(index, entrega['imei'], entrega['timestamp'])
+    if not name:
+        return None
+    try:
+        with open(archived_pdf_file(name, directory), 'rb') as f:
+            return name, f.read()
+    except (OSError, ValueError):
+        return None
+
+
+def get_archived_pdf(db, entrega_id, directory=PDF_ENTREGAS_DIR):
+    """Fila de ``pdf_archivo`` de la entrega *entrega_id*, o None si no tiene PDF archivado.
+
+    Los PDFs anteriores al índice (en la raíz de ``pdfs/entregas``) se buscan
+    por IMEI y fecha la primera vez y quedan indexados (con la conexión de
+    escritura: *db* puede ser de solo lectura).
+    """
+    row = db.execute('SELECT * FROM pdf_archivo WHERE entrega_id = ?', (entrega_id,)).fetchone()
+    if row:
+        return row
+    entrega = db.execute('SELECT id, imei, timestamp FROM entregas WHERE id = ?', (entrega_id,)).fetchone()
+    if not entrega:
+        return None
+    legacy = _legacy_pdf(_index_archived_pdfs(directory), entrega, directory)
+    if not legacy:
+        return None
+    from models import write_transaction
+    with write_transaction() as wdb:
+        index_archived_pdf(wdb, entrega_id, *legacy)
+    return db.execute('SELECT * FROM pdf_archivo WHERE entrega_id = ?', (entrega_id,)).fetchone()
+
+
+# ---------------------------------------------------------------------------
+# Lotes de PDFs de entrega (ZIP en streaming)
+# ---------------------------------------------------------------------------
+
+PDF_BATCH_WORKERS = min(4, os.cpu_count() or 1)  # procesos que maquetan PDFs
+PDF_BATCH_WINDOW = 32          # PDFs en vuelo por descarga (acota la memoria)
+PDF_ARCHIVE_TOLERANCE = 60     # segundos entre el registro y el nombre de su PDF archivado
+PDF_ZIP_MAX = 2000             # entregas por ZIP: más hay que acotarlas con los filtros
+
+_RE_PDF_ARCHIVADO = re.compile(r'^entrega_(.*)_(\d{8}_\d{6})\.pdf$')
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+def _get_pdf_pool():
+    """Pool de procesos para maquetar PDFs (se crea al primer lote).
+
+    Se arranca con ``spawn``: hacer fork de un worker con hilos (importaciones,
+    archivo de PDFs) puede heredar locks tomados.  Cada proceso construye su
+    propia plantilla (:func:`_get_pdf_template`) una sola vez.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_BATCH_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _pdf_pool
+
+
+def _index_archived_pdfs(directory=PDF_ENTREGAS_DIR):
+    """{imei: [(fecha, nombre), ...]} de los PDFs sin indexar de la raíz de *directory*."""
+    index = {}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return index
+    for name in names:
+        m = _RE_PDF_ARCHIVADO.match(name)
+        if not m:
+            continue
+        try:
+            when = datetime.strptime(m.group(2), '%Y%m%d_%H%M%S')
+        except ValueError:
+            continue
+        index.setdefault(m.group(1), []).append((when, name))
+    for entries in index.values():
+        entries.sort()
+    return index
+
+
+def _parse_timestamp(value):
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
+def find_archived_pdf(index, imei, timestamp, tolerance=PDF_ARCHIVE_TOLERANCE):
+    """Nombre del PDF archivado de la entrega (*imei*, *timestamp*) o None.
+
+    El PDF se genera justo después de guardar la entrega, así que su nombre
+    lleva una fecha igual o unos segundos posterior al ``timestamp``.
+    """
+    when = _parse_timestamp(timestamp)
+    if when is None:
+        return None
+    when = when.replace(microsecond=0)
+    for fecha, name in index.get(imei or '', ()):
+        delta = (fecha - when).total_seconds()
+        if 0 <= delta <= tolerance:
+            return name
+    return None
+
+
+def iter_entrega_pdfs(rows, db=None, directory=PDF_ENTREGAS_DIR):
+    """Genera ``(nombre, bytes)`` con el PDF de cada entrega de *rows*, en orden.
+
+    Si la entrega ya tiene PDF archivado se reutiliza; si no, se maqueta en
+    el pool de procesos y se archiva para la próxima vez.  Con *db* se
+    consulta ``pdf_archivo`` y se indexan los PDFs antiguos encontrados en
+    la raíz del directorio; los nuevos los indexa el hilo de archivo cuando
+    ya están en disco (ver :func:`archive_pdf`).  Nunca hay más de
+    ``PDF_BATCH_WINDOW`` PDFs en vuelo y *rows* (p. ej. un cursor) se
+    consume a medida que se envían, así que la memoria no depende del
+    tamaño del lote.
+    """
+    legacy = None  # índice del directorio, solo si alguna entrega no está en pdf_archivo
+    pending = deque()
+    por_indexar = []
+
+    def indexar():
+        # Una transacción corta por tanda: nunca se tiene el bloqueo de
+        # escritura mientras se envía el ZIP
+        from models import write_transaction
+        with write_transaction(db):
+            for args in por_indexar:
+                index_archived_pdf(db, *args)
+        por_indexar.clear()
+
+    def resolve(item):
+        entrega_id, ruta, legado, future, args = item
+        indice = entrega_id if db is not None else None
+        if future is None:
+            try:
+                with open(archived_pdf_file(ruta, directory), 'rb') as f:
+                    data = f.read()
+            except (OSError, ValueError):
+                # Borrado mientras tanto o ruta fuera del archivo: se maqueta de nuevo
+                ruta = archived_pdf_path(args[2], _parse_timestamp(args[5]) or datetime.utcnow(), entrega_id)
+                data, legado = render_entrega_pdf(*args), False
+                archive_pdf(ruta, data, directory, indice)
+        else:
+            data = future.result()
+            archive_pdf(ruta, data, directory, indice)
+        if db is not None and legado:  # PDF antiguo de la raíz: se indexa aquí
+            por_indexar.append((entrega_id, ruta, data))
+            if len(por_indexar) >= PDF_BATCH_WINDOW:
+                indexar()
+        return os.path.basename(ruta), data
+
+    try:
+        for r in rows:
+            args = (r['situm'], r['usuario'], r['imei'], r['telefono'], r['notas_telefono'],
+                    r['timestamp'], r['codigo_validacion'])
+            indexed = db.execute('SELECT ruta FROM pdf_archivo WHERE entrega_id = ?',
+                                 (r['id'],)).fetchone() if db is not None else None
+            if indexed:
+                pending.append((r['id'], indexed[0], False, None, args))
+            else:
+                if legacy is None:
+                    legacy = _index_archived_pdfs(directory)
+                name = find_archived_pdf(legacy, r['imei'], r['timestamp'])
+                if name:
+                    pending.append((r['id'], name, True, None, args))
+                else:
+                    ruta = archived_pdf_path(r['imei'], _parse_timestamp(r['timestamp']) or datetime.utcnow(),
+                                             r['id'])
+                    pending.append((r['id'], ruta, False, _get_pdf_pool().submit(render_entrega_pdf, *args), args))
+            if len(pending) >= PDF_BATCH_WINDOW:
+                yield resolve(pending.popleft())
+        while pending:
+            yield resolve(pending.popleft())
+    finally:
+        for item in pending:  # descarga cortada: no maquetar lo que ya nadie va a leer
+            if item[3] is not None:
+                item[3].cancel()
+        if por_indexar:
+            indexar()
+
+
+class _ZipSink(io.RawIOBase):
+    """Destino no posicionable de ``zipfile``: acumula lo escrito hasta ``take()``."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(entries):
+    """Construye al vuelo un ZIP con *entries* (``(nombre, bytes)``) y genera sus trozos.
+
+    Los PDFs ya van comprimidos, así que se guardan sin recomprimir.  Los
+    nombres repetidos llevan un sufijo ``-2``, ``-3``...
+    """
+    sink = _ZipSink()
+    seen = set()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+        for name, data in entries:
+            base, ext = os.path.splitext(name)
+            n = 1
+            while name in seen:
+                n += 1
+                name = f'{base}-{n}{ext}'
+            seen.add(name)
+            zf.writestr(name, data)
+            yield sink.take()
+    yield sink.take()
+
+
+# ---------------------------------------------------------------------------
+# Almacén de adjuntos (direccionado por contenido)
+# ---------------------------------------------------------------------------
+
+ADJUNTOS_DIR = os.path.join(BASE_DIR, 'pdfs', 'adjuntos')
+ADJUNTO_MAX_BYTES = 20 * 1024 * 1024  # tamaño máximo de un adjunto subido
+_CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentTooLarge(ValueError):
+    """El adjunto supera el tamaño máximo permitido."""
+
+
+def attachment_path(sha256):
+    """Ruta en disco del adjunto con hash *sha256* (``ab/cd/abcd...``)."""
+    return os.path.join(ADJUNTOS_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+def spool_attachment(stream, max_bytes=ADJUNTO_MAX_BYTES):
+    """Copia *stream* a un temporal del almacén y devuelve ``{'tmp', 'sha256', 'size'}``.
+
+    Se lee y escribe por bloques mientras se calcula el hash, así que nunca
+    se tiene el fichero entero en memoria.  El temporal se publica con
+    :func:`publish_attachment` (o se descarta con :func:`discard_attachment`).
+    Lanza :class:`AttachmentTooLarge` si se superan *max_bytes* (``None`` =
+    sin límite).
+    """
+    os.makedirs(ADJUNTOS_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=ADJUNTOS_DIR, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            while True:
+                chunk = stream.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise AttachmentTooLarge(f'El archivo supera el máximo de {max_bytes // (1024 * 1024)} MB')
+                digest.update(chunk)
+                tmp.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return {'tmp': tmp_path, 'sha256': digest.hexdigest(), 'size': size}
+
+
+def discard_attachment(spooled):
+    """Borra el temporal de *spooled* si sigue ahí (no se llegó a publicar)."""
+    if spooled:
+        try:
+            os.remove(spooled['tmp'])
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def publish_attachment(spooled):
+    """Mueve el temporal de *spooled* a su sitio en el almacén durante el bloque.
+
+    Hay que usarlo dentro de ``write_transaction`` y con el ``INSERT`` que
+    referencia el adjunto en el bloque: con el bloqueo de escritura tomado,
+    :func:`remove_unreferenced_attachments` no puede borrar el fichero entre
+    la publicación y el ``INSERT``.  Si ya existe un adjunto con el mismo
+    contenido se reutiliza (deduplicación); si el bloque falla y el fichero
+    lo había creado esta llamada, se borra.  *spooled* None no hace nada.
+    """
+    if not spooled:
+        yield
+        return
+    final_path = attachment_path(spooled['sha256'])
+    creado = False
+    try:
+        if os.path.exists(final_path):
+            discard_attachment(spooled)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(spooled['tmp'], final_path)
+            creado = True
+        yield
+    except BaseException:
+        discard_attachment(spooled)
+        if creado:
+            os.remove(final_path)
+        raise
+
+
+def store_attachment(stream, max_bytes=ADJUNTO_MAX_BYTES):
+    """Guarda el contenido de *stream* en el almacén y devuelve (sha256, tamaño).
+
+    Atajo de :func:`spool_attachment` + :func:`publish_attachment` para quien
+    ya tiene el bloqueo de escritura (la migración de adjuntos de
+    :mod:`models`).
+    """
+    spooled = spool_attachment(stream, max_bytes)
+    with publish_attachment(spooled):
+        pass
+    return spooled['sha256'], spooled['size']
 
-    # Guardar copia en servidor
-    pdf_dir = os.path.join(BASE_DIR, 'pdfs', 'entregas')
-    os.makedirs(pdf_dir, exist_ok=True)
-    pdf_filename = f"entrega_{imei}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.pdf"
-    pdf_path = os.path.join(pdf_dir, pdf_filename)
-    with open(pdf_path, 'wb') as f:
-        f.write(pdf_buffer.getvalue())
 
-    pdf_buffer.seek(0)
-    return pdf_buffer, pdf_filename
+def remove_unreferenced_attachments(db, hashes):
+    """Borra del disco los adjuntos de *hashes* que ya no referencia ninguna incidencia.
+
+    Hay que llamarla dentro de ``write_transaction``, tras el ``DELETE``: la
+    comprobación y el borrado no pueden intercalarse con una subida del mismo
+    contenido (ver :func:`publish_attachment`).
+    """
+    for sha256 in set(h for h in hashes if h):
+        in_use = db.execute(
+            'SELECT 1 FROM incidencias WHERE archivo_sha256 = ? LIMIT 1', (sha256,)
+        ).fetchone()
+        if not in_use:
+            try:
+                os.remove(attachment_path(sha256))
+            except FileNotFoundError:
+                pass
 
 
 # ---------------------------------------------------------------------------
 # Importación genérica de ficheros CSV / XLSX
 # ---------------------------------------------------------------------------
 
-def parse_import_file(file):
-    """Lee un fichero CSV o XLSX y devuelve (rows: list[dict], errors: list[str]).
+def _spooled_upload(file):
+    """Devuelve un fichero binario con posicionamiento con el contenido subido.
+
+    Werkzeug ya vuelca a un temporal las subidas grandes; solo se copia a
+    otro temporal si el stream no admite ``seek``.
+    """
+    stream = file.stream
+    if getattr(stream, 'seekable', lambda: False)():
+        stream.seek(0)
+        return stream
+    spool = tempfile.TemporaryFile()
+    while True:
+        chunk = stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+_CSV_ENCODINGS = ('utf-8-sig', 'cp1252')  # Excel en español guarda los CSV en Windows-1252
+
 
-    ``file`` es un FileStorage de Flask (request.files).
+def _csv_encoding(stream):
+    """Primera de ``_CSV_ENCODINGS`` que decodifica *stream* entero, o None.
+
+    Se comprueba por bloques (sin cargarlo en memoria) antes de importar
+    nada: la lectura es perezosa y un error de codificación a mitad del
+    fichero dejaría importados los bloques anteriores.
+    """
+    for encoding in _CSV_ENCODINGS:
+        stream.seek(0)
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            while True:
+                chunk = stream.read(_CHUNK_SIZE)
+                decoder.decode(chunk, final=not chunk)
+                if not chunk:
+                    break
+        except UnicodeDecodeError:
+            continue
+        stream.seek(0)
+        return encoding
+    return None
+
+
+def _xlsx_cell(val):
+    if val is None:
+        return None
+    if isinstance(val, float) and val.is_integer():
+        return str(int(val))
+    return str(val)
+
+
+def _iter_raw_rows(rows, errors, on_close=None):
+    """Itera las filas crudas (secuencias) anotando en *errors* los fallos de lectura."""
+    try:
+        yield from rows
+    except Exception as e:
+        errors.append(f'Error al procesar el archivo: {e}')
+    finally:
+        if on_close:
+            on_close()
+
+
+def _open_import(file):
+    """Abre la subida y devuelve (cabeceras, filas, errors).
+
+    *filas* es un iterador perezoso de secuencias posicionales (listas del
+    CSV o tuplas de openpyxl, sin convertir) o ``None`` si hubo error.
     """
     if not file or file.filename == '':
-        return [], ['No se subió ningún archivo.']
+        return [], None, ['No se subió ningún archivo.']
 
-    data = file.read()
     filename = (file.filename or '').lower()
-    rows = []
     errors = []
-
     try:
         if filename.endswith('.csv'):
-            text = data.decode('utf-8-sig')
-            rows = list(csv.DictReader(io.StringIO(text)))
-        elif filename.endswith(('.xlsx', '.xlsm', '.xls')):
-            wb = load_workbook(filename=io.BytesIO(data), read_only=True, data_only=True)
-            ws = wb.active
-            it = ws.iter_rows(values_only=True)
+            data = _spooled_upload(file)
+            encoding = _csv_encoding(data)
+            if encoding is None:
+                errors.append('Error al procesar el archivo: el CSV no está en UTF-8 ni en Windows-1252.')
+                return [], None, errors
+            text = io.TextIOWrapper(data, encoding=encoding, newline='')
+            reader = csv.reader(text)
+            headers = [h.strip() for h in next(reader, [])]
+            return headers, _iter_raw_rows(reader, errors, text.detach), errors
+        if filename.endswith(('.xlsx', '.xlsm', '.xls')):
+            wb = load_workbook(filename=_spooled_upload(file), read_only=True, data_only=True)
+            it = wb.active.iter_rows(values_only=True)
             try:
                 headers = [str(h).strip() if h is not None else '' for h in next(it)]
             except StopIteration:
                 headers = []
-            for row in it:
-                rowdict = {}
-                for i, h in enumerate(headers):
-                    key = h if h else f'col{i}'
-                    val = row[i] if i < len(row) else None
-                    if val is not None:
-                        if isinstance(val, float) and val.is_integer():
-                            val = str(int(val))
-                        else:
-                            val = str(val)
-                    rowdict[key] = val
-                rows.append(rowdict)
-        else:
-            errors.append('Formato no soportado. Suba CSV o XLSX.')
+            return headers, _iter_raw_rows(it, errors, wb.close), errors
+        errors.append('Formato no soportado. Suba CSV o XLSX.')
     except Exception as e:
         errors.append(f'Error al procesar el archivo: {e}')
+    return [], None, errors
 
-    return rows, errors
+
+def compile_header_map(headers, fields):
+    """Resuelve una sola vez qué columnas alimentan cada campo lógico.
+
+    *fields* es un dict campo → claves candidatas (p.ej. ``'telefono':
+    ['telefono', 'phone']``).  Para cada campo devuelve la tupla de índices de
+    columna a probar, en el mismo orden de prioridad que :func:`get_value`:
+    primero coincidencias exactas y después sin distinguir mayúsculas.
+    """
+    exact = {}
+    lower = {}
+    for i, h in enumerate(headers):
+        if h:
+            exact.setdefault(h, i)
+            lower.setdefault(h.lower(), i)
+    index_map = []
+    for keys in fields.values():
+        idxs = [exact[k] for k in keys if k in exact]
+        idxs += [lower[k.lower()] for k in keys if k.lower() in lower]
+        index_map.append(tuple(dict.fromkeys(idxs)))
+    return index_map
+
+
+def _first_value(row, idxs):
+    """Primer valor no vacío de *row* entre las columnas *idxs* ('' si no hay)."""
+    n = len(row)
+    for i in idxs:
+        if i < n:
+            val = row[i]
+            if val is not None:
+                if isinstance(val, float) and val.is_integer():
+                    val = int(val)
+                val = str(val).strip()
+                if val:
+                    return val
+    return ''
+
+
+def parse_import_file(file, fields=None):
+    """Lee un fichero CSV o XLSX y devuelve (rows, errors).
+
+    ``file`` es un FileStorage de Flask (request.files).  *rows* es un
+    iterador perezoso (una fila cada vez, sin cargar el fichero en memoria) o
+    ``[]`` si el fichero no se puede abrir.  Los errores que aparezcan durante
+    la iteración se añaden a la misma lista *errors*.
+
+    Con *fields* (ver :func:`compile_header_map`) cada fila es una tupla con
+    el valor de cada campo, en el orden de *fields*, ya normalizado a texto
+    sin espacios ('' si falta).  Sin *fields* cada fila es un dict
+    cabecera → valor.
+    """
+    headers, raw_rows, errors = _open_import(file)
+    if raw_rows is None:
+        return [], errors
+
+    if fields is not None:
+        index_map = compile_header_map(headers, fields)
+        return (tuple(_first_value(r, idxs) for idxs in index_map) for r in raw_rows), errors
+
+    keys = [h if h else f'col{i}' for i, h in enumerate(headers)]
+    return ({
+        key: _xlsx_cell(r[i]) if i < len(r) else None
+        for i, key in enumerate(keys)
+    } for r in raw_rows), errors
 
 
 def get_value(row, keys):
@@ -287,6 +1099,326 @@ def get_value(row, keys):
     return ''
 
 
+# ---------------------------------------------------------------------------
+# Inserción masiva de importaciones
+# ---------------------------------------------------------------------------
+
+IMPORT_CHUNK_ROWS = 5000  # filas por transacción en bulk_insert
+
+
+class ImportRowError(ValueError):
+    """Fila de importación inválida; el mensaje (el motivo) se añade a los errores."""
+
+
+UPSERT_FIJAS = ('fecha_creacion',)  # columnas que un upsert no sobrescribe
+
+
+def insert_sql(tabla, columnas):
+    """``INSERT INTO tabla (columnas) VALUES (?, ...)``."""
+    return f'INSERT INTO {tabla} ({", ".join(columnas)}) VALUES ({", ".join("?" * len(columnas))})'
+
+
+def _upsert_cambiables(clave, columnas, fijas):
+    return [c for c in columnas if c != clave and c not in fijas]
+
+
+def upsert_sql(tabla, columnas, fijas=UPSERT_FIJAS):
+    """``INSERT ... ON CONFLICT DO UPDATE`` sobre la clave natural de *tabla*.
+
+    La clave es la de :data:`models.CLAVES_NATURALES`.  Si la fila ya existe
+    se actualizan las demás *columnas* (salvo las *fijas*), y solo cuando
+    alguna cambia: las filas idénticas no se reescriben.
+    """
+    from models import CLAVES_NATURALES
+    clave = CLAVES_NATURALES[tabla]
+    cambiables = _upsert_cambiables(clave, columnas, fijas)
+    return (
+        insert_sql(tabla, columnas)
+        + f" ON CONFLICT({clave}) WHERE {clave} <> '' DO UPDATE SET "
+        + ', '.join(f'{c} = excluded.{c}' for c in cambiables)
+        + ' WHERE ' + ' OR '.join(f'{tabla}.{c} IS NOT excluded.{c}' for c in cambiables)
+    )
+
+
+def bulk_insert(db, insert_sql, rows, to_values, chunk_size=IMPORT_CHUNK_ROWS, first_row=2,
+                progress=None, table=None):
+    """Pipeline común de importación: valida, agrupa e inserta con ``executemany``.
+
+    *to_values(row)* convierte cada fila leída en la tupla de parámetros de
+    *insert_sql*, o lanza :class:`ImportRowError` con el motivo para omitirla.
+    Las tuplas se insertan en bloques de *chunk_size* filas, una transacción
+    por bloque.  Si un bloque falla se reintenta fila a fila para aislar las
+    filas erróneas.
+    *first_row* es el número de fila de la primera fila de datos (la 1 es la
+    cabecera).  Si se pasa *progress* se llama con el dict de resultado tras
+    cada bloque (ver :mod:`jobs`).
+    Con *insert_sql* de :func:`upsert_sql` hay que pasar la *table* destino:
+    las filas nuevas se cuentan por la diferencia de ``COUNT(*)`` del bloque
+    y el resto de filas modificadas son actualizaciones.
+
+    Devuelve un dict con:
+      - processed: filas leídas
+      - inserted:  filas insertadas
+      - updated:   filas existentes modificadas (solo upserts)
+      - unchanged: filas existentes idénticas, no reescritas (solo upserts)
+      - errors:    mensajes ``Fila N: motivo`` (validación e inserción)
+      - chunks:    lista de (filas, segundos) por bloque insertado
+      - seconds:   duración total
+    """
+    result = {'processed': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'errors': [],
+              'chunks': [], 'seconds': 0.0}
+    started = time.perf_counter()
+    batch, batch_rows = [], []
+    count_sql = f'SELECT COUNT(*) FROM {table}' if table else None
+
+    def insert_chunk():
+        before = db.execute(count_sql).fetchone()[0] if table else 0
+        changed = db.executemany(insert_sql, batch).rowcount
+        nuevas = db.execute(count_sql).fetchone()[0] - before if table else 0
+        return changed, len(batch), nuevas
+
+    def insert_row_by_row():
+        # Cada fila en su savepoint: las erróneas se deshacen sin perder el resto
+        before = db.execute(count_sql).fetchone()[0] if table else 0
+        changed = ok = 0
+        for idx, values in zip(batch_rows, batch):
+            db.execute('SAVEPOINT fila')
+            try:
+                changed += db.execute(insert_sql, values).rowcount
+                ok += 1
+            except sqlite3.DatabaseError as e:
+                db.execute('ROLLBACK TO fila')
+                result['errors'].append(f'Fila {idx}: {e}')
+            db.execute('RELEASE fila')
+        nuevas = db.execute(count_sql).fetchone()[0] - before if table else 0
+        return changed, ok, nuevas
+
+    def flush():
+        from models import write_transaction
+        t0 = time.perf_counter()
+        # Un turno de escritura por bloque: entre bloques pueden escribir
+        # otras peticiones (p. ej. registrar una entrega)
+        try:
+            with write_transaction(db):
+                changed, ok, nuevas = insert_chunk()
+        except sqlite3.DatabaseError:
+            with write_transaction(db):
+                changed, ok, nuevas = insert_row_by_row()
+        if table:
+            result['inserted'] += nuevas
+            result['updated'] += changed - nuevas
+            result['unchanged'] += ok - changed
+        else:
+            result['inserted'] += ok
+        elapsed = time.perf_counter() - t0
+        result['chunks'].append((len(batch), elapsed))
+        current_app.logger.info('bulk_insert: bloque de %d filas en %.3f s', len(batch), elapsed)
+        batch.clear()
+        batch_rows.clear()
+        if progress:
+            result['seconds'] = time.perf_counter() - started
+            progress(result)
+
+    for idx, row in enumerate(rows, first_row):
+        result['processed'] += 1
+        try:
+            values = to_values(row)
+        except ImportRowError as e:
+            result['errors'].append(f'Fila {idx}: {e}')
+            continue
+        batch.append(values)
+        batch_rows.append(idx)
+        if len(batch) >= chunk_size:
+            flush()
+    if batch:
+        flush()
+
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def import_rows(db, tabla, columnas, rows, to_values, dry_run=False, progress=None,
+                match=None, column_checks=None):
+    """Importa *rows* en *tabla* con el pipeline común.
+
+    Las tablas con clave natural (:data:`models.CLAVES_NATURALES`) se
+    importan con :func:`upsert_sql`; el resto con un ``INSERT`` simple.  Con
+    *dry_run* no se escribe nada: se devuelve el informe de
+    :func:`dry_run_import` (*match* y *column_checks* solo se usan ahí).
+    """
+    from models import CLAVES_NATURALES
+    if dry_run:
+        return dry_run_import(db, tabla, columnas, rows, to_values, match=match,
+                              column_checks=column_checks, progress=progress)
+    clave = CLAVES_NATURALES.get(tabla)
+    if clave:
+        to_values = _normalizar_clave(to_values, columnas.index(clave))
+        return bulk_insert(db, upsert_sql(tabla, columnas), rows, to_values,
+                           progress=progress, table=tabla)
+    return bulk_insert(db, insert_sql(tabla, columnas), rows, to_values, progress=progress)
+
+
+def _normalizar_clave(to_values, pos):
+    """*to_values* con la clave natural (posición *pos*) normalizada: así se
+    guarda y así coincide con la de la BD (ver :func:`models.normalize_clave`)."""
+    from models import normalize_clave
+
+    def normalizado(row):
+        values = list(to_values(row))
+        values[pos] = normalize_clave(values[pos])
+        return tuple(values)
+    return normalizado
+
+
+def dry_run_import(db, tabla, columnas, rows, to_values, match=None, column_checks=None,
+                   first_row=2, progress=None, chunk_size=IMPORT_CHUNK_ROWS):
+    """Simulación de importación: valida el fichero entero sin escribir en *tabla*.
+
+    1. Cada fila pasa por *to_values* igual que en la importación real (los
+       rechazos salen como ``Fila N: motivo``).
+    2. *column_checks* (columna → validador, ver :func:`check_imei_column`)
+       revisa columnas completas y añade ``Fila N: aviso: ...``: son filas
+       que se importarían pero conviene revisar.
+    3. Las filas válidas se cargan en una tabla temporal y se cruzan con
+       *tabla* en una sola consulta.  En tablas con clave natural eso da las
+       filas que se insertarían, actualizarían o quedarían igual (y avisa de
+       claves repetidas en el propio fichero); en el resto, *match* son las
+       columnas que identifican un registro ya existente y cada coincidencia
+       se avisa como posible reimportación.
+
+    La clave natural se normaliza como en la importación real para cruzarla,
+    pero los avisos muestran los valores tal como vienen en el fichero.
+
+    Si se pasa *progress* se llama con el dict de resultado cada *chunk_size*
+    filas leídas y antes del cruce final, igual que en :func:`bulk_insert`:
+    hasta el final solo se conocen las filas procesadas y los errores.
+
+    Devuelve el mismo dict que :func:`bulk_insert` con ``dry_run=True``.
+    """
+    from models import CLAVES_NATURALES, normalize_clave
+    started = time.perf_counter()
+    result = {'processed': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'errors': [],
+              'chunks': [], 'seconds': 0.0, 'dry_run': True}
+    clave = CLAVES_NATURALES.get(tabla)
+    if clave:
+        pos_clave = columnas.index(clave)
+        leer = to_values
+
+        def to_values(row):
+            values = list(leer(row))
+            originales.append(values[pos_clave])
+            values[pos_clave] = normalize_clave(values[pos_clave])
+            return tuple(values)
+    valid, filas, originales = [], [], []  # originales: la clave tal cual, para los avisos
+    for idx, row in enumerate(rows, first_row):
+        result['processed'] += 1
+        if progress and result['processed'] % chunk_size == 0:
+            result['seconds'] = time.perf_counter() - started
+            progress(result)
+        try:
+            valid.append(to_values(row))
+        except ImportRowError as e:
+            result['errors'].append(f'Fila {idx}: {e}')
+            continue
+        filas.append(idx)
+    if progress:
+        result['seconds'] = time.perf_counter() - started
+        progress(result)
+
+    avisos = []
+    for col, check in (column_checks or {}).items():
+        pos = columnas.index(col)
+        columna = originales if col == clave else [v[pos] for v in valid]
+        avisos += [(filas[i], msg) for i, msg in check(columna)]
+
+    if clave:
+        vistas = {}
+        for fila, values, original in zip(filas, valid, originales):
+            if values[pos_clave] in vistas:
+                avisos.append((fila, f'{clave} "{original}" repetido en el fichero '
+                                     f'(fila {vistas[values[pos_clave]]}); se queda el último'))
+            elif values[pos_clave]:
+                vistas[values[pos_clave]] = fila
+        match = (clave,)
+
+    result['inserted'] = len(valid)
+    if valid and match:
+        cols = ', '.join(columnas)
+        on = ' AND '.join(f't.{c} IS s.{c}' for c in match)
+        db.execute(f'CREATE TEMP TABLE _simulacion (_fila, {cols})')
+        try:
+            db.executemany(insert_sql('temp._simulacion', ('_fila',) + tuple(columnas)),
+                           [(f,) + tuple(v) for f, v in zip(filas, valid)])
+            if clave:
+                # Como en el upsert real, las filas se aplican en orden: la
+                # primera de cada clave se compara con la fila de la tabla (si
+                # existe) y las repetidas en el fichero con la anterior
+                db.execute(f'CREATE INDEX temp._simulacion_clave ON _simulacion ({clave}, _fila)')
+                cambiables = _upsert_cambiables(clave, columnas, UPSERT_FIJAS)
+
+                def distinta(a):
+                    return ' OR '.join(f'{a}.{c} IS NOT s.{c}' for c in cambiables) or '0'
+
+                existentes = db.execute(f'''
+                    SELECT CASE WHEN p._fila IS NOT NULL THEN {distinta('p')} ELSE {distinta('t')} END
+                    FROM _simulacion s
+                    LEFT JOIN _simulacion p ON p._fila = (
+                        SELECT MAX(q._fila) FROM _simulacion q WHERE q.{clave} = s.{clave} AND q._fila < s._fila)
+                    LEFT JOIN {tabla} t ON t.{clave} = s.{clave}
+                    WHERE s.{clave} <> '' AND (p._fila IS NOT NULL OR t.id IS NOT NULL)
+                ''').fetchall()
+                result['inserted'] -= len(existentes)
+                result['updated'] = sum(1 for (cambia,) in existentes if cambia)
+                result['unchanged'] = len(existentes) - result['updated']
+            else:
+                avisos += [(fila, 'ya existe un registro con los mismos datos')
+                           for (fila,) in db.execute(
+                               f'SELECT DISTINCT s._fila FROM _simulacion s JOIN {tabla} t ON {on}')]
+        finally:
+            db.execute('DROP TABLE temp._simulacion')
+            db.commit()
+
+    result['errors'] += [f'Fila {fila}: aviso: {msg}' for fila, msg in sorted(avisos)]
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Búsqueda por subcadena
+# ---------------------------------------------------------------------------
+
+FTS_MIN_TERM = 3  # el tokenizer trigram no puede buscar términos más cortos
+
+
+def search_filter(tabla, terms):
+    """Construye el filtro ``AND ...`` de búsqueda por subcadena sobre *tabla*.
+
+    *terms* es un dict columna → término (los vacíos se ignoran).  Si existe
+    el índice ``<tabla>_fts`` los términos de 3+ caracteres se resuelven con
+    ``MATCH`` en ese índice; el resto usa ``LIKE '%term%'``.
+
+    Devuelve (fragmento_sql, params) listo para añadir tras un ``WHERE``.
+    """
+    import models
+
+    sql = ''
+    params = []
+    matches = []
+    fts_cols = models.FTS_TABLAS.get(tabla, ()) if models.FTS_ENABLED else ()
+    for col, term in terms.items():
+        if not term:
+            continue
+        if col in fts_cols and len(term) >= FTS_MIN_TERM:
+            matches.append('{} : "{}"'.format(col, term.replace('"', '""')))
+        else:
+            sql += f' AND {col} LIKE ?'
+            params.append(f'%{term}%')
+    if matches:
+        sql += f' AND id IN (SELECT rowid FROM {tabla}_fts WHERE {tabla}_fts MATCH ?)'
+        params.append(' AND '.join(matches))
+    return sql, params
+
+
 # ---------------------------------------------------------------------------
 # Paginación
 # ---------------------------------------------------------------------------
@@ -294,23 +1426,137 @@ def get_value(row, keys):
 PER_PAGE = 50  # registros por página por defecto
 
 
-def paginate_query(db, query, params, per_page=PER_PAGE):
+def _encode_cursor(direction, page, values):
+    """Codifica un cursor opaco (base64 url-safe) para la paginación keyset."""
+    raw = json.dumps([direction, page, *values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(token):
+    """Decodifica un cursor. Devuelve (direction, page, values) o None si es inválido."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        direction, page, *values = json.loads(raw.decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if direction not in ('after', 'before') or not isinstance(page, int):
+        return None
+    return direction, max(1, page), values
+
+
+def _keyset_seek(db, query, params, keyset, values, limit, desc=True):
+    """Hasta *limit* filas de *query* a continuación de *values* en el orden de
+    *keyset* (descendente o, con ``desc=False``, ascendente).
+
+    La primera columna del keyset puede ser NULL (registros antiguos sin
+    ``timestamp``); las demás no, y la última debe ser única.  SQLite ordena
+    los NULL antes que cualquier valor, así que en orden descendente van al
+    final.  La comparación de tuplas nunca es cierta con un NULL, por eso ese
+    tramo se consulta aparte: dos rangos siguen usando el índice, mientras
+    que un ``OR ... IS NULL`` o un ``COALESCE`` obligarían a recorrerlo entero.
+    """
+    first, rest = keyset[0], keyset[1:]
+    sentido, op = ('DESC', '<') if desc else ('ASC', '>')
+    order = ', '.join(f'{c} {sentido}' for c in keyset)
+    params = list(params)
+
+    def tramo(cond, extra, n):
+        return db.execute(f'{query} AND {cond} ORDER BY {order} LIMIT ?', params + extra + [n]).fetchall()
+
+    rest_cond = f"({', '.join(rest)}) {op} ({', '.join('?' for _ in rest)})"
+    if values[0] is None:
+        rows = tramo(f'{first} IS NULL AND {rest_cond}', list(values[1:]), limit)
+        if not desc and len(rows) < limit:
+            rows += tramo(f'{first} IS NOT NULL', [], limit - len(rows))
+        return rows
+    cols = ', '.join(keyset)
+    rows = tramo(f"({cols}) {op} ({', '.join('?' for _ in keyset)})", list(values), limit)
+    if desc and len(rows) < limit:
+        rows += tramo(f'{first} IS NULL', [], limit - len(rows))
+    return rows
+
+
+# Caché de totales: (consulta normalizada, params) → (versión de tabla, total)
+_COUNT_CACHE = OrderedDict()
+_COUNT_CACHE_MAX = 256
+_COUNT_CACHE_LOCK = threading.Lock()
+
+APPROX_COUNT_CAP = 10000  # en modo aproximado se cuenta como máximo hasta aquí
+
+
+def cached_count(db, query, params, table=None, cap=None):
+    """Cuenta las filas de *query*, reutilizando el resultado mientras *table* no cambie.
+
+    La clave es la consulta normalizada (espacios colapsados) más sus params;
+    el valor se invalida cuando cambia el contador de ``versiones_tabla``
+    (los triggers lo incrementan en cada INSERT/UPDATE/DELETE).  Con *cap* se
+    deja de contar al llegar a ese número ("al menos N").
+    """
+    if cap:
+        count_query, count_params = f'SELECT COUNT(*) FROM ({query} LIMIT ?)', list(params) + [cap]
+    else:
+        count_query, count_params = f'SELECT COUNT(*) FROM ({query})', list(params)
+
+    if not table:
+        return db.execute(count_query, count_params).fetchone()[0]
+
+    from models import get_table_version
+    key = (' '.join(count_query.split()), tuple(count_params))
+    version = get_table_version(db, table)
+    with _COUNT_CACHE_LOCK:
+        hit = _COUNT_CACHE.get(key)
+        if hit and hit[0] == version:
+            _COUNT_CACHE.move_to_end(key)
+            return hit[1]
+
+    total = db.execute(count_query, count_params).fetchone()[0]
+    with _COUNT_CACHE_LOCK:
+        _COUNT_CACHE[key] = (version, total)
+        _COUNT_CACHE.move_to_end(key)
+        while len(_COUNT_CACHE) > _COUNT_CACHE_MAX:
+            _COUNT_CACHE.popitem(last=False)
+    return total
+
+
+def paginate_query(db, query, params, per_page=PER_PAGE, keyset=None, table=None, approx=False):
     """Ejecuta *query* con paginación.
 
+    Sin *keyset* pagina con ``LIMIT/OFFSET`` y la página se toma de ``?page=``.
+
+    Con *keyset* (p.ej. ``('timestamp', 'id')``) pagina por cursor (seek): la
+    consulta debe incluir un ``WHERE`` y **no** llevar ``ORDER BY``; se ordena
+    por esas columnas en orden descendente y la posición se toma de ``?cursor=``.
+    Las filas con la primera columna a NULL van al final (ver :func:`_keyset_seek`).
+    Cada página cuesta lo mismo que la primera, sea cual sea su profundidad.
+
+    Si se indica *table*, el total se cachea hasta la siguiente escritura en
+    esa tabla (ver :func:`cached_count`).  Con *approx* el total se limita a
+    ``APPROX_COUNT_CAP`` y se marca como aproximado (pensado para vistas sin
+    filtros).
+
     Devuelve un dict con:
       - rows:        lista de filas de la página actual
       - page:        página actual (1-based)
       - per_page:    registros por página
-      - total:       total de registros
+      - total:       total de registros (cota inferior si total_aprox)
       - total_pages: total de páginas
+      - total_aprox: True si el total es "al menos N"
+      - next_cursor / prev_cursor: cursores opacos (solo en modo keyset)
     """
-    page = max(1, request.args.get('page', 1, type=int))
-
     # Total de registros
-    count_query = f'SELECT COUNT(*) FROM ({query})'
-    total = db.execute(count_query, params).fetchone()[0]
+    total = cached_count(db, query, params, table=table, cap=APPROX_COUNT_CAP if approx else None)
+    total_aprox = bool(approx and total >= APPROX_COUNT_CAP)
     total_pages = max(1, math.ceil(total / per_page))
 
+    if keyset:
+        pag = _paginate_keyset(db, query, params, per_page, keyset, total_pages, total_aprox)
+        pag.update(total=total, total_aprox=total_aprox)
+        return pag
+
+    page = max(1, request.args.get('page', 1, type=int))
+
     # Ajustar página si sobrepasa
     if page > total_pages:
         page = total_pages
@@ -325,20 +1571,218 @@ def paginate_query(db, query, params, per_page=PER_PAGE):
         'per_page': per_page,
         'total': total,
         'total_pages': total_pages,
+        'total_aprox': total_aprox,
     }
 
 
+def _paginate_keyset(db, query, params, per_page, keyset, total_pages, total_aprox):
+    """Implementación del modo cursor de :func:`paginate_query`."""
+    desc = ', '.join(f'{c} DESC' for c in keyset)
+
+    cursor = _decode_cursor(request.args.get('cursor', '').strip())
+    if cursor and len(cursor[2]) != len(keyset):
+        cursor = None
+
+    rows = None
+    if cursor and cursor[0] == 'before':
+        _, page, values = cursor
+        fetched = _keyset_seek(db, query, params, keyset, values, per_page + 1, desc=False)
+        if len(fetched) > per_page:
+            rows = list(reversed(fetched[:per_page]))
+            has_prev, has_next = True, True
+        # Sin página anterior completa: estamos al principio → primera página
+
+    if rows is None and cursor and cursor[0] == 'after':
+        _, page, values = cursor
+        fetched = _keyset_seek(db, query, params, keyset, values, per_page + 1)
+        rows = fetched[:per_page]
+        has_prev, has_next = True, len(fetched) > per_page
+
+    if rows is None:
+        page = 1
+        fetched = db.execute(f'{query} ORDER BY {desc} LIMIT ?', params + [per_page + 1]).fetchall()
+        rows = fetched[:per_page]
+        has_prev, has_next = False, len(fetched) > per_page
+
+    if not total_aprox:
+        page = min(page, total_pages)
+    next_cursor = prev_cursor = None
+    if rows and has_next:
+        next_cursor = _encode_cursor('after', page + 1, [rows[-1][c] for c in keyset])
+    if rows and has_prev:
+        prev_cursor = _encode_cursor('before', max(1, page - 1), [rows[0][c] for c in keyset])
+
+    return {
+        'rows': rows,
+        'page': page,
+        'per_page': per_page,
+        'total_pages': total_pages,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+    }
+
+
+def keyset_page(db, query, params, keyset, limit, cursor=None):
+    """Siguiente bloque de *limit* filas de *query* en orden descendente de *keyset*.
+
+    Versión solo-hacia-delante del modo cursor de :func:`paginate_query`,
+    para la API JSON: *cursor* es el ``next_cursor`` del bloque anterior (o
+    None para empezar).  Devuelve (rows, next_cursor).
+    """
+    desc = ', '.join(f'{c} DESC' for c in keyset)
+    decoded = _decode_cursor(cursor)
+    if decoded and decoded[0] == 'after' and len(decoded[2]) == len(keyset):
+        _, page, values = decoded
+        fetched = _keyset_seek(db, query, params, keyset, values, limit + 1)
+    else:
+        page = 1
+        fetched = db.execute(f'{query} ORDER BY {desc} LIMIT ?', list(params) + [limit + 1]).fetchall()
+    rows = fetched[:limit]
+    next_cursor = None
+    if len(fetched) > limit:
+        next_cursor = _encode_cursor('after', page + 1, [rows[-1][c] for c in keyset])
+    return rows, next_cursor
+
+
+# ---------------------------------------------------------------------------
+# API JSON de listados
+# ---------------------------------------------------------------------------
+
+API_MAX_LIMIT = 500  # filas máximas por petición a /api/<recurso>
+
+
+def api_list(db, query, params, campos, keyset, table=None):
+    """Respuesta JSON de un listado: proyección de campos + paginación por cursor.
+
+    *query* es la misma consulta (``SELECT ... FROM ... WHERE ...`` sin
+    ORDER BY) que usa la vista HTML, así que admite los mismos filtros.  De
+    la URL se leen:
+      - fields: campos separados por comas (subconjunto de *campos*)
+      - limit:  filas por bloque (por defecto ``PER_PAGE``, máx. ``API_MAX_LIMIT``)
+      - cursor: ``next_cursor`` de la respuesta anterior
+
+    El total (acotado a ``APPROX_COUNT_CAP``) solo se calcula en el primer
+    bloque; en los siguientes va a None.
+    """
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()] or list(campos)
+    desconocidos = [f for f in fields if f not in campos]
+    if desconocidos:
+        return jsonify(success=False, error=f"Campos no válidos: {', '.join(desconocidos)}"), 400
+    limit = min(max(1, request.args.get('limit', PER_PAGE, type=int)), API_MAX_LIMIT)
+    cursor = request.args.get('cursor', '').strip() or None
+
+    # Proyección: los campos pedidos más los del cursor
+    _, _, resto = query.partition(' FROM ')
+    select = ', '.join(dict.fromkeys(fields + list(keyset)))
+    rows, next_cursor = keyset_page(db, f'SELECT {select} FROM {resto}', params, keyset, limit, cursor)
+
+    total = total_aprox = None
+    if not cursor:
+        total = cached_count(db, query, params, table=table, cap=APPROX_COUNT_CAP)
+        total_aprox = total >= APPROX_COUNT_CAP
+    return jsonify(
+        success=True, fields=fields,
+        rows=[{f: r[f] for f in fields} for r in rows],
+        next_cursor=next_cursor, total=total, total_aprox=total_aprox,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Exportación
+# ---------------------------------------------------------------------------
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024  # por encima de esto el export pasa a disco
+EXPORT_FORMATS = ('xlsx', 'csv', 'ndjson')
+_EXPORT_BATCH_ROWS = 500  # filas por bloque enviado en los exports en streaming
+
+
 def build_excel(headers, rows_data):
-    """Crea un XLSX en memoria y devuelve un BytesIO listo para send_file."""
-    wb = Workbook()
-    ws = wb.active
+    """Crea un XLSX en modo *write-only* y devuelve un fichero listo para send_file.
+
+    *rows_data* puede ser cualquier iterable (p.ej. un generador sobre el
+    cursor): cada fila se escribe y se descarta, así que la memoria no depende
+    del número de filas.  El resultado se vuelca a un ``SpooledTemporaryFile``
+    que pasa a disco al superar ``EXPORT_SPOOL_BYTES``.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
     ws.append(headers)
     for r in rows_data:
         ws.append(r)
-    bio = io.BytesIO()
-    wb.save(bio)
-    bio.seek(0)
-    return bio
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    wb.save(out)
+    out.seek(0)
+    return out
+
+
+def send_excel(headers, rows_data, download_name):
+    """Respuesta de descarga (streaming, con Content-Length) de :func:`build_excel`."""
+    out = build_excel(headers, rows_data)
+    size = out.seek(0, io.SEEK_END)
+    out.seek(0)
+    rv = send_file(out, as_attachment=True, download_name=download_name, mimetype=XLSX_MIMETYPE)
+    rv.content_length = size
+    return rv
+
+
+def _iter_csv(headers, rows_data):
+    """Genera el CSV en bloques de ``_EXPORT_BATCH_ROWS`` filas."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(headers)
+    for n, r in enumerate(rows_data, 1):
+        writer.writerow(r)
+        if n % _EXPORT_BATCH_ROWS == 0:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+
+def _iter_ndjson(headers, rows_data):
+    """Genera una línea JSON por fila (claves = cabeceras), en bloques."""
+    lines = []
+    for r in rows_data:
+        lines.append(json.dumps(dict(zip(headers, r)), ensure_ascii=False))
+        if len(lines) >= _EXPORT_BATCH_ROWS:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def _closing_stream(body, db):
+    """Itera *body* y cierra *db* al terminar (o si el cliente corta la descarga)."""
+    try:
+        yield from body
+    finally:
+        if db is not None:
+            db.close()
+
+
+def send_export(headers, rows_data, basename, fmt=None):
+    """Respuesta de export en el formato pedido en ``?format=`` (xlsx por defecto).
+
+    CSV y NDJSON se generan en streaming directamente desde *rows_data*, con
+    memoria constante: la conexión de la petición pasa a la respuesta (ver
+    :func:`models.detach_db`) y se cierra al acabar el envío.  XLSX usa
+    :func:`send_excel`.
+    """
+    fmt = (fmt or request.args.get('format', '') or 'xlsx').strip().lower()
+    if fmt not in EXPORT_FORMATS:
+        return f'Formato de exportación no soportado: {fmt}', 400
+    if fmt == 'xlsx':
+        return send_excel(headers, rows_data, f'{basename}.xlsx')
+
+    if fmt == 'csv':
+        body, mimetype = _iter_csv(headers, rows_data), 'text/csv'
+    else:
+        body, mimetype = _iter_ndjson(headers, rows_data), 'application/x-ndjson'
+    from models import detach_db
+    rv = Response(_closing_stream(body, detach_db()), mimetype=mimetype)
+    rv.headers.set('Content-Disposition', 'attachment', filename=f'{basename}.{fmt}')
+    return rv
 
 
 # ---------------------------------------------------------------------------